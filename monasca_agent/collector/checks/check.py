@@ -39,7 +39,10 @@ class AgentCheck(util.Dimensions):
         self.aggregator = (
             aggregator.MetricsAggregator(self.hostname,
                                          recent_point_threshold=threshold,
-                                         tenant_id=tenant_id))
+                                         tenant_id=tenant_id,
+                                         series_ttl=agent_config.get('series_ttl', aggregator.SERIES_TTL_DEFAULT),
+                                         max_series=agent_config.get('max_series', -1),
+                                         rules=agent_config.get('aggregation_rules')))
 
         self.instances = instances or []
         self.library_versions = None
@@ -116,11 +119,12 @@ class AgentCheck(util.Dimensions):
                                       value_meta)
 
     def rate(self, metric, value, dimensions=None, delegated_tenant=None,
-             hostname=None, device_name=None, value_meta=None):
+             hostname=None, device_name=None, value_meta=None, counter_width=None):
         """Submit a point for a metric that will be calculated as a rate on flush.
 
         Values will persist across each call to `check` if there is not enough
-        point to generate a rate on the flush.
+        point to generate a rate on the flush. No rate is reported for the interval
+        in which a counter is reset, a counter of counter_width bits may also wrap around.
 
         :param metric: The name of the metric
         :param value: The value of the rate
@@ -129,10 +133,32 @@ class AgentCheck(util.Dimensions):
         :param hostname: (optional) A hostname for this metric. Defaults to the current hostname.
         :param device_name: (optional) The device name for this metric
         :param value_meta: Additional metadata about this value
+        :param counter_width: (optional) The number of bits after which the counter wraps around
         """
         self.aggregator.submit_metric(metric,
                                       value,
-                                      metrics_pkg.Rate,
+                                      metrics_pkg.rate_class(counter_width),
+                                      dimensions,
+                                      delegated_tenant,
+                                      hostname,
+                                      device_name,
+                                      value_meta)
+
+    def histogram(self, metric, value, dimensions=None, delegated_tenant=None,
+                  hostname=None, device_name=None, value_meta=None):
+        """Sample a histogram, reported on flush as the count, sum, min, max, avg and percentiles of the values.
+
+        :param metric: The name of the metric
+        :param value: The value to sample
+        :param dimensions: (optional) A dictionary of dimensions for this metric
+        :param delegated_tenant: (optional) Submit metrics on behalf of this tenant ID.
+        :param hostname: (optional) A hostname for this metric. Defaults to the current hostname.
+        :param device_name: (optional) The device name for this metric
+        :param value_meta: Additional metadata about this value
+        """
+        self.aggregator.submit_metric(metric,
+                                      value,
+                                      metrics_pkg.Histogram,
                                       dimensions,
                                       delegated_tenant,
                                       hostname,
@@ -1,6 +1,7 @@
 # (C) Copyright 2015-2017 Hewlett Packard Enterprise Development LP
 
 # Core modules
+import collections
 import logging
 from multiprocessing.dummy import Pool
 import os
@@ -9,6 +10,7 @@ import sys
 import threading
 import time
 
+import monasca_agent.common.aggregator as aggregator
 import monasca_agent.common.metrics as metrics
 import monasca_agent.common.util as util
 
@@ -80,7 +82,11 @@ class Collector(util.Dimensions):
             try:
                 self.emitter(payload, log, self.agent_config['forwarder_url'])
             except Exception:
-                log.exception("Error running emitter: %s" % self.emitter.__name__)
+                log.exception("Error running emitter.")
+
+    def _emitter_paused(self):
+        """Return True while the forwarder asked for no data to be sent."""
+        return hasattr(self.emitter, 'paused') and self.emitter.paused()
 
     def _set_status(self, collect_duration):
         if self.run_count <= FLUSH_LOGGING_INITIAL or self.run_count % FLUSH_LOGGING_PERIOD == 0:
@@ -105,6 +111,21 @@ class Collector(util.Dimensions):
 
         self.add_collection_metric('monasca.agent.collection_time_sec', collection_time)
 
+        for name, value in aggregator.get_validation_cache_statistics().iteritems():
+            self.add_collection_metric(name, value)
+
+        # Series held, evicted and discarded by the aggregators of all checks
+        series_statistics = collections.Counter()
+        for entry in self.collection_times.itervalues():
+            series_statistics.update(entry['check'].aggregator.get_statistics())
+        for name, value in series_statistics.iteritems():
+            self.add_collection_metric(name, value)
+
+        # Connection statistics of the emitter since the previous run
+        if hasattr(self.emitter, 'get_statistics'):
+            for name, value in self.emitter.get_statistics().iteritems():
+                self.add_collection_metric(name, value)
+
     def run(self, check_frequency):
         """Collect data from each check and submit their data.
 
@@ -124,6 +145,12 @@ class Collector(util.Dimensions):
             log.warn("Collection time (s) is high: %.1f, metrics count: %d" %
                      (collect_duration, num_metrics))
 
+        if self._emitter_paused():
+            # The statistics are gathered since the previous report once the forwarder accepts data again
+            log.debug("Forwarder is backlogged, skipping the collector metrics")
+            self._set_status(collect_duration)
+            return
+
         self.collector_stats(num_metrics, collect_duration)
         collect_stats = []
         dimensions = {'component': 'monasca-agent', 'service': 'monitoring'}
@@ -153,13 +180,18 @@ class Collector(util.Dimensions):
             # Run the check.
             check.run()
 
-            current_check_metrics = check.get_metrics()
+            if self._emitter_paused():
+                # The aggregator of the check keeps summing counters and updating gauges
+                # until the forwarder accepts data again
+                log.debug("Forwarder is backlogged, skipping flush of plugin %s" % check.name)
+            else:
+                current_check_metrics = check.get_metrics()
 
-            # Emit the metrics after each check
-            self._emit(current_check_metrics)
+                # Emit the metrics after each check
+                self._emit(current_check_metrics)
 
-            # Save the status of the check.
-            count += len(current_check_metrics)
+                # Save the status of the check.
+                count += len(current_check_metrics)
 
         except Exception:
             log.exception("Error running plugin %s" % check.name)
@@ -93,7 +93,8 @@ class CollectorDaemon(monasca_agent.common.daemon.Daemon):
 
         # initialize check orchestrator
         collector_config = agent_config.get_config(['Main', 'Api', 'Logging'])
-        self.collector = checks.collector.Collector(collector_config, monasca_agent.common.emitter.http_emitter, checksd)
+        emitter = monasca_agent.common.emitter.get_emitter(collector_config['forwarder_url'])
+        self.collector = checks.collector.Collector(collector_config, emitter, checksd)
         # start external process for collecting JMX metrics (if needed).
         self.jmx_configured = self.start_jmx(agent_config)
 
@@ -3,10 +3,13 @@
 """
 import json
 import logging
+import math
 import re
+import threading
 from time import time
 
 import monasca_agent.common.metrics as metrics_pkg
+import monasca_agent.common.rules as rules_pkg
 from monasca_agent.common.exceptions import Infinity, UnknownValue
 
 log = logging.getLogger(__name__)
@@ -21,12 +24,114 @@ RECENT_POINT_THRESHOLD_DEFAULT = 3600
 VALUE_META_MAX_NUMBER = 16
 VALUE_META_VALUE_MAX_LENGTH = 2048
 VALUE_META_NAME_MAX_LENGTH = 255
+# Number of validated dimension sets and metric names remembered
+VALIDATION_CACHE_SIZE = 200000
+# Number of validated value_meta remembered
+VALUE_META_CACHE_SIZE = 10000
+# Number of flushes a series may go without samples before it is forgotten
+SERIES_TTL_DEFAULT = 10
+# Shards of a ShardedMetricsAggregator
+SHARDS_DEFAULT = 16
+# Measurements in each JSON list returned by MetricsAggregator.flush_encoded()
+ENCODED_CHUNK_SIZE = 5000
+# Same layout and separators as json.dumps() of the envelopes built by Metric.measurement()
+ENVELOPE_FORMAT = '{"measurement": {"name": %s, "value_meta": %s, "value": %s, "timestamp": %s, %s'
+SERIES_FORMAT = '"dimensions": %s}, "tenant_id": %s}'
+encode_string = json.encoder.encode_basestring_ascii
 
 invalid_chars = "<>={}(),\"\\\\;&"
 restricted_dimension_chars = re.compile('[' + invalid_chars + ']')
 restricted_name_chars = re.compile('[' + invalid_chars + ' ' + ']')
 
 
+class ValidationCache(object):
+    """Bounded set of values which already passed validation, optionally with the
+    result of their validation.
+
+    Least recently used values are evicted using two generations: a value found in
+    the previous generation is moved to the current one, and the previous generation
+    is dropped once the current one holds half of max_size values. A max_size of 0
+    disables the cache.
+
+    The caches are shared by all aggregators of a process, so the hit and miss
+    counters may lose an update when several collector threads submit at once.
+    """
+
+    def __init__(self, max_size):
+        self.generation_size = max_size // 2
+        self._current = {}
+        self._previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, value):
+        """Return the result stored for value, None if value is not in the cache."""
+        result = self._current.get(value)
+        if result is None:
+            result = self._previous.get(value)
+            if result is None:
+                self.misses += 1
+                return None
+            self.add(value, result)
+        self.hits += 1
+        return result
+
+    def __contains__(self, value):
+        return self.get(value) is not None
+
+    def add(self, value, result=True):
+        if self.generation_size < 1:
+            return
+        if len(self._current) >= self.generation_size:
+            self._previous = self._current
+            self._current = {}
+        self._current[value] = result
+
+    def __len__(self):
+        return len(self._current.viewkeys() | self._previous.viewkeys())
+
+    def reset_statistics(self):
+        """Return the hits and misses since the previous call."""
+        hits, misses = self.hits, self.misses
+        self.hits = 0
+        self.misses = 0
+        return hits, misses
+
+
+dimensions_cache = ValidationCache(VALIDATION_CACHE_SIZE)
+names_cache = ValidationCache(VALIDATION_CACHE_SIZE)
+# value_meta contents with the ValueMeta holding their JSON
+value_meta_cache = ValidationCache(VALUE_META_CACHE_SIZE)
+
+
+def _value_meta_key(value_meta):
+    """Return the key of value_meta in value_meta_cache, None if it can't be cached.
+
+    The type of each value is part of the key, as True, 1 and 1.0 are equal but
+    encoded differently. Tuples are not cached, their items could differ the same way.
+    """
+    try:
+        key = frozenset((name, value.__class__, value) for name, value in value_meta.iteritems())
+    except TypeError:
+        # unhashable values are encoded every time
+        return None
+    for name, value_type, value in key:
+        if value_type is tuple:
+            return None
+    return key
+
+
+def get_validation_cache_statistics():
+    """Return the percentage of metric names, dimension sets and value_meta found in the validation caches."""
+    statistics = {}
+    for name, cache in (('dimensions', dimensions_cache), ('names', names_cache),
+                        ('value_meta', value_meta_cache)):
+        hits, misses = cache.reset_statistics()
+        if hits + misses:
+            statistics['monasca.agent.validation_cache.{0}_hit_rate'.format(name)] = 100.0 * hits / (hits + misses)
+    return statistics
+
+
 class InvalidMetricName(Exception):
     pass
 
@@ -48,9 +153,20 @@ class InvalidValueMeta(Exception):
 
 
 class MetricsAggregator(object):
-    """A metric aggregator class."""
+    """A metric aggregator class.
+
+    A series that has not been sampled for series_ttl flushes is forgotten, so
+    short-lived processes, containers or statsd tags don't stay in memory for the
+    life of the process. A series_ttl of 0 keeps every series. No more than
+    max_series series are held, samples of new series beyond that are discarded.
+    A negative max_series does not limit the number of series.
 
-    def __init__(self, hostname, recent_point_threshold=None, tenant_id=None):
+    rules is a list of pre-aggregation rules, see monasca_agent.common.rules,
+    applied to the measurements of each flush.
+    """
+
+    def __init__(self, hostname, recent_point_threshold=None, tenant_id=None,
+                 series_ttl=SERIES_TTL_DEFAULT, max_series=-1, rules=None):
         self.total_count = 0
         self.count = 0
         self.hostname = hostname
@@ -60,17 +176,45 @@ class MetricsAggregator(object):
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
 
+        self.series_ttl = int(series_ttl)
+        self.max_series = int(max_series)
+        self.flushes = 0
+        self.num_capped_points = 0
+        # Counts since the previous get_statistics() call
+        self.evicted_series = 0
+        self.capped_points = 0
+
+        self.rules = None
+        if rules:
+            try:
+                self.rules = rules_pkg.RuleEngine(rules)
+            except (rules_pkg.InvalidRule, TypeError) as e:
+                log.error("Ignoring the aggregation rules: {0}".format(e))
+
         self.metrics = {}
 
-    def flush(self):
+    def _flush_values(self):
+        """Return the series with measurements due, each with the name, value and timestamp of its measurements."""
         # Flush samples.  The individual metrics reset their internal samples
         # when required
-        metrics = []
+        flushed = []
+        evicted = 0
         for context, metric in self.metrics.items():
             try:
-                metrics.extend(metric.flush())
+                values = metric.flush_values()
+                if values:
+                    flushed.append((metric, values))
             except Exception:
-                log.exception('Error flushing {0} {1} metrics.'.format(metric.metric['name'], metric.metric['dimensions']))
+                log.exception('Error flushing {0} {1} metrics.'.format(metric.name, dict(metric.dimensions)))
+            if self.series_ttl > 0 and self.flushes - metric.last_sampled >= self.series_ttl:
+                del self.metrics[context]
+                evicted += 1
+        self.flushes += 1
+
+        if evicted:
+            log.debug('{0} series were not sampled for {1} flushes and have been removed'.format(
+                      evicted, self.series_ttl))
+            self.evicted_series += evicted
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
@@ -78,12 +222,52 @@ class MetricsAggregator(object):
                      self.num_discarded_old_points))
             self.num_discarded_old_points = 0
 
+        if self.num_capped_points > 0:
+            log.warn('{0} points of new series were discarded as {1} series are held already'.format(
+                     self.num_capped_points, self.max_series))
+            self.num_capped_points = 0
+
         # Save some stats.
         log.debug("received {0} payloads since last flush".format(self.count))
         self.total_count += self.count
         self.count = 0
+
+        if self.rules:
+            flushed = self.rules.apply(flushed)
+        return flushed
+
+    def flush(self):
+        metrics = []
+        for metric, values in self._flush_values():
+            for name, value, timestamp in values:
+                metrics.append(metric.measurement(value, timestamp, name))
         return metrics
 
+    def flush_encoded(self, chunk_size=ENCODED_CHUNK_SIZE):
+        """Flush the samples and return an iterator over the measurements as JSON encoded lists.
+
+        The lists hold up to chunk_size measurement envelopes and are encoded directly
+        from the series, without building a dict for each measurement as flush() does.
+        Each item is a tuple of the number of measurements and the JSON list.
+        """
+        return _encode_chunks(self._flush_values(), chunk_size)
+
+    def get_statistics(self):
+        """Return the number of series held, and the series evicted, points of new series
+        discarded and points saved by the aggregation rules since the previous call.
+        """
+        statistics = {'monasca.agent.aggregator.series': len(self.metrics),
+                      'monasca.agent.aggregator.evicted_series': self.evicted_series,
+                      'monasca.agent.aggregator.capped_points': self.capped_points}
+        self.evicted_series = 0
+        self.capped_points = 0
+        if self.rules:
+            statistics['monasca.agent.aggregator.rule_reduced_points'] = (self.rules.points_in -
+                                                                          self.rules.points_out)
+            self.rules.points_in = 0
+            self.rules.points_out = 0
+        return statistics
+
     def get_hostname_to_post(self, hostname):
         if 'SUPPRESS' == hostname:
             return None
@@ -94,59 +278,62 @@ class MetricsAggregator(object):
             return 0
         return round(float(self.count) / interval, 2)
 
-    def _valid_value_meta(self, value_meta, name, dimensions):
+    @staticmethod
+    def _encode_value_meta(value_meta, name, dimensions):
+        """Return the value_meta as a ValueMeta holding its JSON, None if it is invalid."""
         if len(value_meta) > VALUE_META_MAX_NUMBER:
             msg = "Too many valueMeta entries {0}, limit is {1}: {2} -> {3} valueMeta {4}"
             log.error(msg.format(len(value_meta), VALUE_META_MAX_NUMBER, name, dimensions, value_meta))
-            return False
+            return None
         for key, value in value_meta.iteritems():
             if not key:
                 log.error("valueMeta name cannot be empty: {0} -> {1}".format(name, dimensions))
-                return False
+                return None
             if len(key) > VALUE_META_NAME_MAX_LENGTH:
                 msg = "valueMeta name {0} must be {1} characters or less: {2} -> {3}"
                 log.error(msg.format(key, VALUE_META_NAME_MAX_LENGTH, name, dimensions))
-                return False
+                return None
 
         try:
-            if get_value_meta_overage(value_meta):
-                msg = "valueMeta name value combinations must be {0} characters or less: {1} -> {2} valueMeta {3}"
-                log.error(msg.format(VALUE_META_VALUE_MAX_LENGTH, name, dimensions, value_meta))
-                return False
+            encoded = json.dumps(value_meta)
         except Exception:
                 log.exception("Unable to serialize valueMeta into JSON: %s -> %s", name, dimensions)
-                return False
-
-        return True
-
-    def submit_metric(self, name, value, metric_class, dimensions=None,
-                      delegated_tenant=None, hostname=None, device_name=None,
-                      value_meta=None, timestamp=None, sample_rate=1):
-        if dimensions:
-            for k, v in dimensions.iteritems():
-                if not isinstance(k, (str, unicode)):
-                    log.error("invalid dimension key {0} must be a string: {1} -> {2}".format(k, name, dimensions))
-                    raise InvalidDimensionKey
-                if len(k) > 255 or len(k) < 1:
-                    log.error("invalid length for dimension key {0}: {1} -> {2}".format(k, name, dimensions))
-                    raise InvalidDimensionKey
-                if restricted_dimension_chars.search(k) or re.match('^_', k):
-                    log.error("invalid characters in dimension key {0}: {1} -> {2}".format(k, name, dimensions))
-                    raise InvalidDimensionKey
-
-                if not isinstance(v, (str, unicode)):
-                    log.error("invalid dimension value {0} for key {1} must be a string: {2} -> {3}".format(v, k, name,
-                                                                                                            dimensions))
-                    raise InvalidDimensionValue
-                if len(v) > 255 or len(v) < 1:
-                    log.error("invalid length dimension value {0} for key {1}: {2} -> {3}".format(v, k, name,
-                                                                                                  dimensions))
-                    raise InvalidDimensionValue
-                if restricted_dimension_chars.search(v):
-                    log.error("invalid characters in dimension value {0} for key {1}: {2} -> {3}".format(v, k, name,
-                                                                                                         dimensions))
-                    raise InvalidDimensionValue
+                return None
+        if len(encoded) > VALUE_META_VALUE_MAX_LENGTH:
+            msg = "valueMeta name value combinations must be {0} characters or less: {1} -> {2} valueMeta {3}"
+            log.error(msg.format(VALUE_META_VALUE_MAX_LENGTH, name, dimensions, value_meta))
+            return None
 
+        return metrics_pkg.ValueMeta(value_meta, encoded)
+
+    @staticmethod
+    def _validate_dimensions(name, dimensions):
+        for k, v in dimensions.iteritems():
+            if not isinstance(k, (str, unicode)):
+                log.error("invalid dimension key {0} must be a string: {1} -> {2}".format(k, name, dimensions))
+                raise InvalidDimensionKey
+            if len(k) > 255 or len(k) < 1:
+                log.error("invalid length for dimension key {0}: {1} -> {2}".format(k, name, dimensions))
+                raise InvalidDimensionKey
+            if restricted_dimension_chars.search(k) or re.match('^_', k):
+                log.error("invalid characters in dimension key {0}: {1} -> {2}".format(k, name, dimensions))
+                raise InvalidDimensionKey
+
+            if not isinstance(v, (str, unicode)):
+                log.error("invalid dimension value {0} for key {1} must be a string: {2} -> {3}".format(v, k, name,
+                                                                                                        dimensions))
+                raise InvalidDimensionValue
+            if len(v) > 255 or len(v) < 1:
+                log.error("invalid length dimension value {0} for key {1}: {2} -> {3}".format(v, k, name,
+                                                                                              dimensions))
+                raise InvalidDimensionValue
+            if restricted_dimension_chars.search(v):
+                log.error("invalid characters in dimension value {0} for key {1}: {2} -> {3}".format(v, k, name,
+                                                                                                     dimensions))
+                raise InvalidDimensionValue
+
+    @staticmethod
+    def _validate_name(name, dimensions):
         if not isinstance(name, (str, unicode)):
             log.error("invalid metric name must be a string: {0} -> {1}".format(name, dimensions))
             raise InvalidMetricName
@@ -157,38 +344,64 @@ class MetricsAggregator(object):
             log.error("invalid characters in metric name: {0} -> {1}".format(name, dimensions))
             raise InvalidMetricName
 
-        if not isinstance(value, (int, long, float)):
+    def submit_metric(self, name, value, metric_class, dimensions=None,
+                      delegated_tenant=None, hostname=None, device_name=None,
+                      value_meta=None, timestamp=None, sample_rate=1):
+        if dimensions:
+            try:
+                dimensions_key = frozenset(dimensions.iteritems())
+            except TypeError:
+                # unhashable values are never valid
+                dimensions_key = None
+            if dimensions_key is None or dimensions_key not in dimensions_cache:
+                self._validate_dimensions(name, dimensions)
+                if dimensions_key is not None:
+                    dimensions_cache.add(dimensions_key)
+
+        if not isinstance(name, (str, unicode)) or name not in names_cache:
+            self._validate_name(name, dimensions)
+            names_cache.add(name)
+
+        # the members of a set are counted, not added up
+        if not isinstance(value, (int, long, float)) and not issubclass(metric_class, metrics_pkg.Set):
             log.error("invalid value {0} is not of number type for metric {1}".format(value, name))
             raise InvalidValue
 
         if value_meta:
-            if not self._valid_value_meta(value_meta, name, dimensions):
-                log.error("invalid value_meta {0} for metric {1}".format(value, name))
-                raise InvalidValueMeta
+            # identical value_meta are validated and encoded once and then shared
+            cache_key = _value_meta_key(value_meta)
+            cached = value_meta_cache.get(cache_key) if cache_key is not None else None
+            if cached is None:
+                cached = self._encode_value_meta(value_meta, name, dimensions)
+                if cached is None:
+                    log.error("invalid value_meta {0} for metric {1}".format(value, name))
+                    raise InvalidValueMeta
+                if cache_key is not None:
+                    value_meta_cache.add(cache_key, cached)
+            value_meta = cached
 
         hostname_to_post = self.get_hostname_to_post(hostname)
 
         tenant_to_post = delegated_tenant or self.global_delegated_tenant
 
-        dimensions_copy = dimensions.copy()
-
-        if 'hostname' not in dimensions_copy and hostname_to_post:
-            dimensions_copy.update({'hostname': hostname_to_post})
+        add_hostname = 'hostname' not in dimensions and hostname_to_post
+        if add_hostname or device_name:
+            dimensions = dimensions.copy()
+            if add_hostname:
+                dimensions['hostname'] = hostname_to_post
 
-        # TODO(joe): Shouldn't device_name be added to dimensions in the check
-        #            plugin?  Why is it special cased through so many layers?
-        if device_name:
-            dimensions_copy.update({'device': device_name})
+            # TODO(joe): Shouldn't device_name be added to dimensions in the check
+            #            plugin?  Why is it special cased through so many layers?
+            if device_name:
+                dimensions['device'] = device_name
 
+        # The dimensions tuple of the context is shared with the metric
+        series_dimensions = metrics_pkg.dimensions_key(dimensions)
         # TODO(joe): Decide if hostname_to_post and device_name are necessary
         #            for the context tuple
-        context = (name, tuple(dimensions_copy.items()), tenant_to_post,
+        context = (name, series_dimensions, tenant_to_post,
                    hostname_to_post, device_name)
 
-        if context not in self.metrics:
-            self.metrics[context] = metric_class(name,
-                                                 dimensions_copy,
-                                                 tenant=tenant_to_post)
         cur_time = time()
         if timestamp is not None:
             if cur_time - int(timestamp) > self.recent_point_threshold:
@@ -197,12 +410,197 @@ class MetricsAggregator(object):
                 return
         else:
             timestamp = cur_time
-        self.metrics[context].value_meta = value_meta
-        self.metrics[context].sample(value, sample_rate, timestamp)
+        self._sample(context, metric_class, name, series_dimensions, tenant_to_post,
+                     value, sample_rate, timestamp, value_meta)
+
+    def _series_capped(self, name, dimensions, series=None):
+        """Return True, and count the discarded point, when no new series can be held."""
+        if series is None:
+            series = len(self.metrics)
+        if 0 <= self.max_series <= series:
+            log.debug("Discarding {0} {1} - {2} series are held already".format(name, dict(dimensions),
+                                                                                 self.max_series))
+            self.num_capped_points += 1
+            self.capped_points += 1
+            return True
+        return False
+
+    def _sample(self, context, metric_class, name, dimensions, tenant, value, sample_rate, timestamp, value_meta):
+        metric = self.metrics.get(context)
+        if metric is None:
+            if self._series_capped(name, dimensions):
+                return
+            metric = self.metrics[context] = metric_class(name,
+                                                          dimensions,
+                                                          tenant=tenant)
+        metric.value_meta = value_meta
+        metric.last_sampled = self.flushes
+        metric.sample(value, sample_rate, timestamp)
         self.count += 1
 
 
+class _Shard(object):
+    """Series sampled since the last flush by the producers hashed to this shard."""
+
+    __slots__ = ('lock', 'samples', 'count', 'new_series')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.count = 0
+        # Samples of series the aggregator does not hold yet, counted against max_series
+        self.new_series = 0
+
+
+class ShardedMetricsAggregator(MetricsAggregator):
+    """A metric aggregator which can be used by many threads at once.
+
+    Samples are aggregated in per-interval buffers, spread over shards by series
+    so concurrent producers seldom wait for the same lock, which is only held to
+    sample one value. A flush swaps the buffer of each shard for an empty one and
+    merges the swapped buffers into the series afterwards, so producers never
+    wait for a flush, and every sample lands in exactly one buffer. Expired
+    series are removed at flush time. The series the buffers hold which are not
+    held by the aggregator yet are counted across the shards, so max_series also
+    bounds the buffers between flushes.
+    """
+
+    def __init__(self, hostname, recent_point_threshold=None, tenant_id=None,
+                 series_ttl=SERIES_TTL_DEFAULT, max_series=-1, rules=None, shards=SHARDS_DEFAULT):
+        super(ShardedMetricsAggregator, self).__init__(hostname, recent_point_threshold, tenant_id,
+                                                       series_ttl, max_series, rules)
+        self._shards = [_Shard() for _ in range(shards)]
+        self._flush_lock = threading.Lock()
+        # Number of series in the shard buffers which the aggregator does not hold yet
+        self._new_series = 0
+        self._series_lock = threading.Lock()
+
+    def _add_series(self, shard, context, name, dimensions):
+        """Return True if a series can be added to the buffer of the shard, whose lock is held."""
+        if self.max_series < 0 or context in self.metrics:
+            return True
+        with self._series_lock:
+            # the series may have been merged meanwhile
+            if context in self.metrics:
+                return True
+            if self._series_capped(name, dimensions, len(self.metrics) + self._new_series):
+                return False
+            self._new_series += 1
+        shard.new_series += 1
+        return True
+
+    def _sample(self, context, metric_class, name, dimensions, tenant, value, sample_rate, timestamp, value_meta):
+        shard = self._shards[hash(context) % len(self._shards)]
+        with shard.lock:
+            metric = shard.samples.get(context)
+            if metric is None:
+                if not self._add_series(shard, context, name, dimensions):
+                    return
+                metric = shard.samples[context] = metric_class(name, dimensions, tenant=tenant)
+            metric.value_meta = value_meta
+            metric.sample(value, sample_rate, timestamp)
+            shard.count += 1
+
+    def take_samples(self):
+        """Return the metrics sampled since the previous flush by context, and the number of samples.
+
+        The samples are removed from the aggregator, which is how statsd workers hand their
+        samples to the aggregator of the reporter with add_samples().
+        """
+        taken = {}
+        count = 0
+        for shard in self._shards:
+            with shard.lock:
+                samples, shard.samples = shard.samples, {}
+                count += shard.count
+                shard.count = 0
+                new_series, shard.new_series = shard.new_series, 0
+            with self._series_lock:
+                self._new_series -= new_series
+            taken.update(samples)
+        return taken, count
+
+    def add_samples(self, samples, count):
+        """Add metrics sampled by another aggregator, as returned by its take_samples(), to the next flush."""
+        shards = self._shards
+        for context, sampled in samples.iteritems():
+            shard = shards[hash(context) % len(shards)]
+            with shard.lock:
+                metric = shard.samples.get(context)
+                if metric is None:
+                    if self._add_series(shard, context, sampled.name, sampled.dimensions):
+                        shard.samples[context] = sampled
+                else:
+                    metric.merge(sampled)
+        with shards[0].lock:
+            shards[0].count += count
+
+    def _merge_samples(self):
+        for shard in self._shards:
+            with shard.lock:
+                samples, shard.samples = shard.samples, {}
+                count, shard.count = shard.count, 0
+                new_series, shard.new_series = shard.new_series, 0
+            self.count += count
+            # The new series are held by the aggregator once they are merged
+            with self._series_lock:
+                for context, sampled in samples.iteritems():
+                    metric = self.metrics.get(context)
+                    if metric is None:
+                        metric = self.metrics[context] = sampled
+                    else:
+                        metric.merge(sampled)
+                    metric.last_sampled = self.flushes
+                self._new_series -= new_series
+
+    def _flush_values(self):
+        with self._flush_lock:
+            self._merge_samples()
+            return super(ShardedMetricsAggregator, self)._flush_values()
+
+
+def _encode_number(value):
+    value_type = type(value)
+    if value_type is float and not (math.isinf(value) or math.isnan(value)):
+        return repr(value)
+    if value_type is int or value_type is long:
+        return str(value)
+    return json.dumps(value)
+
+
+def _encode_chunks(flushed, chunk_size):
+    envelopes = []
+    for metric, values in flushed:
+        series = metric.encoded_series
+        if series is None:
+            # The series is encoded once and reused by the following flushes
+            tenant = encode_string(metric.tenant) if metric.tenant is not None else 'null'
+            series = metric.encoded_series = SERIES_FORMAT % (json.dumps(dict(metric.dimensions)), tenant)
+        value_meta = metric.value_meta
+        if not value_meta:
+            value_meta = 'null'
+        elif isinstance(value_meta, metrics_pkg.ValueMeta):
+            value_meta = value_meta.encoded
+        else:
+            value_meta = json.dumps(value_meta)
+        for name, value, timestamp in values:
+            timestamp *= 1000
+            # x - x is only 0 for finite floats, which are encoded as json.dumps() does
+            envelopes.append(ENVELOPE_FORMAT % (
+                encode_string(name), value_meta,
+                repr(value) if type(value) is float and value - value == 0 else _encode_number(value),
+                repr(timestamp) if type(timestamp) is float and timestamp - timestamp == 0 else
+                _encode_number(timestamp),
+                series))
+            if len(envelopes) >= chunk_size:
+                yield len(envelopes), '[' + ', '.join(envelopes) + ']'
+                envelopes = []
+    if envelopes:
+        yield len(envelopes), '[' + ', '.join(envelopes) + ']'
+
+
 def get_value_meta_overage(value_meta):
-    if len(json.dumps(value_meta)) > VALUE_META_VALUE_MAX_LENGTH:
-        return len(json.dumps(value_meta)) - VALUE_META_VALUE_MAX_LENGTH
+    length = len(json.dumps(value_meta))
+    if length > VALUE_META_VALUE_MAX_LENGTH:
+        return length - VALUE_META_VALUE_MAX_LENGTH
     return 0
@@ -46,6 +46,7 @@ class Config(object):
                                  'hostname': None,
                                  'dimensions': None,
                                  'listen_port': None,
+                                 'listen_socket': None,
                                  'version': self.get_version(),
                                  'additional_checksd': '/usr/lib/monasca/agent/custom_checks.d',
                                  'limit_memory_consumption': None,
@@ -53,6 +54,9 @@ class Config(object):
                                  'autorestart': True,
                                  'non_local_traffic': False,
                                  'sub_collection_warn': 6,
+                                 'series_ttl': 10,
+                                 'max_series': -1,
+                                 'aggregation_rules': [],
                                  'collector_restart_interval': 24},
                         'Api': {'is_enabled': False,
                                 'url': '',
@@ -70,12 +74,34 @@ class Config(object):
                                 'max_buffer_size': 1000,
                                 'max_measurement_buffer_size': -1,
                                 'write_timeout': 10,
-                                'backlog_send_rate': 5},
+                                'backlog_send_rate': 5,
+                                'max_backlog_send_rate': 100,
+                                'backlog_max_latency': 1000,
+                                'backlog_merge_size': 512 * 1024,
+                                'backlog_spool_dir': None,
+                                'backlog_spool_segment_size': 1024 * 1024,
+                                'backlog_spool_max_size': -1,
+                                'post_threads': 4,
+                                'max_inflight_requests': 2,
+                                'max_batch_measurements': 5000,
+                                'max_batch_bytes': 512 * 1024,
+                                'max_batch_linger': 3000,
+                                'compression': None,
+                                'compression_level': 6,
+                                'compression_min_size': 1024,
+                                'backlog_high_water_mark': 0.9,
+                                'backlog_retry_after': 10},
                         'Statsd': {'recent_point_threshold': None,
                                    'monasca_statsd_interval': 20,
+                                   'monasca_statsd_percentiles': [0.5, 0.95, 0.99],
                                    'monasca_statsd_forward_host': None,
                                    'monasca_statsd_forward_port': 8125,
-                                   'monasca_statsd_port': 8125},
+                                   'monasca_statsd_port': 8125,
+                                   'monasca_statsd_receive_buffer': 0,
+                                   'monasca_statsd_tcp_port': None,
+                                   'monasca_statsd_unix_socket': None,
+                                   'monasca_statsd_unix_socket_type': 'dgram',
+                                   'monasca_statsd_workers': 1},
                         'Logging': {'disable_file_logging': False,
                                     'log_level': None,
                                     'collector_log_file': DEFAULT_LOG_DIR + '/collector.log',
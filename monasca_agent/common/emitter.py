@@ -1,8 +1,26 @@
 # (C) Copyright 2015-2016 Hewlett Packard Enterprise Development LP
 
 from hashlib import md5
+import httplib
 import json
-import urllib2
+import socket
+import threading
+import time
+import urlparse
+
+import monasca_agent.common.intake as intake
+
+DEFAULT_TIMEOUT = 10  # seconds, for connecting and for each request
+DEFAULT_RETRIES = 1
+DEFAULT_MAX_IDLE = 2  # connections
+DEFAULT_MAX_HELD_MEASUREMENTS = 100000
+DEFAULT_RETRY_AFTER = 10  # seconds, when the forwarder refuses data without saying how long to wait
+
+BACKPRESSURE_STATUSES = (intake.STATUS_TOO_MANY_REQUESTS, intake.STATUS_SERVICE_UNAVAILABLE)
+
+# Emitters shared by everything sending to the same forwarder url
+_emitters = {}
+_emitters_lock = threading.Lock()
 
 
 def post_headers(payload):
@@ -14,40 +32,252 @@ def post_headers(payload):
     }
 
 
-def http_emitter(message, log, url):
-    """Send payload
+class _HTTPConnection(object):
+    """Keep-alive connection to the forwarder's /intake endpoint."""
+
+    def __init__(self, url, timeout):
+        parsed = urlparse.urlparse(url)
+        self.path = parsed.path.rstrip('/') + '/intake'
+        self.connection = httplib.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+        # Reconnecting is left to the Emitter so new connections are counted
+        self.connection.auto_open = 0
+
+    def connect(self):
+        self.connection.connect()
+
+    def send(self, message):
+        payload = message if isinstance(message, str) else json.dumps(message)
+        self.connection.request('POST', self.path, payload, post_headers(payload))
+        response = self.connection.getresponse()
+        # The response has to be read completely before the connection can be reused
+        response.read()
+        try:
+            retry_after = int(response.getheader('Retry-After', 0))
+        except ValueError:
+            retry_after = 0
+        return response.status, retry_after
+
+    def close(self):
+        self.connection.close()
+
+
+class _UnixConnection(object):
+    """Connection to the forwarder's Unix domain socket."""
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+
+    def connect(self):
+        self.sock.connect(self.path)
+
+    def send(self, message):
+        if isinstance(message, str):
+            self.sock.sendall(intake.encode_json(message))
+        else:
+            self.sock.sendall(intake.encode(message))
+        return intake.decode_status(recv_exactly(self.sock, intake.STATUS.size))
+
+    def close(self):
+        self.sock.close()
+
+
+def recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error("Connection closed by the forwarder")
+        data += chunk
+    return data
+
+
+class Emitter(object):
+    """Sends measurements to the forwarder over a pool of kept-alive connections.
+
+    url is either the forwarder's http url or unix:// followed by the path of its
+    socket. A request failing on a connection the forwarder closed or reset is
+    retried on a new connection up to retries times, timeouts are not retried.
+
+    When the forwarder refuses data because its backlog is full, nothing is sent
+    until the time it asked for has passed. Meanwhile the measurements are held,
+    up to max_held_measurements, and sent once the forwarder accepts data again.
+    They are held unchanged, as the type of a measurement is not known here: the
+    collector and statsd stop flushing their aggregators while the emitter is
+    paused, which keep the latest value of gauges and sum counters meanwhile.
     """
 
-    log.debug('http_emitter: attempting postback to ' + url)
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, max_idle=DEFAULT_MAX_IDLE,
+                 max_held_measurements=DEFAULT_MAX_HELD_MEASUREMENTS):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.max_idle = max_idle
+        self.max_held_measurements = max_held_measurements
+        self._held = []
+        self._resume_time = 0
+        self._refused = 0
+        self._dropped = 0
+        self._socket_path = intake.socket_path(url)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._connect_times = []
+        self._send_times = []
+        self._errors = 0
 
-    # Post back the data
-    partial_payload = []
-    for measurement in message:
-        partial_payload.append(measurement)
+    def _new_connection(self):
+        if self._socket_path:
+            connection = _UnixConnection(self._socket_path, self.timeout)
+        else:
+            connection = _HTTPConnection(self.url, self.timeout)
+        start = time.time()
+        try:
+            connection.connect()
+        except Exception:
+            connection.close()
+            raise
+        with self._lock:
+            self._connect_times.append((time.time() - start) * 1000)
+        return connection
+
+    def _get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._new_connection()
+
+    def _release_connection(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _send(self, message):
+        attempt = 0
+        while True:
+            connection = self._get_connection()
+            start = time.time()
+            try:
+                response = connection.send(message)
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                # The other idle connections were most likely closed by the forwarder as well
+                self.close()
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                continue
+            with self._lock:
+                self._send_times.append((time.time() - start) * 1000)
+            self._release_connection(connection)
+            return response
+
+    def paused(self):
+        """Return True while the forwarder asked for no data to be sent."""
+        return time.time() < self._resume_time
 
-    payload = json.dumps(partial_payload)
-    url = "%s/intake" % url
-    headers = post_headers(payload)
+    def _hold(self, message):
+        with self._lock:
+            room = max(self.max_held_measurements - len(self._held), 0)
+            self._held.extend(message[:room])
+            self._dropped += max(len(message) - room, 0)
 
-    try:
-        # Make sure no proxy is autodetected for this localhost connection
-        proxy_handler = urllib2.ProxyHandler({})
-        # Should this be installed as the default opener and reused?
-        opener = urllib2.build_opener(proxy_handler)
-        request = urllib2.Request(url, payload, headers)
-        response = None
+    def _take_held(self):
+        with self._lock:
+            held, self._held = self._held, []
+        return held
+
+    def send(self, message, log):
+        """Send payload
+
+        message is a list of measurement envelopes, or such a list already encoded as JSON.
+        """
+        if self._held or self.paused():
+            if isinstance(message, str):
+                message = json.loads(message)
+            if self.paused():
+                self._hold(message)
+                log.debug('emitter: holding measurements while the forwarder is backlogged')
+                return
+            message = self._take_held() + message
+
+        log.debug('emitter: attempting postback to ' + self.url)
         try:
-            response = opener.open(request)
-            log.debug('http_emitter: postback response: ' + str(response.read()))
+            status, retry_after = self._send(message)
         except Exception as exc:
+            with self._lock:
+                self._errors += 1
             log.error("""Forwarder at {0} is down or not responding...
                       Error is {1}
-                      Please restart the monasca-agent.""".format(url, repr(exc)))
-        finally:
-            if response:
-                response.close()
-    except urllib2.HTTPError as e:
-        if e.code == 202:
-            log.debug("http payload accepted")
+                      Please restart the monasca-agent.""".format(self.url, repr(exc)))
+            return
+
+        if status in BACKPRESSURE_STATUSES:
+            retry_after = retry_after or DEFAULT_RETRY_AFTER
+            self._resume_time = time.time() + retry_after
+            self._hold(json.loads(message) if isinstance(message, str) else message)
+            with self._lock:
+                self._refused += 1
+            log.warn("Forwarder at {0} is backlogged, holding {1} measurements "
+                     "for {2} seconds".format(self.url, len(self._held), retry_after))
+        elif status // 100 != 2:
+            with self._lock:
+                self._errors += 1
+            log.error("Forwarder at {0} refused the measurements with status {1}".format(self.url, status))
         else:
-            raise
+            log.debug("emitter: payload accepted with status {0}".format(status))
+
+    def __call__(self, message, log, url=None):
+        self.send(message, log)
+
+    def get_statistics(self):
+        """Return the connection statistics gathered since the previous call."""
+        with self._lock:
+            connect_times, self._connect_times = self._connect_times, []
+            send_times, self._send_times = self._send_times, []
+            statistics = {'monasca.agent.emitter.errors': self._errors,
+                          'monasca.agent.emitter.refused': self._refused,
+                          'monasca.agent.emitter.dropped_measurements': self._dropped,
+                          'monasca.agent.emitter.held_measurements': len(self._held)}
+            self._errors = 0
+            self._refused = 0
+            self._dropped = 0
+        statistics['monasca.agent.emitter.connections'] = len(connect_times)
+        if connect_times:
+            statistics['monasca.agent.emitter.connect_time_ms'] = sum(connect_times) / len(connect_times)
+        if send_times:
+            statistics['monasca.agent.emitter.send_time_ms'] = sum(send_times) / len(send_times)
+            statistics['monasca.agent.emitter.send_time_max_ms'] = max(send_times)
+        return statistics
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+def get_emitter(url):
+    """Return the emitter shared by everything sending to the forwarder at url."""
+    with _emitters_lock:
+        emitter = _emitters.get(url)
+        if emitter is None:
+            emitter = _emitters[url] = Emitter(url)
+        return emitter
+
+
+def emit(message, log, url):
+    """Send the measurements to the forwarder at url
+    """
+    get_emitter(url).send(message, log)
+
+
+def http_emitter(message, log, url):
+    """Send payload
+    """
+    emit(message, log, url)
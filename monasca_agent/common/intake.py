@@ -0,0 +1,88 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+""" Framing of measurements sent to the forwarder over its Unix domain socket.
+
+A request frame is a header holding the payload length and encoding followed
+by the payload, a list of measurement envelopes. Payloads are encoded with
+msgpack when it is installed and with JSON otherwise. The forwarder answers
+every frame with a status frame holding an HTTP status code, so it can refuse
+data the same way the /intake endpoint does. The status frame also holds the
+number of seconds to wait before sending again when data was refused.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+UNIX_SCHEME = 'unix://'
+
+ENCODING_JSON = 0
+ENCODING_MSGPACK = 1
+
+HEADER = struct.Struct('!IB')
+STATUS = struct.Struct('!HH')
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # bytes
+
+STATUS_ACCEPTED = 202
+STATUS_BAD_REQUEST = 400
+STATUS_TOO_MANY_REQUESTS = 429
+STATUS_ERROR = 500
+STATUS_SERVICE_UNAVAILABLE = 503
+
+
+class FrameError(Exception):
+    pass
+
+
+def socket_path(url):
+    """Return the socket path of a unix:// url, or None for other urls."""
+    if url and url.startswith(UNIX_SCHEME):
+        return url[len(UNIX_SCHEME):]
+    return None
+
+
+def encode(envelopes):
+    """Return a request frame holding the list of measurement envelopes."""
+    if msgpack:
+        payload = msgpack.packb(envelopes, use_bin_type=True)
+        encoding = ENCODING_MSGPACK
+    else:
+        payload = json.dumps(envelopes)
+        encoding = ENCODING_JSON
+    return HEADER.pack(len(payload), encoding) + payload
+
+
+def encode_json(payload):
+    """Return a request frame holding a list of measurement envelopes already encoded as JSON."""
+    return HEADER.pack(len(payload), ENCODING_JSON) + payload
+
+
+def decode_header(header):
+    """Return the payload length and encoding from a request frame header."""
+    length, encoding = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FrameError("Frame of {0} bytes exceeds the maximum of {1} bytes".format(length, MAX_FRAME_SIZE))
+    if encoding == ENCODING_MSGPACK and not msgpack:
+        raise FrameError("Received a msgpack frame but msgpack is not installed")
+    if encoding not in (ENCODING_JSON, ENCODING_MSGPACK):
+        raise FrameError("Unknown frame encoding {0}".format(encoding))
+    return length, encoding
+
+
+def decode_payload(payload, encoding):
+    """Return the list of measurement envelopes in a request frame payload."""
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+
+def encode_status(status, retry_after=0):
+    return STATUS.pack(status, retry_after)
+
+
+def decode_status(data):
+    """Return the status code and the seconds to wait before retrying from a status frame."""
+    return STATUS.unpack(data)
@@ -3,28 +3,99 @@
 """
 import logging
 
+from monasca_agent.common.sketch import HyperLogLog
+from monasca_agent.common.sketch import Sketch
+
 log = logging.getLogger(__name__)
 
+PERCENTILES_DEFAULT = (0.5, 0.95, 0.99)
+# Distinct values a Set counts exactly before it switches to a HyperLogLog
+SET_EXACT_MAX_DEFAULT = 1000
+
+
+def dimensions_key(dimensions):
+    """Return the dimensions dict as a sorted tuple of items which identifies the series."""
+    try:
+        return tuple(sorted(dimensions.iteritems()))
+    except UnicodeDecodeError:
+        # encoded str and unicode keys with non ascii characters can't be compared
+        return tuple(sorted(dimensions.iteritems(), key=lambda item: repr(item[0])))
+
+
+# Subclasses of the metric classes with other class settings, such as Histogram
+# percentiles, by base class and settings, and the other way round
+_subclasses = {}
+_subclass_keys = {}
+
+
+def _subclass(base, **settings):
+    key = (base, tuple(sorted(settings.iteritems())))
+    cls = _subclasses.get(key)
+    if cls is None:
+        cls = _subclasses[key] = type(base.__name__, (base,), dict(settings, __slots__=()))
+        _subclass_keys[cls] = key
+    return cls
+
+
+def _new_metric(base, settings):
+    """Create an empty metric of a pickled class, see Metric.__reduce_ex__()."""
+    cls = _subclass(base, **dict(settings)) if settings else base
+    return cls.__new__(cls)
+
+
+class ValueMeta(dict):
+    """value_meta validated by the aggregator, with its JSON encoding.
+
+    One instance is shared by every sample with the same value_meta, so it must
+    not be modified.
+    """
+
+    __slots__ = ('encoded',)
+
+    def __init__(self, value_meta, encoded):
+        super(ValueMeta, self).__init__(value_meta)
+        self.encoded = encoded
+
 
 class Metric(object):
-    """A base metric class """
+    """A base metric class
+
+    The aggregator holds one instance per series, so instances have no __dict__
+    and store their dimensions as the immutable tuple from dimensions_key(),
+    which the aggregator also uses in its context keys. last_sampled is the
+    number of flushes the aggregator had done when the series was last sampled.
+    encoded_series holds the JSON of the dimensions and tenant once the series
+    has been flushed by MetricsAggregator.flush_encoded().
+    """
+
+    __slots__ = ('name', 'dimensions', 'tenant', 'value_meta', 'value', 'timestamp', 'last_sampled',
+                 'encoded_series')
 
     def __init__(self, name, dimensions, tenant):
-        self.metric = {'name': name,
-                       'dimensions': dimensions.copy()}
+        self.name = name
+        if isinstance(dimensions, tuple):
+            self.dimensions = dimensions
+        else:
+            self.dimensions = dimensions_key(dimensions)
 
         self.value_meta = None
         self.value = None
         self.timestamp = None
         self.tenant = tenant
+        self.last_sampled = 0
+        self.encoded_series = None
 
-    def measurement(self, value, timestamp):
-        measurement = self.metric.copy()
+    @property
+    def metric(self):
+        return {'name': self.name,
+                'dimensions': dict(self.dimensions)}
 
-        if self.value_meta:
-            measurement['value_meta'] = self.value_meta.copy()
-        else:
-            measurement['value_meta'] = None
+    def measurement(self, value, timestamp, name=None):
+        measurement = {'name': name or self.name,
+                       'dimensions': dict(self.dimensions)}
+
+        # value_meta is not modified once submitted, so it is shared by the measurements
+        measurement['value_meta'] = self.value_meta or None
 
         measurement['value'] = value
         measurement['timestamp'] = timestamp * 1000
@@ -34,23 +105,46 @@ class Metric(object):
 
         return envelope
 
+    def __reduce_ex__(self, protocol):
+        # the subclasses returned by histogram_class() and rate_class() can't be pickled by name,
+        # so metrics are pickled with their base class and settings
+        base, settings = _subclass_keys.get(type(self), (type(self), ()))
+        state = {}
+        for cls in type(self).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                try:
+                    state[slot] = getattr(self, slot)
+                except AttributeError:
+                    pass
+        return _new_metric, (base, settings), (None, state)
+
     def sample(self, value, sample_rate, timestamp):
         """Save a sample. """
         raise NotImplementedError()
 
-    def flush(self):
+    def merge(self, other):
+        """Add the samples of a later instance of the same series."""
+        raise NotImplementedError()
+
+    def flush_values(self):
+        """Return the name, value and timestamp of each measurement due and reset the samples."""
         if self.timestamp is None:
             return []
 
-        envelope = self.measurement(self.value, self.timestamp)
+        values = [(self.name, self.value, self.timestamp)]
         self.timestamp = None
         self.value = None
-        return [envelope]
+        return values
+
+    def flush(self):
+        return [self.measurement(value, timestamp, name) for name, value, timestamp in self.flush_values()]
 
 
 class Gauge(Metric):
     """A metric that tracks a value at particular points in time. """
 
+    __slots__ = ()
+
     def __init__(self, name, dimensions, tenant=None):
         super(Gauge, self).__init__(name, dimensions, tenant)
 
@@ -58,36 +152,203 @@ class Gauge(Metric):
         self.value = value
         self.timestamp = timestamp
 
+    def merge(self, other):
+        if other.timestamp is not None:
+            self.value_meta = other.value_meta
+            self.sample(other.value, 1, other.timestamp)
+
 
 class Counter(Metric):
-    """A metric that tracks a counter value. """
+    """A metric that tracks a counter value.
+
+    Samples without a sample rate are summed in value, the others in sampled by
+    their sample rate. Each sum is divided by its sample rate at flush, and the
+    total rounded to an integer, so the count is exact up to that rounding.
+    """
+
+    __slots__ = ('sampled',)
 
     def __init__(self, name, dimensions, tenant=None):
         super(Counter, self).__init__(name, dimensions, tenant)
+        self.sampled = None
 
     def sample(self, value, sample_rate, timestamp):
         try:
-            inc = float(value) / sample_rate
+            if value.__class__ is not int and value.__class__ is not float:
+                value = float(value)
             if self.timestamp is None:
-                self.value = inc
+                self.value = 0
+            if sample_rate == 1:
+                self.value += value
+            elif self.sampled is not None and sample_rate in self.sampled:
+                self.sampled[sample_rate] += value
+            elif sample_rate > 0:
+                if self.sampled is None:
+                    self.sampled = {}
+                self.sampled[sample_rate] = value
             else:
-                self.value += inc
+                raise ValueError('sample rate must be positive')
             self.timestamp = timestamp
         except (TypeError, ValueError):
             log.exception("illegal metric {} value {} sample_rate {}".
-                          format(self.metric['name'], value, sample_rate))
+                          format(self.name, value, sample_rate))
+
+    def merge(self, other):
+        if other.timestamp is not None:
+            self.value_meta = other.value_meta
+            self.sample(other.value, 1, other.timestamp)
+            if other.sampled:
+                for sample_rate, value in other.sampled.iteritems():
+                    self.sample(value, sample_rate, other.timestamp)
 
     # redefine flush method to make counter an integer when sample rates <> 1.0 used
-    def flush(self):
+    def flush_values(self):
         if self.timestamp:
-            self.value = int(self.value)
-            return super(Counter, self).flush()
+            total = self.value
+            if self.sampled:
+                for sample_rate, value in self.sampled.iteritems():
+                    total += value / float(sample_rate)
+                self.sampled = None
+            self.value = int(round(total))
+            return super(Counter, self).flush_values()
+        else:
+            return []
+
+
+class Histogram(Metric):
+    """A metric that tracks the distribution of values over each flush interval.
+
+    The flush reports the count, sum, min, max and avg of the values and the
+    percentiles in the class's percentiles attribute, each as a measurement
+    named after the metric with a suffix such as .count or .95percentile.
+    Use histogram_class() for other percentiles.
+    """
+
+    __slots__ = ('sketch',)
+
+    percentiles = PERCENTILES_DEFAULT
+
+    def __init__(self, name, dimensions, tenant=None):
+        super(Histogram, self).__init__(name, dimensions, tenant)
+        self.sketch = Sketch()
+
+    def sample(self, value, sample_rate, timestamp):
+        try:
+            self.sketch.add(float(value), 1.0 / sample_rate)
+            self.timestamp = timestamp
+        except (TypeError, ValueError, ZeroDivisionError):
+            log.exception("illegal metric {} value {} sample_rate {}".
+                          format(self.name, value, sample_rate))
+
+    def merge(self, other):
+        if other.timestamp is not None:
+            self.value_meta = other.value_meta
+            self.sketch.merge(other.sketch)
+            self.timestamp = other.timestamp
+
+    def flush_values(self):
+        sketch = self.sketch
+        if self.timestamp is None or not sketch.count:
+            return []
+
+        values = [('count', int(round(sketch.count))),
+                  ('sum', sketch.sum),
+                  ('min', sketch.min),
+                  ('max', sketch.max),
+                  ('avg', sketch.sum / sketch.count)]
+        for fraction in self.percentiles:
+            values.append((percentile_suffix(fraction), sketch.quantile(fraction)))
+
+        timestamp = self.timestamp
+        sketch.clear()
+        self.timestamp = None
+        return [('{0}.{1}'.format(self.name, suffix), value, timestamp) for suffix, value in values]
+
+
+def percentile_suffix(fraction):
+    if fraction == 0.5:
+        return 'median'
+    return '{0:g}percentile'.format(fraction * 100)
+
+
+def histogram_class(percentiles):
+    """Return a Histogram class reporting the given percentiles, fractions from 0 to 1."""
+    percentiles = tuple(percentiles)
+    if percentiles == Histogram.percentiles:
+        return Histogram
+    return _subclass(Histogram, percentiles=percentiles)
+
+
+class Set(Metric):
+    """A metric that counts the distinct values sampled in each flush interval.
+
+    Values are kept in a set until there are more than exact_max of them, then
+    counted by a HyperLogLog which uses 4KiB whatever the number of values.
+    """
+
+    __slots__ = ('values', 'hll')
+
+    exact_max = SET_EXACT_MAX_DEFAULT
+
+    def __init__(self, name, dimensions, tenant=None):
+        super(Set, self).__init__(name, dimensions, tenant)
+        self.values = set()
+        self.hll = None
+
+    def sample(self, value, sample_rate, timestamp):
+        if self.hll is not None:
+            self.hll.add(value)
         else:
+            self.values.add(value)
+            if len(self.values) > self.exact_max:
+                self.hll = HyperLogLog()
+                for distinct in self.values:
+                    self.hll.add(distinct)
+                self.values = set()
+        self.timestamp = timestamp
+
+    def merge(self, other):
+        if other.timestamp is None:
+            return
+        self.value_meta = other.value_meta
+        if other.hll is not None:
+            if self.hll is None:
+                self.hll = HyperLogLog()
+                for distinct in self.values:
+                    self.hll.add(distinct)
+                self.values = set()
+            self.hll.merge(other.hll)
+            self.timestamp = other.timestamp
+        else:
+            for distinct in other.values:
+                self.sample(distinct, 1, other.timestamp)
+
+    def flush_values(self):
+        if self.timestamp is None:
             return []
 
+        if self.hll is not None:
+            self.value = self.hll.count()
+            self.hll = None
+        else:
+            self.value = len(self.values)
+            self.values = set()
+        return super(Set, self).flush_values()
+
 
 class Rate(Metric):
-    """Track the rate of metrics over each flush interval """
+    """Track the rate of a counter over each flush interval.
+
+    A counter which decreased has either wrapped around at counter_width bits or
+    been reset, typically by a restart of what it counts. A wrap is assumed when
+    the counter_width is set and the wrapped difference is less than half the
+    counter range, no rate is reported for the interval of a reset. Use
+    rate_class() for counters of a known width.
+    """
+
+    __slots__ = ('start_value', 'start_timestamp')
+
+    counter_width = None
 
     def __init__(self, name, dimensions, tenant=None):
         super(Rate, self).__init__(name, dimensions, tenant)
@@ -104,8 +365,16 @@ class Rate(Metric):
             self.timestamp = timestamp
             self.value = value
 
+    def merge(self, other):
+        # only the first and last samples of the other instance count
+        self.value_meta = other.value_meta
+        if other.start_timestamp is not None:
+            self.sample(other.start_value, 1, other.start_timestamp)
+        if other.timestamp is not None:
+            self.sample(other.value, 1, other.timestamp)
+
     # redefine flush method to calculate rate from metrics
-    def flush(self):
+    def flush_values(self):
         # need at least two timestamps to determine rate
         # is the second one is missing then the first is kept as start value for the subsequent interval
         if self.start_timestamp is None or self.timestamp is None:
@@ -113,11 +382,22 @@ class Rate(Metric):
 
         delta_t = self.timestamp - self.start_timestamp
         delta_v = self.value - self.start_value
+        if delta_v < 0:
+            delta_v = self._wrapped_delta()
+            if delta_v is None:
+                log.debug('Counter reset for metric {0} with dimensions {1} at time {2}: {3} to {4}'.format(
+                    self.name, dict(self.dimensions), self.timestamp, self.start_value, self.value))
+                # skip the interval, the new value starts the next one
+                self.start_value = self.value
+                self.start_timestamp = self.timestamp
+                self.timestamp = None
+                self.value = None
+                return []
         try:
             rate = delta_v / float(delta_t)
         except ZeroDivisionError:
-            log.warning('Conflicting values reported for metric %s with dimensions %s at time %d: (%f, %f)', self.metric['name'],
-                        self.metric['dimensions'], self.timestamp, self.start_value, self.value)
+            log.warning('Conflicting values reported for metric %s with dimensions %s at time %d: (%f, %f)', self.name,
+                        dict(self.dimensions), self.timestamp, self.start_value, self.value)
 
             # skip this measurement, but keep value for next cycle
             self.start_value = self.value
@@ -127,7 +407,26 @@ class Rate(Metric):
         self.start_value = self.value
         self.start_timestamp = self.timestamp
 
-        envelope = self.measurement(rate, self.timestamp)
+        values = [(self.name, rate, self.timestamp)]
         self.timestamp = None
         self.value = None
-        return [envelope]
+        return values
+
+    def _wrapped_delta(self):
+        """Return the difference of a counter which wrapped around, None if it was reset."""
+        if self.counter_width is None:
+            return None
+        limit = 1 << self.counter_width
+        if self.start_value >= limit or self.value < 0:
+            return None
+        delta_v = self.value + limit - self.start_value
+        if delta_v >= limit / 2:
+            return None
+        return delta_v
+
+
+def rate_class(counter_width):
+    """Return a Rate class for counters which wrap around at counter_width bits, None for no wrap."""
+    if counter_width is None:
+        return Rate
+    return _subclass(Rate, counter_width=int(counter_width))
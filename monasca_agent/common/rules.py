@@ -0,0 +1,183 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+""" Pre-aggregation rules applied by MetricsAggregator before measurements are sent.
+
+A rule applies to the metrics whose name matches its regular expression and
+reduces them in up to three ways:
+
+  drop_dimensions: measurements which only differ in these dimensions are
+                   combined into one with function
+  every:           only one of every N flushes of a metric is sent
+  window:          measurements are combined with function over this many
+                   seconds and sent once per window
+
+function is one of sum, avg, max, min or last, avg by default. The first rule
+matching a metric name applies, and the match is remembered for the name.
+"""
+import logging
+import re
+
+import monasca_agent.common.metrics as metrics_pkg
+
+log = logging.getLogger(__name__)
+
+FUNCTIONS = ('sum', 'avg', 'max', 'min', 'last')
+# Metric names whose matching rule is remembered
+MATCH_CACHE_SIZE = 10000
+
+
+class InvalidRule(Exception):
+    pass
+
+
+class _Group(object):
+    """Measurements combined into one by a rule."""
+
+    __slots__ = ('metric', 'count', 'sum', 'min', 'max', 'last', 'timestamp', 'window_start', 'flushes',
+                 'updated')
+
+    def __init__(self, name, dimensions, tenant):
+        # carries the name, dimensions and tenant of the combined measurements
+        self.metric = metrics_pkg.Gauge(name, dimensions, tenant)
+        self.flushes = 0
+        self.window_start = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.timestamp = None
+        self.updated = False
+
+    def add(self, value, timestamp):
+        if self.count:
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+        else:
+            self.min = self.max = value
+        if self.timestamp is None or timestamp >= self.timestamp:
+            self.last = value
+            self.timestamp = timestamp
+        if self.window_start is None:
+            self.window_start = timestamp
+        self.count += 1
+        self.sum += value
+        self.updated = True
+
+    def value(self, function):
+        if function == 'avg':
+            return self.sum / float(self.count)
+        return getattr(self, function)
+
+
+class Rule(object):
+
+    def __init__(self, metric, drop_dimensions=None, function='avg', every=1, window=0):
+        try:
+            self.pattern = re.compile(metric)
+        except (re.error, TypeError) as e:
+            raise InvalidRule("Invalid metric pattern {0}: {1}".format(metric, e))
+        if function not in FUNCTIONS:
+            raise InvalidRule("Invalid function {0} for {1}, expected one of {2}".format(function, metric,
+                                                                                          ', '.join(FUNCTIONS)))
+        self.drop_dimensions = frozenset(drop_dimensions or ())
+        self.function = function
+        self.every = int(every)
+        self.window = float(window)
+        if self.every < 1 or self.window < 0:
+            raise InvalidRule("every must be at least 1 and window at least 0 for {0}".format(metric))
+        self._groups = {}
+
+    def add(self, metric, name, value, timestamp):
+        dimensions = metric.dimensions
+        if self.drop_dimensions:
+            dimensions = tuple(item for item in dimensions if item[0] not in self.drop_dimensions)
+        key = (name, dimensions, metric.tenant)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _Group(name, dimensions, metric.tenant)
+        group.add(value, timestamp)
+
+    def flush(self):
+        """Return the combined measurements which are due, like MetricsAggregator._flush_values()."""
+        flushed = []
+        for key, group in self._groups.items():
+            if not group.updated:
+                # not sampled since the previous flush, a window in progress is sent as it is
+                if group.count:
+                    flushed.append(self._combined(group))
+                del self._groups[key]
+                continue
+            group.updated = False
+            if self.window:
+                if group.timestamp - group.window_start < self.window:
+                    continue
+                group.window_start = None
+            group.flushes += 1
+            if (group.flushes - 1) % self.every == 0:
+                flushed.append(self._combined(group))
+            group.reset()
+        return flushed
+
+    def _combined(self, group):
+        return group.metric, [(group.metric.name, group.value(self.function), group.timestamp)]
+
+
+class RuleEngine(object):
+    """Rules compiled from the aggregation_rules configuration, a list of dicts."""
+
+    def __init__(self, rules):
+        self.rules = []
+        for rule in rules:
+            if not isinstance(rule, dict) or 'metric' not in rule:
+                raise InvalidRule("Aggregation rule {0} has no metric pattern".format(rule))
+            self.rules.append(Rule(**rule))
+        self._matches = {}
+        self.points_in = 0
+        self.points_out = 0
+
+    def match(self, name):
+        """Return the first rule matching the metric name, or None."""
+        try:
+            return self._matches[name]
+        except KeyError:
+            pass
+        matched = None
+        for rule in self.rules:
+            if rule.pattern.match(name):
+                matched = rule
+                break
+        if len(self._matches) >= MATCH_CACHE_SIZE:
+            self._matches.clear()
+        self._matches[name] = matched
+        return matched
+
+    def apply(self, flushed):
+        """Combine the measurements matching a rule and return the rest with the combined ones due."""
+        result = []
+        points_in = 0
+        for metric, values in flushed:
+            kept = []
+            for name, value, timestamp in values:
+                rule = self.match(name)
+                if rule is None:
+                    kept.append((name, value, timestamp))
+                else:
+                    rule.add(metric, name, value, timestamp)
+                    points_in += 1
+            if len(kept) == len(values):
+                result.append((metric, values))
+            elif kept:
+                result.append((metric, kept))
+        points_out = 0
+        for rule in self.rules:
+            combined = rule.flush()
+            points_out += len(combined)
+            result.extend(combined)
+        self.points_in += points_in
+        self.points_out += points_out
+        return result
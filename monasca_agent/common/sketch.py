@@ -0,0 +1,190 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+""" Mergeable sketches: quantiles with a bounded relative error, after DDSketch
+(Masson, Rim and Lee, VLDB 2019), and HyperLogLog distinct counts (Flajolet,
+Fusy, Gandouet and Meunier, AofA 2007).
+"""
+import math
+
+RELATIVE_ACCURACY_DEFAULT = 0.01
+MAX_BINS_DEFAULT = 2048
+# Values closer to zero than this are counted as zero
+MIN_VALUE = 1e-9
+# 2 ** 12 registers count with a standard error of 1.6%
+HLL_PRECISION_DEFAULT = 12
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+
+class _Store(object):
+    """Weights of the logarithmic bins of one sign of the sketch.
+
+    Once more than max_bins bins are used, the lowest bins are merged into a
+    floor bin that also takes every lower value from then on, so the quantiles
+    near the top keep their accuracy.
+    """
+
+    __slots__ = ('bins', 'floor', 'max_bins')
+
+    def __init__(self, max_bins):
+        self.bins = {}
+        self.floor = None
+        self.max_bins = max_bins
+
+    def add(self, key, weight):
+        if self.floor is not None and key < self.floor:
+            key = self.floor
+        bins = self.bins
+        if key in bins:
+            bins[key] += weight
+        else:
+            bins[key] = weight
+            if len(bins) > self.max_bins:
+                self._collapse()
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        excess = len(keys) - self.max_bins
+        floor = keys[excess]
+        bins = self.bins
+        for key in keys[:excess]:
+            bins[floor] += bins.pop(key)
+        self.floor = floor
+
+    def merge(self, other):
+        for key, weight in other.bins.iteritems():
+            self.add(key, weight)
+
+    def clear(self):
+        self.bins.clear()
+        self.floor = None
+
+
+class Sketch(object):
+    """Quantile sketch which also tracks the count, sum, minimum and maximum.
+
+    Quantiles are accurate to relative_accuracy of the value as long as no more
+    than max_bins bins are needed for each sign, which at 1% covers values from
+    a microsecond to more than a year in the same unit. Samples can be weighted,
+    which is how statsd sample rates are accounted for.
+    """
+
+    __slots__ = ('count', 'sum', 'min', 'max', 'zero_count', '_positive', '_negative',
+                 '_gamma', '_multiplier')
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY_DEFAULT, max_bins=MAX_BINS_DEFAULT):
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self._gamma)
+        self._positive = _Store(max_bins)
+        self._negative = _Store(max_bins)
+        self.clear()
+
+    def add(self, value, weight=1.0):
+        if value > MIN_VALUE:
+            self._positive.add(int(math.ceil(math.log(value) * self._multiplier)), weight)
+        elif value < -MIN_VALUE:
+            self._negative.add(int(math.ceil(math.log(-value) * self._multiplier)), weight)
+        else:
+            self.zero_count += weight
+
+        if self.count:
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+        else:
+            self.min = self.max = value
+        self.count += weight
+        self.sum += value * weight
+
+    def merge(self, other):
+        """Add the samples of another sketch with the same relative accuracy."""
+        if not other.count:
+            return
+        if self.count:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        else:
+            self.min = other.min
+            self.max = other.max
+        self.count += other.count
+        self.sum += other.sum
+        self.zero_count += other.zero_count
+        self._positive.merge(other._positive)
+        self._negative.merge(other._negative)
+
+    def _value(self, key):
+        return 2 * self._gamma ** key / (self._gamma + 1)
+
+    def quantile(self, fraction):
+        """Return the estimated value at fraction (0 to 1) of the samples, None without samples."""
+        if not self.count:
+            return None
+        rank = fraction * (self.count - 1)
+        total = 0
+        for key in sorted(self._negative.bins, reverse=True):
+            total += self._negative.bins[key]
+            if total > rank:
+                return max(-self._value(key), self.min)
+        total += self.zero_count
+        if total > rank:
+            return 0
+        for key in sorted(self._positive.bins):
+            total += self._positive.bins[key]
+            if total > rank:
+                return min(self._value(key), self.max)
+        return self.max
+
+    def clear(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.zero_count = 0
+        self._positive.clear()
+        self._negative.clear()
+
+
+def hash64(value):
+    """Return a well mixed 64 bit hash of a hashable value.
+
+    The built-in hash of similar strings differs mostly in the low bits, so it is
+    passed through the splitmix64 finalizer.
+    """
+    h = hash(value) & MASK_64
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return h ^ (h >> 31)
+
+
+class HyperLogLog(object):
+    """Distinct count of hashable values in 2 ** precision bytes."""
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=HLL_PRECISION_DEFAULT):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        h = hash64(value)
+        index = h >> (64 - self.precision)
+        # position of the first set bit of the remaining 64 - precision bits
+        rank = 64 - self.precision - (h & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Add the values of another HyperLogLog with the same precision."""
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small counts
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
@@ -685,6 +685,12 @@ def chunks(iterable, chunk_size):
             break
 
 
+def percentile(sorted_values, fraction):
+    """Return the value below which `fraction` of the non-empty list `sorted_values` falls."""
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
 def get_sub_collection_warn():
     config = configuration.Config()
     agent_config = config.get_config(sections='Main')
@@ -0,0 +1,57 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+""" Controls how fast the forwarder sends its backlog after an outage.
+"""
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+MIN_RATE = 1
+DECREASE_FACTOR = 0.5
+
+
+class DrainController(object):
+    """Adjusts the backlog send rate with additive increase, multiplicative decrease.
+
+    Every request to the API is recorded. Before each round of sending from the
+    backlog the rate is raised by rate_increase batches if the requests since the
+    previous round were fast and none of them failed with a server error or timeout,
+    otherwise it is halved.
+    """
+
+    def __init__(self, initial_rate, max_rate, max_latency, rate_increase=1):
+        self.max_rate = max(MIN_RATE, int(max_rate))
+        self.rate = min(max(MIN_RATE, int(initial_rate)), self.max_rate)
+        self.max_latency = max_latency  # ms
+        self.rate_increase = rate_increase
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._failures = 0
+        self._total_latency = 0.0
+
+    def record(self, latency, failed):
+        """Record a request which took latency ms, failed is True for server errors and timeouts."""
+        with self._lock:
+            self._requests += 1
+            self._total_latency += latency
+            if failed:
+                self._failures += 1
+
+    def next_rate(self):
+        """Return the number of requests to send from the backlog in the next round."""
+        with self._lock:
+            requests, failures, total_latency = self._requests, self._failures, self._total_latency
+            self._requests = 0
+            self._failures = 0
+            self._total_latency = 0.0
+
+        if requests:
+            average_latency = total_latency / requests
+            if failures or average_latency > self.max_latency:
+                self.rate = max(MIN_RATE, int(self.rate * DECREASE_FACTOR))
+                log.debug("Backlog send rate decreased to {0} ({1} of {2} requests failed, "
+                          "average latency {3:.0f}ms)".format(self.rate, failures, requests, average_latency))
+            elif self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.rate_increase)
+                log.debug("Backlog send rate increased to {0}".format(self.rate))
+        return self.rate
@@ -1,17 +1,61 @@
 # (C) Copyright 2015-2016 Hewlett Packard Enterprise Development LP
 
 import collections
-import copy
 import json
 import logging
 import random
+import resource
+import threading
 import time
+import zlib
+
+from concurrent import futures
 
 import monasca_agent.common.keystone as keystone
+import monasca_agent.common.util as util
+import monasca_agent.forwarder.api.drain as drain
+import monasca_agent.forwarder.api.spool as spool
 import monascaclient.client
 
 log = logging.getLogger(__name__)
 
+# Content-Encoding of the request body mapped to the zlib window bits producing it
+COMPRESSION_WBITS = {'gzip': 16 + zlib.MAX_WBITS,
+                     'deflate': zlib.MAX_WBITS}
+
+
+class CompressedBody(str):
+    """Compressed request body.
+
+    The monasca client logs every request body, which fails for binary data, so
+    the body is logged as a placeholder instead.
+    """
+
+    def __str__(self):
+        return '<{0} compressed bytes>'.format(len(self))
+
+
+def compress(body, encoding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, COMPRESSION_WBITS[encoding])
+    return CompressedBody(compressor.compress(body) + compressor.flush())
+
+
+# resource.RUSAGE_THREAD is only defined from Python 3.2, it is 1 on Linux
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+
+def thread_cpu_time():
+    """Return the seconds of CPU time used by the calling thread.
+
+    Where the resource usage of a thread is not available, the CPU time of the
+    process is returned, which includes the other threads.
+    """
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except ValueError:
+        return time.clock()
+    return usage.ru_utime + usage.ru_stime
+
 
 class MonascaAPI(object):
     """Sends measurements to MonascaAPI
@@ -24,6 +68,14 @@ class MonascaAPI(object):
     MAX_BACKOFF = 60  # seconds
     MIN_AUTH_BACKOFF = 60  # seconds to wait after failed authentications (wrong password, locked user, no role)
     MAX_AUTH_BACKOFF = 60 * 15  # max. time to wait (limit for exponential backoff)
+    DEFAULT_POST_THREADS = 4
+    DEFAULT_MAX_INFLIGHT_REQUESTS = 2  # per tenant
+    DEFAULT_MAX_BACKLOG_SEND_RATE = 100  # requests
+    DEFAULT_BACKLOG_MAX_LATENCY = 1000  # ms
+    DEFAULT_BACKLOG_MERGE_SIZE = 512 * 1024  # bytes
+    DEFAULT_COMPRESSION_LEVEL = 6
+    DEFAULT_COMPRESSION_MIN_SIZE = 1024  # bytes
+    DEFAULT_BACKLOG_HIGH_WATER_MARK = 0.9  # fraction of the queue limits
 
     def __init__(self, config):
         """Initialize Mon api client connection."""
@@ -32,7 +84,6 @@ class MonascaAPI(object):
         self.api_version = '2_0'
         self.keystone = keystone.Keystone(config)
         self.mon_client = None
-        self._failure_reason = None
         self._resume_time = None
         self._failed_auth_cnt = 0
         self._log_interval_remaining = 1
@@ -49,10 +100,33 @@ class MonascaAPI(object):
                 self.max_buffer_size = -1
 
         self.backlog_send_rate = int(config['backlog_send_rate'])
-        if self.max_buffer_size > -1:
-            self.message_queue = collections.deque(maxlen=self.max_buffer_size)
+        # The number of requests sent from the backlog each time starts at backlog_send_rate and
+        # grows up to max_backlog_send_rate while the API keeps answering quickly
+        max_backlog_send_rate = max(self.backlog_send_rate,
+                                    int(config.get('max_backlog_send_rate',
+                                                   MonascaAPI.DEFAULT_MAX_BACKLOG_SEND_RATE)))
+        self.drain = drain.DrainController(self.backlog_send_rate,
+                                           max_backlog_send_rate,
+                                           int(config.get('backlog_max_latency',
+                                                          MonascaAPI.DEFAULT_BACKLOG_MAX_LATENCY)))
+        # Queued batches of a tenant are combined into requests of up to this many bytes
+        self.backlog_merge_size = int(config.get('backlog_merge_size', MonascaAPI.DEFAULT_BACKLOG_MERGE_SIZE))
+        # 'backlog_spool_dir' is optional, without it the backlog is only kept in memory
+        self.spool_dir = config.get('backlog_spool_dir')
+        self.max_spool_size = int(config.get('backlog_spool_max_size', -1))
+        if self.spool_dir:
+            self.message_queue = spool.SegmentSpool(self.spool_dir,
+                                                    config.get('backlog_spool_segment_size',
+                                                               spool.DEFAULT_SEGMENT_SIZE),
+                                                    max_batches=self.max_buffer_size,
+                                                    max_measurements=self.max_measurement_buffer_size)
+            self._current_number_measurements = self.message_queue.measurements
         else:
             self.message_queue = collections.deque()
+        # New measurements are refused once the backlog reaches this fraction of any of its limits,
+        # so the collector and statsd hold them back instead of the oldest data being discarded
+        self.backlog_high_water_mark = float(config.get('backlog_high_water_mark',
+                                                        MonascaAPI.DEFAULT_BACKLOG_HIGH_WATER_MARK))
         self.write_timeout = int(config['write_timeout'])
         # 'amplifier' is completely optional and may not exist in the config
         try:
@@ -60,69 +134,237 @@ class MonascaAPI(object):
         except KeyError:
             self.amplifier = None
 
+        # 'compression' is optional, request bodies are sent uncompressed without it
+        self.compression = config.get('compression') or None
+        if self.compression and self.compression not in COMPRESSION_WBITS:
+            log.error("Unknown compression {0}, request bodies will not be compressed. "
+                      "Supported values are {1}".format(self.compression, ', '.join(sorted(COMPRESSION_WBITS))))
+            self.compression = None
+        self.compression_level = int(config.get('compression_level', MonascaAPI.DEFAULT_COMPRESSION_LEVEL))
+        self.compression_min_size = int(config.get('compression_min_size', MonascaAPI.DEFAULT_COMPRESSION_MIN_SIZE))
+        self._compressed_bytes = 0
+        self._uncompressed_bytes = 0
+        self._compression_time = 0.0
+
+        # Requests are sent from a pool of threads so posting never blocks the forwarder's IOLoop.
+        # With 'post_threads' set to 0 measurements are posted synchronously by the caller.
+        self.post_threads = int(config.get('post_threads', MonascaAPI.DEFAULT_POST_THREADS))
+        self.max_inflight_requests = int(config.get('max_inflight_requests',
+                                                    MonascaAPI.DEFAULT_MAX_INFLIGHT_REQUESTS))
+        self._executor = None
+        if self.post_threads > 0:
+            self._executor = futures.ThreadPoolExecutor(max_workers=self.post_threads)
+        # Guards the message queue and the request statistics shared by the post threads
+        self._lock = threading.RLock()
+        # Guards getting the monasca client and tokens, which calls Keystone, and the auth backoff.
+        # It is only taken by the post threads, so a slow Keystone never blocks the IOLoop.
+        self._client_lock = threading.RLock()
+        # Only one thread sends from the backlog at a time
+        self._backlog_lock = threading.Lock()
+        self._requests_in_flight = {}
+        self._send_times = []
+        # Data thrown away because the queue was full, since the last report and since the start
+        self._discarded_batches = 0
+        self._discarded_measurements = 0
+        self.discarded_batches_total = 0
+        self.discarded_measurements_total = 0
+
         random.seed()
 
-    def _post(self, measurements, tenant=None):
+    def _post(self, tenant, body, count):
         """Does the actual http post
-            measurements is a list of Measurement
+            body is a JSON list of count measurements
         """
-        kwargs = {
-            'jsonbody': measurements
-        }
-
-        if tenant:
-            kwargs['tenant_id'] = tenant
-
         if not self.mon_client:
-            self.mon_client = self.get_monclient()
+            with self._client_lock:
+                if not self.mon_client:
+                    mon_client = self.get_monclient()
+                    with self._lock:
+                        self.mon_client = mon_client
             if not self.mon_client:
                 # Keystone is down, queue the message
-                self._queue_message(kwargs.copy(), "Keystone API is down or unreachable")
+                self._queue_message(tenant, body, count, "Keystone API is down or unreachable")
                 return
 
-        if self._send_message(**kwargs):
+        failure_reason = self._send_message(body, tenant)
+        if failure_reason is None:
             if len(self.message_queue) > 0:
-                messages_sent = 0
-                for index in range(0, len(self.message_queue)):
-                    if index < self.backlog_send_rate:
-
-                        msg = json.loads(self.message_queue.pop())
-
-                        if self._send_message(**msg):
-                            messages_sent += 1
-                            for value in msg.values():
-                                self._current_number_measurements -= len(value)
-                        else:
-                            self._queue_message(msg, self._failure_reason)
-                            break
-                    else:
-                        break
-                log.info("Sent {0} messages from the backlog.".format(messages_sent))
-                log.info("{0} messages remaining in the queue.".format(len(self.message_queue)))
-                self._log_interval_remaining = 0
+                self._drain_backlog()
         else:
-            self._queue_message(kwargs.copy(), self._failure_reason)
+            self._queue_message(tenant, body, count, failure_reason)
+
+    def _send_backlog(self):
+        messages_sent = 0
+        for _ in range(0, self.drain.next_rate()):
+            with self._lock:
+                if not self.message_queue:
+                    break
+                queued_tenant, queued_body, count = self._pop_merged_batch()
+
+            failure_reason = self._send_message(queued_body, queued_tenant)
+            if failure_reason is None:
+                messages_sent += 1
+            else:
+                self._queue_message(queued_tenant, queued_body, count, failure_reason)
+                break
+        log.info("Sent {0} messages from the backlog.".format(messages_sent))
+        log.info("{0} messages remaining in the queue.".format(len(self.message_queue)))
+        self._log_interval_remaining = 0
+
+    def is_backlogged(self):
+        """Return True if the backlog has reached its high water mark."""
+        if self.backlog_high_water_mark <= 0:
+            return False
+        with self._lock:
+            levels = [(len(self.message_queue), self.max_buffer_size),
+                      (self._current_number_measurements, self.max_measurement_buffer_size)]
+            if self.spool_dir:
+                levels.append((self.message_queue.size, self.max_spool_size))
+        for level, limit in levels:
+            if limit > -1 and level >= limit * self.backlog_high_water_mark:
+                return True
+        return False
+
+    def drain_backlog(self):
+        """Send from the backlog without waiting for new measurements to be posted.
+
+        While the backlog is above its high water mark no new measurements are accepted,
+        so the backlog is sent from here instead of after a successful post.
+        """
+        if not self.mon_client or not self.message_queue:
+            return
+        if self._executor:
+            self._executor.submit(self._drain_backlog).add_done_callback(self._drain_done)
+        else:
+            self._drain_backlog()
+
+    @staticmethod
+    def _drain_done(future):
+        if future.exception():
+            log.error("Error sending the backlog: {0}".format(repr(future.exception())))
+
+    def _drain_backlog(self):
+        if self._backlog_lock.acquire(False):
+            try:
+                self._send_backlog()
+            finally:
+                self._backlog_lock.release()
+
+    def _pop_merged_batch(self):
+        """Remove the newest batch from the queue, combined with the following ones of the same tenant.
+
+        The serialized JSON lists are joined without being parsed as long as the result stays
+        within backlog_merge_size bytes.
+        """
+        tenant, body, count = self.message_queue.pop()
+        self._current_number_measurements -= count
+        if not self.message_queue or len(body) >= self.backlog_merge_size:
+            return tenant, body, count
+
+        bodies = [body[1:-1]]
+        size = len(body)
+        while self.message_queue:
+            next_batch = self.message_queue.pop()
+            next_tenant, next_body, next_count = next_batch
+            if next_tenant != tenant or size + len(next_body) - 1 > self.backlog_merge_size:
+                self.message_queue.append(next_batch)
+                break
+            bodies.append(next_body[1:-1])
+            size += len(next_body) - 1
+            count += next_count
+            self._current_number_measurements -= next_count
+        return tenant, '[' + ','.join(bodies) + ']', count
 
     def post_metrics(self, measurements):
         """post_metrics
             given [Measurement, ...], format the request and post to
             the monitoring api
         """
-        # Add default dimensions
+        # Split out separate POSTs for each delegated tenant (includes 'None'). The measurements
+        # are not modified after being handed over, so they are grouped without copying them.
+        tenant_group = {}
         for envelope in measurements:
             measurement = envelope['measurement']
             if isinstance(measurement['dimensions'], list):
                 measurement['dimensions'] = dict([(d[0], d[1]) for d in measurement['dimensions']])
-
-        # Split out separate POSTs for each delegated tenant (includes 'None')
-        tenant_group = {}
-        for envelope in measurements:
-            measurement = envelope['measurement']
             tenant = envelope['tenant_id']
-            tenant_group.setdefault(tenant, []).append(copy.deepcopy(measurement))
+            group = tenant_group.get(tenant)
+            if group is None:
+                tenant_group[tenant] = [measurement]
+            else:
+                group.append(measurement)
 
         for tenant in tenant_group:
-            self._post(tenant_group[tenant], tenant)
+            self.post_batch(tenant, json.dumps(tenant_group[tenant]), len(tenant_group[tenant]))
+
+    def post_batch(self, tenant, body, count):
+        """Hand a tenant's batch, serialized as a JSON list of count measurements, to the post threads.
+
+        A tenant never has more than max_inflight_requests requests queued or running;
+        further batches go straight to the backlog and are sent once the API catches up.
+        """
+        if not self._executor:
+            self._post(tenant, body, count)
+            return
+
+        with self._lock:
+            in_flight = self._requests_in_flight.get(tenant, 0)
+            if in_flight < self.max_inflight_requests:
+                self._requests_in_flight[tenant] = in_flight + 1
+        if in_flight >= self.max_inflight_requests:
+            self._queue_message(tenant, body, count,
+                                "{0} requests already in flight for tenant {1}".format(in_flight, tenant))
+            return
+
+        future = self._executor.submit(self._post, tenant, body, count)
+        future.add_done_callback(lambda f: self._request_done(f, tenant))
+
+    def _request_done(self, future, tenant):
+        with self._lock:
+            self._requests_in_flight[tenant] -= 1
+            if not self._requests_in_flight[tenant]:
+                del self._requests_in_flight[tenant]
+        if future.exception():
+            log.error("Error posting measurements: {0}".format(repr(future.exception())))
+
+    def get_queue_status(self):
+        """Return the current state of the requests in flight and the message queue."""
+        with self._lock:
+            return {'monasca.agent.forwarder.send_queue_depth': sum(self._requests_in_flight.values()),
+                    'monasca.agent.forwarder.backlog_size': len(self.message_queue),
+                    'monasca.agent.forwarder.backlog_measurements': self._current_number_measurements,
+                    'monasca.agent.forwarder.backlog_send_rate': self.drain.rate}
+
+    def get_statistics(self):
+        """Return the queue status and the request statistics gathered since the previous call."""
+        with self._lock:
+            send_times, self._send_times = self._send_times, []
+            statistics = self.get_queue_status()
+            statistics['monasca.agent.forwarder.discarded_batches'] = self._discarded_batches
+            statistics['monasca.agent.forwarder.discarded_measurements'] = self._discarded_measurements
+            self._discarded_batches = 0
+            self._discarded_measurements = 0
+            if self._compressed_bytes:
+                statistics['monasca.agent.forwarder.compression_ratio'] = (float(self._uncompressed_bytes) /
+                                                                           self._compressed_bytes)
+                statistics['monasca.agent.forwarder.compression_time_ms'] = self._compression_time
+                self._compressed_bytes = 0
+                self._uncompressed_bytes = 0
+                self._compression_time = 0.0
+        if send_times:
+            send_times.sort()
+            statistics['monasca.agent.forwarder.send_time_ms'] = sum(send_times) / len(send_times)
+            statistics['monasca.agent.forwarder.send_time_max_ms'] = send_times[-1]
+            statistics['monasca.agent.forwarder.send_time_median_ms'] = util.percentile(send_times, 0.5)
+            statistics['monasca.agent.forwarder.send_time_95percentile_ms'] = util.percentile(send_times, 0.95)
+        return statistics
+
+    def stop(self):
+        """Wait for the requests in flight to complete."""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        if self.spool_dir:
+            self.message_queue.close()
 
     def get_monclient(self):
         """get_monclient
@@ -143,65 +385,110 @@ class MonascaAPI(object):
 
         return None
 
-    def _send_message(self, **kwargs):
-        if self._resume_time:
-            if time.time() > self._resume_time:
-                self._resume_time = None
-                log.debug("Getting new token...")
-                # Get a new keystone client and token
-                if self.keystone.refresh_token():
-                    self.mon_client.replace_token(self.keystone.get_token())
-                    self._failed_auth_cnt = 0
+    def _create_metrics(self, body, tenant=None):
+        """POST an already serialized list of measurements.
+
+        The body is passed to the monasca client unchanged, so queued batches are sent without being parsed again.
+        Bodies of at least compression_min_size bytes are compressed if 'compression' is configured.
+        """
+        url = '/metrics'
+        if tenant:
+            url += '?tenant_id={0}'.format(tenant)
+        headers = self.mon_client.http_client.credentials_headers()
+        headers['Content-Type'] = 'application/json'
+        headers['Accept'] = 'application/json'
+        if self.compression and len(body) >= self.compression_min_size:
+            # CPU time, so waiting for the GIL or being preempted is not counted
+            start = thread_cpu_time()
+            compressed = compress(body, self.compression, self.compression_level)
+            compression_time = (thread_cpu_time() - start) * 1000
+            with self._lock:
+                self._uncompressed_bytes += len(body)
+                self._compressed_bytes += len(compressed)
+                self._compression_time += compression_time
+            body = compressed
+            headers['Content-Encoding'] = self.compression
+        self.mon_client.http_client.raw_request('POST', url, data=body, headers=headers)
+
+    def _send_message(self, body, tenant=None):
+        """POST a batch, returning None once it was sent and otherwise the reason it was not."""
+        with self._client_lock:
+            if self._resume_time:
+                if time.time() > self._resume_time:
+                    self._resume_time = None
+                    log.debug("Getting new token...")
+                    # Get a new keystone client and token
+                    if self.keystone.refresh_token():
+                        self.mon_client.replace_token(self.keystone.get_token())
+                        self._failed_auth_cnt = 0
+                    else:
+                        self._failed_auth_cnt += 1
+                        return self._handle_auth_fail()
                 else:
-                    self._failed_auth_cnt += 1
-                    self._handle_auth_fail()
-                    return False
-            else:
-                # Return without posting so the monasca client doesn't keep requesting new tokens
-                return False
+                    # Return without posting so the monasca client doesn't keep requesting new tokens
+                    return 'Waiting to get a new token from Keystone'
+        start = time.time()
+        # Server errors and timeouts make the backlog drain slow down
+        server_failure = False
         try:
-            self.mon_client.metrics.create(**kwargs)
-            return True
+            self._create_metrics(body, tenant)
+            return None
         except monascaclient.exc.HTTPException as ex:
+            server_failure = not isinstance(ex.code, int) or ex.code >= 500 or ex.code == 429
             if ex.code == 401:
                 # monasca client should already have retried once with a new token before returning this exception
-                self._failure_reason = 'Invalid token detected. Waiting to get new token from Keystone'
                 wait_time = random.randint(MonascaAPI.MIN_BACKOFF, MonascaAPI.MAX_BACKOFF + 1)
-                self._resume_time = time.time() + wait_time
+                with self._client_lock:
+                    self._resume_time = time.time() + wait_time
                 log.info("Invalid token detected. Waiting %d seconds before getting new token.", wait_time)
-            else:
-                log.exception("HTTPException: error sending message to monasca-api.")
-                self._failure_reason = 'Error sending message to the Monasca API: {0}'.format(str(ex.message))
+                return 'Invalid token detected. Waiting to get new token from Keystone'
+            log.exception("HTTPException: error sending message to monasca-api.")
+            return 'Error sending message to the Monasca API: {0}'.format(str(ex.message))
         except Exception:
             log.exception("Error sending message to Monasca API.")
-            self._failure_reason = 'The Monasca API is DOWN or unreachable'
-
-        return False
+            server_failure = True
+            return 'The Monasca API is DOWN or unreachable'
+        finally:
+            send_time = (time.time() - start) * 1000
+            self.drain.record(send_time, server_failure)
+            with self._lock:
+                self._send_times.append(send_time)
 
     def _handle_auth_fail(self):
-        self._failure_reason = 'The Monasca agent user {0} cannot be authenticated (attempt {1}).'.format(
+        """Back off from Keystone, called with _client_lock held, and return the reason."""
+        failure_reason = 'The Monasca agent user {0} cannot be authenticated (attempt {1}).'.format(
             self.config.get('username'), self._failed_auth_cnt)
-        log.error(self._failure_reason)
+        log.error(failure_reason)
         factor = 2 ** self._failed_auth_cnt
         wait_time = min(
             random.randint(factor * MonascaAPI.MIN_AUTH_BACKOFF, (factor + 1) * MonascaAPI.MIN_AUTH_BACKOFF),
             MonascaAPI.MAX_AUTH_BACKOFF)
         self._resume_time = time.time() + wait_time
-        log.error("%s - Waiting %d seconds before getting new token.", self._failure_reason, wait_time)
+        log.error("%s - Waiting %d seconds before getting new token.", failure_reason, wait_time)
+        return failure_reason
 
-    def _queue_message(self, msg, reason):
+    def _queue_message(self, tenant, body, count, reason):
         if self.max_buffer_size == 0 or self.max_measurement_buffer_size == 0:
             return
 
-        self.message_queue.append(json.dumps(msg))
+        with self._lock:
+            self._append_to_queue(tenant, body, count, reason)
 
-        for value in msg.values():
-            self._current_number_measurements += len(value)
+    def _append_to_queue(self, tenant, body, count, reason):
+        if -1 < self.max_buffer_size <= len(self.message_queue):
+            self._remove_oldest_from_queue()
+
+        self.message_queue.append((tenant, body, count))
+        self._current_number_measurements += count
 
         if self.max_measurement_buffer_size > -1:
             while self._current_number_measurements > self.max_measurement_buffer_size:
                 self._remove_oldest_from_queue()
 
+        if self.spool_dir and self.max_spool_size > -1:
+            while self.message_queue.size > self.max_spool_size:
+                self._remove_oldest_from_queue()
+
         if self._log_interval_remaining <= 1:
             log.warn("{0}. Queuing the messages to send later...".format(reason))
             log.info("Current agent queue size: {0} of {1}.".format(len(self.message_queue),
@@ -215,10 +502,15 @@ class MonascaAPI(object):
             self._log_interval_remaining -= 1
 
     def _remove_oldest_from_queue(self):
-        removed_batch = json.loads(self.message_queue.popleft())
-        num_discarded = 0
-        for value in removed_batch.values():
-            num_discarded += len(value)
+        if self.spool_dir:
+            num_batches, num_discarded = self.message_queue.evict_oldest()
+        else:
+            num_batches = 1
+            num_discarded = self.message_queue.popleft()[2]
         self._current_number_measurements -= num_discarded
-        log.warn("Queue too large, discarding oldest batch: {0} measurements discarded".format(
-            num_discarded))
+        self._discarded_batches += num_batches
+        self._discarded_measurements += num_discarded
+        self.discarded_batches_total += num_batches
+        self.discarded_measurements_total += num_discarded
+        log.warn("Queue too large, discarding {0} oldest batch(es): {1} measurements discarded".format(
+            num_batches, num_discarded))
@@ -0,0 +1,229 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+""" Durable on-disk backlog of batches the forwarder could not send.
+
+The spool is a directory of segment files. Records are only ever appended to
+the newest segment and each record carries its own length in a trailer, so the
+newest batch can be found from the end of the file and removed by truncating
+it. The oldest data is dropped a whole segment at a time. Every record stores
+the tenant and number of measurements next to the serialized JSON body, so
+the backlog can be accounted and replayed without parsing the batches.
+
+Record layout:  body_len, count, tenant_len | tenant | body | record_len
+"""
+import errno
+import logging
+import mmap
+import os
+import struct
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 1024 * 1024  # bytes
+SEGMENT_SUFFIX = '.seg'
+# A segment is closed once it holds this fraction of the queue limits so
+# evicting the oldest segment never throws away more than a small part of the backlog
+SEGMENT_LIMIT_DIVISOR = 8
+
+_header = struct.Struct('!IIH')
+_trailer = struct.Struct('!I')
+
+
+class _Segment(object):
+
+    def __init__(self, seg_id, path):
+        self.seg_id = seg_id
+        self.path = path
+        self.batches = 0
+        self.measurements = 0
+        self.size = 0
+
+
+class SegmentSpool(object):
+    """Segment file store used in place of the in-memory message queue.
+
+    Batches are appended and popped newest first, like the deque used when no
+    spool directory is configured. Queue limits are enforced by the caller with
+    evict_oldest().
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 max_batches=-1, max_measurements=-1):
+        self.directory = directory
+        self.segment_size = int(segment_size)
+        self.segment_max_batches = self._segment_limit(max_batches)
+        self.segment_max_measurements = self._segment_limit(max_measurements)
+        self.batches = 0
+        self.measurements = 0
+        self.size = 0
+        self._segments = []
+        self._file = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+    @staticmethod
+    def _segment_limit(limit):
+        limit = int(limit)
+        if limit < 0:
+            return -1
+        return max(1, limit // SEGMENT_LIMIT_DIVISOR)
+
+    def __len__(self):
+        return self.batches
+
+    def _load(self):
+        """Rebuild the segment accounting from the files left by a previous run."""
+        seg_ids = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    seg_ids.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    log.warn("Ignoring unknown file {0} in the spool directory".format(name))
+
+        for seg_id in sorted(seg_ids):
+            segment = _Segment(seg_id, self._segment_path(seg_id))
+            self._scan(segment)
+            if segment.batches:
+                self._segments.append(segment)
+                self.batches += segment.batches
+                self.measurements += segment.measurements
+                self.size += segment.size
+            else:
+                os.remove(segment.path)
+
+        if self.batches:
+            log.info("Loaded {0} batches with {1} measurements from the spool at {2}".format(
+                self.batches, self.measurements, self.directory))
+
+    def _scan(self, segment):
+        """Count the records of a segment, truncating a partially written tail."""
+        file_size = os.path.getsize(segment.path)
+        offset = 0
+        if file_size:
+            with open(segment.path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    while offset + _header.size <= file_size:
+                        body_len, count, tenant_len = _header.unpack_from(data, offset)
+                        record_len = _header.size + tenant_len + body_len
+                        if offset + record_len + _trailer.size > file_size:
+                            break
+                        if _trailer.unpack_from(data, offset + record_len)[0] != record_len:
+                            break
+                        offset += record_len + _trailer.size
+                        segment.batches += 1
+                        segment.measurements += count
+                finally:
+                    data.close()
+
+        if offset != file_size:
+            log.warn("Discarding {0} bytes of incomplete data at the end of {1}".format(
+                file_size - offset, segment.path))
+            with open(segment.path, 'r+b') as f:
+                f.truncate(offset)
+        segment.size = offset
+
+    def _segment_path(self, seg_id):
+        return os.path.join(self.directory, '%020d%s' % (seg_id, SEGMENT_SUFFIX))
+
+    def _close_active(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _active_segment(self, record_size, count):
+        """Return the segment to append to, starting a new one when the newest is full."""
+        if self._segments:
+            segment = self._segments[-1]
+            full = (segment.size + record_size > self.segment_size or
+                    (-1 < self.segment_max_batches <= segment.batches) or
+                    (-1 < self.segment_max_measurements < segment.measurements + count))
+            if not full or not segment.batches:
+                return segment
+
+        self._close_active()
+        seg_id = self._segments[-1].seg_id + 1 if self._segments else 0
+        segment = _Segment(seg_id, self._segment_path(seg_id))
+        self._segments.append(segment)
+        return segment
+
+    def append(self, batch):
+        """Store a (tenant, body, count) tuple holding a serialized batch of count measurements."""
+        tenant, body, count = batch
+        tenant_bytes = tenant.encode('utf-8') if tenant else b''
+        record_len = _header.size + len(tenant_bytes) + len(body)
+        segment = self._active_segment(record_len + _trailer.size, count)
+        if self._file is None:
+            self._file = open(segment.path, 'ab')
+
+        self._file.write(_header.pack(len(body), count, len(tenant_bytes)))
+        self._file.write(tenant_bytes)
+        self._file.write(body)
+        self._file.write(_trailer.pack(record_len))
+        self._file.flush()
+
+        segment.batches += 1
+        segment.measurements += count
+        segment.size += record_len + _trailer.size
+        self.batches += 1
+        self.measurements += count
+        self.size += record_len + _trailer.size
+
+    def pop(self):
+        """Remove and return the newest batch as a (tenant, body, count) tuple."""
+        if not self._segments:
+            raise IndexError('pop from an empty spool')
+
+        self._close_active()
+        segment = self._segments[-1]
+        with open(segment.path, 'r+b') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                end = segment.size - _trailer.size
+                record_len = _trailer.unpack_from(data, end)[0]
+                start = end - record_len
+                body_len, count, tenant_len = _header.unpack_from(data, start)
+                offset = start + _header.size
+                tenant = data[offset:offset + tenant_len].decode('utf-8') or None
+                offset += tenant_len
+                body = data[offset:offset + body_len]
+            finally:
+                data.close()
+            f.truncate(start)
+
+        segment.batches -= 1
+        segment.measurements -= count
+        segment.size = start
+        self.batches -= 1
+        self.measurements -= count
+        self.size -= record_len + _trailer.size
+        if not segment.batches:
+            self._remove_segment(segment)
+        return tenant, body, count
+
+    def evict_oldest(self):
+        """Drop the oldest segment, returning the number of batches and measurements discarded."""
+        if not self._segments:
+            return 0, 0
+
+        segment = self._segments[0]
+        if len(self._segments) == 1:
+            self._close_active()
+        self._remove_segment(segment)
+        self.batches -= segment.batches
+        self.measurements -= segment.measurements
+        self.size -= segment.size
+        return segment.batches, segment.measurements
+
+    def _remove_segment(self, segment):
+        self._segments.remove(segment)
+        try:
+            os.remove(segment.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def close(self):
+        self._close_active()
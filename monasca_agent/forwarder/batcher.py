@@ -0,0 +1,111 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+""" Collects the measurements received by the forwarder into per-tenant batches.
+"""
+import json
+import logging
+import time
+
+import monasca_agent.common.util as util
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_MEASUREMENTS = 5000
+DEFAULT_MAX_BYTES = 512 * 1024  # bytes
+DEFAULT_MAX_LINGER = 3000  # ms
+
+
+class _Batch(object):
+
+    def __init__(self, created):
+        self.created = created
+        self.parts = []
+        # the brackets around the JSON list
+        self.size = 2
+
+
+class Batcher(object):
+    """Groups measurements by tenant into serialized batches for the Monasca API.
+
+    Each measurement is serialized once when it is added, so the size of a batch
+    is known exactly. A batch is cut as soon as it holds max_measurements
+    measurements or the next measurement would make its body larger than
+    max_bytes. Batches which are not full are sent once they are max_linger ms
+    old. Batches are returned as (tenant, body, count) tuples.
+    """
+
+    def __init__(self, max_measurements=DEFAULT_MAX_MEASUREMENTS, max_bytes=DEFAULT_MAX_BYTES,
+                 max_linger=DEFAULT_MAX_LINGER):
+        self.max_measurements = int(max_measurements)
+        self.max_bytes = int(max_bytes)
+        self.max_linger = int(max_linger)
+        self._batches = {}
+        self._batch_sizes = []
+        self._batch_bytes = []
+
+    def add(self, envelopes, now=None):
+        """Add a list of measurement envelopes, returning the batches which are full."""
+        if now is None:
+            now = time.time()
+        ready = []
+        for envelope in envelopes:
+            measurement = envelope['measurement']
+            if isinstance(measurement['dimensions'], list):
+                measurement['dimensions'] = dict([(d[0], d[1]) for d in measurement['dimensions']])
+            part = json.dumps(measurement)
+            tenant = envelope['tenant_id']
+
+            batch = self._batches.get(tenant)
+            if batch is not None and batch.size + len(part) + 1 > self.max_bytes:
+                ready.append(self._cut(tenant))
+                batch = None
+            if batch is None:
+                if len(part) + 2 > self.max_bytes:
+                    log.warn("Measurement {0} is larger than max_batch_bytes ({1} bytes), "
+                             "sending it on its own".format(measurement['name'], len(part)))
+                batch = self._batches[tenant] = _Batch(now)
+            elif batch.parts:
+                batch.size += 1
+            batch.parts.append(part)
+            batch.size += len(part)
+
+            if len(batch.parts) >= self.max_measurements:
+                ready.append(self._cut(tenant))
+        return ready
+
+    def expired(self, now=None):
+        """Return the batches which are older than max_linger."""
+        if now is None:
+            now = time.time()
+        deadline = now - self.max_linger / 1000.0
+        return [self._cut(tenant) for tenant, batch in self._batches.items()
+                if batch.created <= deadline]
+
+    def flush(self):
+        """Return all batches, whatever their age or size."""
+        return [self._cut(tenant) for tenant in self._batches.keys()]
+
+    def __len__(self):
+        return sum(len(batch.parts) for batch in self._batches.itervalues())
+
+    def _cut(self, tenant):
+        batch = self._batches.pop(tenant)
+        self._batch_sizes.append(len(batch.parts))
+        self._batch_bytes.append(batch.size)
+        return tenant, '[' + ','.join(batch.parts) + ']', len(batch.parts)
+
+    def get_statistics(self):
+        """Return the distribution of the batch sizes since the previous call."""
+        statistics = {}
+        batch_sizes, self._batch_sizes = self._batch_sizes, []
+        batch_bytes, self._batch_bytes = self._batch_bytes, []
+        for name, values in (('batch_measurements', batch_sizes), ('batch_bytes', batch_bytes)):
+            if not values:
+                continue
+            values.sort()
+            prefix = 'monasca.agent.forwarder.' + name
+            statistics[prefix + '.count'] = len(values)
+            statistics[prefix + '.avg'] = float(sum(values)) / len(values)
+            statistics[prefix + '.max'] = values[-1]
+            statistics[prefix + '.median'] = util.percentile(values, 0.5)
+            statistics[prefix + '.95percentile'] = util.percentile(values, 0.95)
+        return statistics
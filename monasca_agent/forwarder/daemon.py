@@ -11,6 +11,7 @@ import logging
 import signal
 import socket
 import sys
+import time
 
 # set up logging before importing any other components
 import monasca_agent.common.util as util
@@ -22,57 +23,123 @@ os.umask(0o22)
 
 # Tornado
 import tornado.escape
+import tornado.gen
 import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
 import tornado.options
+import tornado.tcpserver
 import tornado.web
 
 # agent import
 import monasca_agent.common.config as cfg
+import monasca_agent.common.intake as intake
+import monasca_agent.common.metrics as metrics
 import monasca_agent.common.util as util
 import monasca_agent.forwarder.api.monasca_api as mon
+import monasca_agent.forwarder.batcher as batcher
 
 log = logging.getLogger('forwarder')
 
-# Max amount of iterations to wait to meet min batch size before flushing
-MAX_FLUSH_ATTEMPTS = 3
+# Batches older than max_batch_linger are looked for this many times per linger period
+LINGER_CHECKS = 4
 
-MIN_BATCH_SIZE = 200
-
-message_batch = []
-
-# In seconds
-FLUSH_INTERVAL = 1
+# Seconds the collector and statsd are asked to wait while the backlog is above its high water mark
+DEFAULT_RETRY_AFTER = 10
 
 
 class AgentInputHandler(tornado.web.RequestHandler):
     def post(self):
         """Read the message and add it to the batch.
-            Batch will be sent to Monasca API once the batch size or max wait time
-            has been reached. Whichever one first.
+            Batch will be sent to Monasca API once it is full or has waited
+            max_batch_linger ms. Whichever one first.
         """
-        global message_batch
-
+        retry_after = self.application.get_retry_after()
+        if retry_after:
+            self.application.refuse_measurements()
+            self.set_status(intake.STATUS_SERVICE_UNAVAILABLE)
+            self.set_header('Retry-After', str(retry_after))
+            return
         try:
             msg = tornado.escape.json_decode(self.request.body)
-            message_batch.extend(msg)
+            self.application.add_measurements(msg)
         except Exception:
             log.exception('Error parsing body of Agent Input')
             raise tornado.web.HTTPError(500)
 
 
+class StatusHandler(tornado.web.RequestHandler):
+    def get(self):
+        """Return the forwarder's queue state, counters and last reported statistics as JSON."""
+        self.write(self.application.get_status())
+
+
+class IntakeStreamServer(tornado.tcpserver.TCPServer):
+    """Accept measurements framed by monasca_agent.common.intake on a Unix domain socket.
+
+    This is the local alternative to /intake, it avoids building a HTTP request for
+    every payload and, with msgpack installed, the JSON encoding of the measurements.
+    """
+
+    def __init__(self, application):
+        super(IntakeStreamServer, self).__init__()
+        self.application = application
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        try:
+            while True:
+                header = yield stream.read_bytes(intake.HEADER.size)
+                try:
+                    length, encoding = intake.decode_header(header)
+                except intake.FrameError as e:
+                    # The rest of the stream can't be parsed any more
+                    log.error('Error parsing frame of Agent Input: {0}'.format(e))
+                    yield stream.write(intake.encode_status(intake.STATUS_BAD_REQUEST))
+                    stream.close()
+                    return
+                payload = yield stream.read_bytes(length)
+                retry_after = self.application.get_retry_after()
+                if retry_after:
+                    self.application.refuse_measurements()
+                    yield stream.write(intake.encode_status(intake.STATUS_SERVICE_UNAVAILABLE, retry_after))
+                    continue
+                try:
+                    self.application.add_measurements(intake.decode_payload(payload, encoding))
+                    status = intake.STATUS_ACCEPTED
+                except Exception:
+                    log.exception('Error parsing body of Agent Input')
+                    status = intake.STATUS_ERROR
+                yield stream.write(intake.encode_status(status))
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
 class Forwarder(tornado.web.Application):
     def __init__(self, port, agent_config, skip_ssl_validation=False,
                  use_simple_http_client=False):
 
-        self._unflushed_iterations = 0
         self._endpoint = mon.MonascaAPI(agent_config)
+        self.batcher = batcher.Batcher(agent_config.get('max_batch_measurements', batcher.DEFAULT_MAX_MEASUREMENTS),
+                                       agent_config.get('max_batch_bytes', batcher.DEFAULT_MAX_BYTES),
+                                       agent_config.get('max_batch_linger', batcher.DEFAULT_MAX_LINGER))
 
         self._ioloop = None
 
         self._port = int(port)
-        self._flush_interval = FLUSH_INTERVAL * 1000
+        self._socket_path = agent_config.get('listen_socket')
+        self._flush_interval = max(1, self.batcher.max_linger // LINGER_CHECKS)
+        self._statistics_interval = int(agent_config.get('check_freq', 15)) * 1000
+        self._dimensions = util.Dimensions(agent_config)
+        self._started = time.time()
+        self._intake_requests = 0
+        self._intake_measurements = 0
+        self._refused_requests = 0
+        self._last_report = {'timestamp': self._started, 'intake_requests': 0, 'intake_measurements': 0,
+                             'refused_requests': 0, 'statistics': {}}
+        self._retry_after = int(agent_config.get('backlog_retry_after', DEFAULT_RETRY_AFTER))
         self._non_local_traffic = agent_config.get("non_local_traffic", False)
 
         logging.getLogger().setLevel(agent_config.get('log_level', logging.INFO))
@@ -100,7 +167,8 @@ class Forwarder(tornado.web.Application):
 
     def _add_tornado_handlers(self):
         handlers = [
-            (r"/intake/?", AgentInputHandler)
+            (r"/intake/?", AgentInputHandler),
+            (r"/status/?", StatusHandler)
         ]
 
         settings = dict(
@@ -141,20 +209,84 @@ class Forwarder(tornado.web.Application):
 
         log.info("Listening on port %d" % self._port)
 
-    def _post_metrics(self):
-        global message_batch
-        self._endpoint.post_metrics(message_batch)
-        log.info("wrote {}".format(len(message_batch)))
-        message_batch = []
-        self._unflushed_iterations = 0
+    def _bind_unix_socket(self):
+        try:
+            unix_socket = tornado.netutil.bind_unix_socket(self._socket_path, mode=0o600)
+        except Exception:
+            log.exception("Unable to listen on %s. Forwarder is exiting.", self._socket_path)
+            sys.exit(1)
+        IntakeStreamServer(self).add_socket(unix_socket)
+        log.info("Listening on %s" % self._socket_path)
+
+    def _post_batches(self, batches):
+        for tenant, body, count in batches:
+            self._endpoint.post_batch(tenant, body, count)
+            log.debug("wrote {0} measurements for tenant {1}".format(count, tenant))
+
+    def add_measurements(self, measurements):
+        """Batch the measurements of one intake request."""
+        self._intake_requests += 1
+        self._intake_measurements += len(measurements)
+        self._post_batches(self.batcher.add(measurements))
+
+    def get_retry_after(self):
+        """Return the seconds to wait before sending more measurements, 0 if they are accepted."""
+        if self._endpoint.is_backlogged():
+            return self._retry_after
+        return 0
+
+    def refuse_measurements(self):
+        self._refused_requests += 1
+
+    def _get_intake_statistics(self, timestamp):
+        elapsed = max(timestamp - self._last_report['timestamp'], 0.001)
+        return {'monasca.agent.forwarder.intake_requests_sec':
+                (self._intake_requests - self._last_report['intake_requests']) / elapsed,
+                'monasca.agent.forwarder.intake_measurements_sec':
+                (self._intake_measurements - self._last_report['intake_measurements']) / elapsed,
+                'monasca.agent.forwarder.intake_refused_requests':
+                self._refused_requests - self._last_report['refused_requests'],
+                'monasca.agent.forwarder.pending_measurements': len(self.batcher)}
+
+    def publish_statistics(self):
+        """Add the forwarder's own metrics to the next batch."""
+        timestamp = time.time()
+        dimensions = self._dimensions._set_dimensions({'component': 'monasca-agent',
+                                                       'service': 'monitoring'})
+        statistics = self._get_intake_statistics(timestamp)
+        statistics.update(self._endpoint.get_statistics())
+        statistics.update(self.batcher.get_statistics())
+        self._last_report = {'timestamp': timestamp,
+                             'intake_requests': self._intake_requests,
+                             'intake_measurements': self._intake_measurements,
+                             'refused_requests': self._refused_requests,
+                             'statistics': statistics}
+        # Added to the batcher directly so they are not counted as intake
+        measurements = [metrics.Metric(name, dimensions, tenant=None).measurement(value, timestamp)
+                        for name, value in statistics.iteritems()]
+        self._post_batches(self.batcher.add(measurements))
+
+    def get_status(self):
+        """Return the current queue state, the counters since the start and the last reported statistics."""
+        queue = self._endpoint.get_queue_status()
+        queue['monasca.agent.forwarder.pending_measurements'] = len(self.batcher)
+        return {'timestamp': time.time(),
+                'started': self._started,
+                'queue': queue,
+                'totals': {'intake_requests': self._intake_requests,
+                           'intake_measurements': self._intake_measurements,
+                           'refused_requests': self._refused_requests,
+                           'discarded_batches': self._endpoint.discarded_batches_total,
+                           'discarded_measurements': self._endpoint.discarded_measurements_total},
+                'last_report': {'timestamp': self._last_report['timestamp'],
+                                'statistics': self._last_report['statistics']}}
 
     def flush(self):
-        if not message_batch:
-            return
-        if len(message_batch) >= MIN_BATCH_SIZE or self._unflushed_iterations >= MAX_FLUSH_ATTEMPTS:
-            self._post_metrics()
-        else:
-            self._unflushed_iterations += 1
+        self._post_batches(self.batcher.expired())
+        if self._endpoint.is_backlogged():
+            # Nothing new is accepted, so the backlog would otherwise only be sent along with
+            # the forwarder's own metrics
+            self._endpoint.drain_backlog()
 
     def run(self):
         log.info("Forwarder RUN")
@@ -162,6 +294,8 @@ class Forwarder(tornado.web.Application):
 
         http_server = tornado.httpserver.HTTPServer(self)
         self._bind_http_server(http_server)
+        if self._socket_path:
+            self._bind_unix_socket()
 
         self._ioloop = util.get_tornado_ioloop()
 
@@ -171,8 +305,15 @@ class Forwarder(tornado.web.Application):
 
         callback.start()
 
+        statistics_callback = tornado.ioloop.PeriodicCallback(self.publish_statistics,
+                                                              self._statistics_interval,
+                                                              io_loop=self._ioloop)
+        statistics_callback.start()
+
         self._ioloop.start()
 
+        self._post_batches(self.batcher.flush())
+        self._endpoint.stop()
         log.info("Stopped")
 
     def stop(self):
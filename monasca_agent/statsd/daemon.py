@@ -13,6 +13,7 @@ import monasca_agent.common.config as cfg
 
 import monasca_agent.statsd.reporter as reporter
 import monasca_agent.statsd.udp as udp
+import monasca_agent.statsd.workers as workers
 
 
 # stdlib
@@ -35,9 +36,31 @@ class MonascaStatsd(object):
         statsd_config = config.get_config(['Main', 'Statsd'])
 
         # Create the aggregator (which is the point of communication between the server and reporting threads.
-        aggregator = agg.MetricsAggregator(util.get_hostname(),
-                                           recent_point_threshold=statsd_config['recent_point_threshold'],
-                                           tenant_id=statsd_config.get('global_delegated_tenant', None))
+        aggregator = agg.ShardedMetricsAggregator(util.get_hostname(),
+                                                  recent_point_threshold=statsd_config['recent_point_threshold'],
+                                                  tenant_id=statsd_config.get('global_delegated_tenant', None),
+                                                  series_ttl=statsd_config['series_ttl'],
+                                                  max_series=statsd_config['max_series'],
+                                                  rules=statsd_config['aggregation_rules'])
+
+        # Start the server on an IPv4 stack
+        if statsd_config['non_local_traffic']:
+            server_host = ''
+        else:
+            server_host = 'localhost'
+
+        server_args = (aggregator, server_host, statsd_config['monasca_statsd_port'])
+        server_kwargs = {'forward_to_host': statsd_config.get('monasca_statsd_forward_host'),
+                         'forward_to_port': int(statsd_config.get('monasca_statsd_forward_port')),
+                         'histogram_percentiles': statsd_config['monasca_statsd_percentiles'],
+                         'receive_buffer': statsd_config['monasca_statsd_receive_buffer'],
+                         'tcp_port': statsd_config['monasca_statsd_tcp_port'],
+                         'unix_socket': statsd_config['monasca_statsd_unix_socket'],
+                         'unix_socket_type': statsd_config['monasca_statsd_unix_socket_type']}
+        if int(statsd_config['monasca_statsd_workers']) > 1:
+            self.server = workers.WorkerPool(statsd_config['monasca_statsd_workers'], *server_args, **server_kwargs)
+        else:
+            self.server = udp.Server(*server_args, **server_kwargs)
 
         # Start the reporting thread.
         interval = int(statsd_config['monasca_statsd_interval'])
@@ -46,17 +69,8 @@ class MonascaStatsd(object):
         self.reporter = reporter.Reporter(interval,
                                           aggregator,
                                           statsd_config['forwarder_url'],
-                                          statsd_config.get('event_chunk_size'))
-
-        # Start the server on an IPv4 stack
-        if statsd_config['non_local_traffic']:
-            server_host = ''
-        else:
-            server_host = 'localhost'
-
-        self.server = udp.Server(aggregator, server_host, statsd_config['monasca_statsd_port'],
-                                 forward_to_host=statsd_config.get('monasca_statsd_forward_host'),
-                                 forward_to_port=int(statsd_config.get('monasca_statsd_forward_port')))
+                                          statsd_config.get('event_chunk_size'),
+                                          receiver=self.server)
 
     def _handle_sigterm(self, signum, frame):
         log.debug("Caught sigterm. Stopping run loop.")
@@ -69,6 +83,10 @@ class MonascaStatsd(object):
         # Handle Keyboard Interrupt
         signal.signal(signal.SIGINT, self._handle_sigterm)
 
+        # The workers are forked before any thread is started
+        if isinstance(self.server, workers.WorkerPool):
+            self.server.start_workers()
+
         # Start the reporting thread before accepting data
         self.reporter.start()
 
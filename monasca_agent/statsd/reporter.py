@@ -4,7 +4,9 @@ import json
 import logging
 import threading
 
+import monasca_agent.common.aggregator as agg
 import monasca_agent.common.emitter as emitter
+import monasca_agent.common.metrics as metrics
 import monasca_agent.common.util as util
 
 log = logging.getLogger(__name__)
@@ -16,6 +18,7 @@ FLUSH_LOGGING_PERIOD = 70
 FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
+SELF_METRIC_DIMENSIONS = {'component': 'monasca-agent', 'service': 'monitoring', 'process': 'monasca-statsd'}
 
 
 class Reporter(threading.Thread):
@@ -23,7 +26,7 @@ class Reporter(threading.Thread):
     server.
     """
 
-    def __init__(self, interval, aggregator, api_host, event_chunk_size=None):
+    def __init__(self, interval, aggregator, api_host, event_chunk_size=None, receiver=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
@@ -32,11 +35,14 @@ class Reporter(threading.Thread):
         self.log_count = 0
 
         self.api_host = api_host
+        self.emitter = emitter.get_emitter(api_host)
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        # The udp.Server or workers.WorkerPool whose samples and statistics are collected on flush
+        self.receiver = receiver
 
     @staticmethod
-    def serialize_metrics(metrics):
-        return json.dumps({"series": metrics})
+    def serialize_metrics(measurements):
+        return json.dumps({"series": measurements})
 
     def stop(self):
         log.info("Stopping reporter")
@@ -54,19 +60,40 @@ class Reporter(threading.Thread):
         log.debug("Stopped reporter")
 
     def flush(self):
+        if self.emitter.paused():
+            # The aggregator keeps summing counters and updating gauges until the forwarder accepts data again
+            log.debug("Forwarder is backlogged, skipping flush")
+            return
         try:
             self.flush_count += 1
             self.log_count += 1
 
-            metrics = self.aggregator.flush()
-            count = len(metrics)
-            if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
-                self.log_count = 0
-            if count:
+            # Connection statistics of the emitter, validation cache hit rates and series
+            # evicted or discarded by the aggregator since the previous flush
+            if self.receiver is not None:
+                # Packets received and dropped by the server or by each worker, whose samples
+                # are added to the aggregator
+                for dimensions, receiver_statistics in self.receiver.collect(self.aggregator):
+                    receiver_dimensions = dict(SELF_METRIC_DIMENSIONS, **dimensions)
+                    for name, value in receiver_statistics.iteritems():
+                        self.aggregator.submit_metric(name, value, metrics.Gauge, dimensions=receiver_dimensions)
+
+            statistics = self.emitter.get_statistics()
+            statistics.update(agg.get_validation_cache_statistics())
+            statistics.update(self.aggregator.get_statistics())
+            for name, value in statistics.iteritems():
+                self.aggregator.submit_metric(name, value, metrics.Gauge, dimensions=SELF_METRIC_DIMENSIONS)
+
+            # The measurements are sent as JSON lists encoded straight from the aggregated series
+            count = 0
+            for chunk_count, payload in self.aggregator.flush_encoded():
+                count += chunk_count
                 try:
-                    emitter.http_emitter(metrics, log, self.api_host)
+                    self.emitter.send(payload, log)
                 except Exception:
                     log.exception("Error running emitter.")
+            if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
+                self.log_count = 0
 
             should_log = self.flush_count <= FLUSH_LOGGING_INITIAL or self.log_count <= FLUSH_LOGGING_COUNT
             log_func = log.info
@@ -1,9 +1,15 @@
 # (C) Copyright 2015,2016 Hewlett Packard Enterprise Development LP
 
 import ast
+import ctypes
+import errno
+import functools
 import logging
+import os
+import re
 import select
 import socket
+import stat
 
 import monasca_agent.common.metrics as metrics_pkg
 
@@ -11,25 +17,246 @@ log = logging.getLogger(__name__)
 
 
 UDP_SOCKET_TIMEOUT = 5
+# Not defined by the socket module of Python 2, this is the value of Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# Datagrams read with one recvmmsg call, and at most on each wakeup of the select loop
+RECEIVE_BATCH = 64
+MAX_DATAGRAMS_PER_WAKEUP = 1024
+MSG_DONTWAIT = 0x40
+# Bytes read from a stream connection at once, and the longest line accepted from it
+STREAM_READ_SIZE = 65536
+MAX_LINE_LENGTH = 65536
+LISTEN_BACKLOG = 128
+# Unix datagrams are not limited to the size of UDP datagrams
+UNIX_DATAGRAM_SIZE = 65536
+UNIX_RECEIVE_BATCH = 8
 
 metric_class = {
     'g': metrics_pkg.Gauge,
     'c': metrics_pkg.Counter,
     'r': metrics_pkg.Rate,
-    'ms': metrics_pkg.Gauge,
-    'h': metrics_pkg.Gauge
+    's': metrics_pkg.Set,
+    'ms': metrics_pkg.Histogram,
+    'h': metrics_pkg.Histogram
 }
 
 
+# Number of distinct dimensions of packets whose parsed dimensions are remembered
+TAG_CACHE_SIZE = 1000
+# One "key": "value" item of Monasca dimensions, quoted with ' or " and without escapes.
+# Other dict literals are evaluated by ast.literal_eval.
+_MONASCA_DIMENSION = re.compile(r'''[ \t]*(?:"([^"\\]*)"|'([^'\\]*)')[ \t]*:[ \t]*'''
+                                r'''(?:"([^"\\]*)"|'([^'\\]*)')[ \t]*([,}])''')
+_tag_cache = {}
+
+
+def parse_dimensions(tags):
+    """Return the dimensions of the tags of a packet, the text after its #.
+
+    The tags are either Monasca dimensions, a dict literal like {"service": "api"},
+    or DogStatsd tags like service:api,canary. The dimensions of recent tags are
+    remembered and shared by their packets, so they must not be modified.
+    """
+    try:
+        return _tag_cache[tags]
+    except KeyError:
+        pass
+    if tags[:1] == '{':
+        dimensions = _parse_monasca_dimensions(tags)
+    else:
+        dimensions = _parse_dogstatsd_tags(tags)
+    if len(_tag_cache) >= TAG_CACHE_SIZE:
+        _tag_cache.clear()
+    _tag_cache[tags] = dimensions
+    return dimensions
+
+
+def _parse_monasca_dimensions(tags):
+    try:
+        return _match_monasca_dimensions(tags)
+    except ValueError:
+        pass
+    # escapes, u prefixes, trailing commas and the other forms of a Python dict literal
+    try:
+        dimensions = ast.literal_eval(tags)
+    except (ValueError, SyntaxError, MemoryError, RuntimeError):
+        # RuntimeError and MemoryError are raised for deeply nested literals
+        raise ValueError('Invalid dimensions: {0}'.format(tags))
+    # dimensions are a flat dict of strings
+    if not isinstance(dimensions, dict):
+        raise ValueError('Invalid dimensions: {0}'.format(tags))
+    for key, value in dimensions.iteritems():
+        if not isinstance(key, basestring) or not isinstance(value, basestring):
+            raise ValueError('Invalid dimensions: {0}'.format(tags))
+    return dimensions
+
+
+def _match_monasca_dimensions(tags):
+    dimensions = {}
+    if tags[1:].strip(' \t') == '}':
+        return dimensions
+    position = 1
+    while True:
+        match = _MONASCA_DIMENSION.match(tags, position)
+        if match is None:
+            raise ValueError('Invalid dimensions: {0}'.format(tags))
+        key, quoted_key, value, quoted_value, separator = match.groups()
+        if key is None:
+            key = quoted_key
+        if value is None:
+            value = quoted_value
+        dimensions[key] = value
+        position = match.end()
+        if separator == '}':
+            if tags[position:].strip(' \t'):
+                raise ValueError('Invalid dimensions: {0}'.format(tags))
+            return dimensions
+
+
+def _parse_dogstatsd_tags(tags):
+    dimensions = {}
+    for tag in tags.split(','):
+        key, separator, value = tag.partition(':')
+        key = key.strip()
+        if not key:
+            continue
+        if separator:
+            dimensions[key] = value.strip() or '?'
+        else:
+            # handle tags w/o value
+            dimensions[key] = 'True'
+    return dimensions
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+try:
+    _recvmmsg = ctypes.CDLL(None, use_errno=True).recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+except (OSError, AttributeError):
+    # not Linux, or a C library older than glibc 2.12
+    _recvmmsg = None
+
+
+class DatagramReader(object):
+    """Reads the datagrams waiting on a non-blocking socket.
+
+    read() returns every datagram waiting, up to MAX_DATAGRAMS_PER_WAKEUP. Where
+    the C library has recvmmsg, batch datagrams are read by one system call into
+    a buffer allocated once, otherwise recv is called until the socket has no
+    more datagrams. Datagrams longer than buffer_size are truncated.
+    """
+
+    def __init__(self, sock, buffer_size, batch=RECEIVE_BATCH):
+        self.socket = sock
+        self.buffer_size = buffer_size
+        self.batch = batch
+        if _recvmmsg is not None and batch > 1:
+            self._buffer = ctypes.create_string_buffer(buffer_size * batch)
+            self._address = ctypes.addressof(self._buffer)
+            self._iovecs = (_IOVec * batch)()
+            self._messages = (_MMsgHdr * batch)()
+            for i in range(batch):
+                self._iovecs[i].iov_base = self._address + i * buffer_size
+                self._iovecs[i].iov_len = buffer_size
+                self._messages[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+                self._messages[i].msg_hdr.msg_iovlen = 1
+            self.read = self._read_batches
+        else:
+            self.read = self._read_each
+
+    def _read_batches(self):
+        datagrams = []
+        fd = self.socket.fileno()
+        messages = self._messages
+        batch = self.batch
+        address = self._address
+        buffer_size = self.buffer_size
+        string_at = ctypes.string_at
+        while len(datagrams) < MAX_DATAGRAMS_PER_WAKEUP:
+            received = _recvmmsg(fd, messages, batch, MSG_DONTWAIT, None)
+            if received < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK) or datagrams:
+                    break
+                raise socket.error(error, os.strerror(error))
+            for i in xrange(received):
+                datagrams.append(string_at(address + i * buffer_size, messages[i].msg_len))
+            if received < batch:
+                break
+        return datagrams
+
+    def _read_each(self):
+        datagrams = []
+        recv = self.socket.recv
+        buffer_size = self.buffer_size
+        while len(datagrams) < MAX_DATAGRAMS_PER_WAKEUP:
+            try:
+                datagrams.append(recv(buffer_size))
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) or datagrams:
+                    break
+                raise
+        return datagrams
+
+
 class Server(object):
     """A statsd udp server."""
 
-    def __init__(self, aggregator, host, port, forward_to_host=None, forward_to_port=None):
+    def __init__(self, aggregator, host, port, forward_to_host=None, forward_to_port=None,
+                 histogram_percentiles=None, reuse_port=False, receive_buffer=None, receive_batch=RECEIVE_BATCH,
+                 tcp_port=None, unix_socket=None, unix_socket_type='dgram'):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.aggregator = aggregator
         self.buffer_size = 1024 * 8
+        # Lets several processes bind the same port, the kernel spreads the datagrams over them
+        self.reuse_port = reuse_port
+        # Size of the socket receive buffer in bytes, None for the default of the kernel
+        self.receive_buffer = receive_buffer
+        self.receive_batch = receive_batch
+        self.socket = None
+        # Newline separated packets are also accepted over TCP connections to tcp_port, and
+        # over a Unix socket at the path unix_socket, of type dgram or stream
+        self.tcp_port = tcp_port
+        self.unix_socket = unix_socket
+        self.unix_socket_type = unix_socket_type
+        self.listeners = []
+        # Received data of the stream connections after their last newline
+        self.stream_buffers = {}
+        # Other files read by the select loop, with the function to call when they are readable
+        self.readers = {}
+        self.packets = 0
+        self.kernel_drops = 0
+
+        self.metric_class = metric_class
+        if histogram_percentiles:
+            histogram = metrics_pkg.histogram_class(histogram_percentiles)
+            self.metric_class = dict(metric_class, ms=histogram, h=histogram)
 
         self.running = False
 
@@ -58,26 +285,24 @@ class Server(object):
         dimensions = {}
         for metadata in parts[3:]:
             if metadata.startswith('#'):
-                dimensions = Server._parse_dogstatsd_tags(metadata)
+                dimensions = parse_dimensions(metadata[1:])
 
         return name, status, dimensions
 
     @staticmethod
     def _parse_metric_packet(packet):
-        name_and_metadata = packet.split(':', 1)
-
-        if len(name_and_metadata) != 2:
+        # <name>:<value>|<type>[|@<sample rate>][|#<dimensions>]
+        name, separator, metadata = packet.partition(':')
+        type_start = metadata.find('|')
+        if not separator or type_start < 0:
             raise Exception('Unparseable metric packet: %s' % packet)
 
-        name = name_and_metadata[0]
-        metadata = name_and_metadata[1].split('|')
-
-        if len(metadata) < 2:
-            raise Exception('Unparseable metric packet: %s' % packet)
-
-        # Submit the metric
-        raw_value = metadata[0]
-        metric_type = metadata[1]
+        raw_value = metadata[:type_start]
+        type_end = metadata.find('|', type_start + 1)
+        if type_end < 0:
+            metric_type = metadata[type_start + 1:]
+        else:
+            metric_type = metadata[type_start + 1:type_end]
 
         if metric_type == 's':
             value = raw_value
@@ -96,54 +321,18 @@ class Server(object):
         # Parse the optional values - sample rate & dimensions.
         sample_rate = 1
         dimensions = {}
-        for m in metadata[2:]:
-            # Parse the sample rate
-            if m[0] == '@':
-                sample_rate = float(m[1:])
-                assert 0 <= sample_rate <= 1
-            # Parse dimensions, supporting both Monasca and DogStatsd extensions
-            elif m[0] == '#' and len(m) > 2:
-                if m[1] == '{':
-                    dimensions = Server._parse_monasca_statsd_dims(m[1:])
-                else:
-                    dimensions = Server._parse_dogstatsd_tags(m[1:])
+        if type_end >= 0:
+            for m in metadata[type_end + 1:].split('|'):
+                # Parse the sample rate
+                if m[0] == '@':
+                    sample_rate = float(m[1:])
+                    assert 0 <= sample_rate <= 1
+                # Parse dimensions, supporting both Monasca and DogStatsd extensions
+                elif m[0] == '#' and len(m) > 2:
+                    dimensions = parse_dimensions(m[1:])
 
         return name, value, metric_type, dimensions, sample_rate
 
-    @staticmethod
-    def _parse_monasca_statsd_dims(dimensions):
-        dimensions = ast.literal_eval(dimensions)
-        return dimensions
-
-    @staticmethod
-    def _parse_dogstatsd_tags(statsd_msg):
-        dimensions = {}
-        s = ''
-        key = ''
-        for c in statsd_msg[1:]:
-            if c == ':':
-                key = s.strip()
-                s = ''
-            elif c == ',':
-                s = s.strip()
-                if len(key) > 0:
-                    if len(s) > 0:
-                        dimensions[key] = s
-                    else:
-                        dimensions[key] = '?'
-                elif len(s) > 0:
-                    # handle tags w/o value
-                    dimensions[s] = "True"
-                key = ''
-                s = ''
-            else:
-                s += c
-        s = s.strip()
-        if len(s) > 0 and len(key) > 0:
-            dimensions[key] = s
-
-        return dimensions
-
     def submit_packets(self, packets):
         for packet in packets.split("\n"):
 
@@ -161,22 +350,49 @@ class Server(object):
             else:
                 name, value, mtype, dimensions, sample_rate = self._parse_metric_packet(packet)
 
-            if mtype not in metric_class:
+            if mtype not in self.metric_class:
                 log.warn("metric type {} not supported.".format(mtype))
                 continue
 
             self.aggregator.submit_metric(name,
                                           value,
-                                          metric_class[mtype],
+                                          self.metric_class[mtype],
                                           dimensions=dimensions,
                                           sample_rate=sample_rate)
 
-    def start(self):
-        """Run the server."""
-        # Bind to the UDP socket.
+    def get_statistics(self):
+        """Return the datagrams received, and dropped by the kernel because the socket buffer was full,
+        since the previous call.
+        """
+        statistics = {'monasca.agent.statsd.packets': self.packets}
+        self.packets = 0
+        drops = kernel_drops(self.socket) if self.socket is not None else None
+        if drops is not None:
+            statistics['monasca.agent.statsd.kernel_drops'] = drops - self.kernel_drops
+            self.kernel_drops = drops
+        return statistics
+
+    def collect(self, aggregator):
+        """Return the statistics of the server with their dimensions, like WorkerPool.collect().
+
+        The server submits its samples to the aggregator itself.
+        """
+        return [({}, self.get_statistics())]
+
+    def bind(self):
+        """Create the socket of the server."""
         # IPv4 only
         open_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         open_socket.setblocking(0)
+        if self.reuse_port:
+            open_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.receive_buffer:
+            open_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.receive_buffer))
+            # Linux reports twice the size set, for its bookkeeping
+            size = open_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+            if size < int(self.receive_buffer):
+                log.warning("The receive buffer is {0} bytes instead of {1}, raise net.core.rmem_max to allow "
+                            "more".format(size, self.receive_buffer))
         try:
             open_socket.bind(self.address)
         except socket.gaierror:
@@ -187,11 +403,130 @@ class Server(object):
                 open_socket.bind(self.address)
 
         log.info('Listening on host & port: %s' % str(self.address))
+        self.socket = open_socket
+        self.kernel_drops = 0
+
+        if self.tcp_port:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.address[0], int(self.tcp_port)))
+            self._listen(listener)
+            log.info('Listening on TCP host & port: {0}'.format(listener.getsockname()))
+        if self.unix_socket:
+            # a socket left behind by a previous run
+            if os.path.exists(self.unix_socket) and stat.S_ISSOCK(os.stat(self.unix_socket).st_mode):
+                os.unlink(self.unix_socket)
+            if self.unix_socket_type == 'stream':
+                listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                listener.bind(self.unix_socket)
+                self._listen(listener)
+            else:
+                listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                listener.setblocking(0)
+                listener.bind(self.unix_socket)
+                self.listeners.append(listener)
+                reader = DatagramReader(listener, UNIX_DATAGRAM_SIZE, min(self.receive_batch, UNIX_RECEIVE_BATCH))
+                self.readers[listener] = functools.partial(self._receive_datagrams, reader)
+            log.info('Listening on Unix {0} socket: {1}'.format(self.unix_socket_type, self.unix_socket))
+
+    def _listen(self, listener):
+        listener.setblocking(0)
+        listener.listen(LISTEN_BACKLOG)
+        self.listeners.append(listener)
+        self.readers[listener] = functools.partial(self._accept, listener)
+
+    def _accept(self, listener):
+        try:
+            connection, _ = listener.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        connection.setblocking(0)
+        self.stream_buffers[connection] = ''
+        self.readers[connection] = functools.partial(self._receive_stream, connection)
+
+    def _receive_datagrams(self, reader):
+        messages = reader.read()
+        self.packets += len(messages)
+        for message in messages:
+            try:
+                self.submit_packets(message)
+            except Exception:
+                log.exception('Error receiving datagram')
+
+    def _receive_stream(self, connection):
+        try:
+            data = connection.recv(STREAM_READ_SIZE)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            log.warning('Error reading statsd connection: {0}'.format(e))
+            data = ''
+        # None while the rest of a line longer than MAX_LINE_LENGTH is discarded
+        buffered = self.stream_buffers[connection]
+        if not data:
+            # closed, what was sent after the last newline is a last packet
+            self._close_stream(connection)
+            lines = buffered or ''
+        else:
+            if buffered is None:
+                start = data.find('\n')
+                if start < 0:
+                    return
+                data = data[start + 1:]
+                buffered = ''
+            end = data.rfind('\n')
+            if end < 0:
+                buffered += data
+                if len(buffered) > MAX_LINE_LENGTH:
+                    log.warning('Discarding a statsd line longer than {0} bytes'.format(MAX_LINE_LENGTH))
+                    buffered = None
+                self.stream_buffers[connection] = buffered
+                return
+            lines = buffered + data[:end]
+            self.stream_buffers[connection] = data[end + 1:]
+        # a bad line of the connection is skipped like a bad packet
+        for line in lines.split('\n'):
+            if not line:
+                continue
+            # each line of a connection counts as a packet, however the stream was segmented
+            self.packets += 1
+            try:
+                self.submit_packets(line)
+            except Exception:
+                log.exception('Error receiving statsd line')
+
+    def _close_stream(self, connection):
+        del self.readers[connection]
+        del self.stream_buffers[connection]
+        connection.close()
+
+    def close(self):
+        """Close the sockets of the server, once it has stopped."""
+        for connection in self.stream_buffers.keys():
+            self._close_stream(connection)
+        for listener in self.listeners:
+            del self.readers[listener]
+            listener.close()
+        self.listeners = []
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def start(self):
+        """Run the server."""
+        # Bind to the UDP socket.
+        if self.socket is None:
+            self.bind()
+        open_socket = self.socket
 
         # Inline variables for quick look-up.
-        buffer_size = self.buffer_size
-        sock = [open_socket]
-        socket_recv = open_socket.recv
+        read = DatagramReader(open_socket, self.buffer_size, self.receive_batch).read
+        readers = self.readers
+        submit_packets = self.submit_packets
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
@@ -202,13 +537,24 @@ class Server(object):
         self.running = True
         while self.running:
             try:
+                # stream connections come and go
+                sock = [open_socket]
+                sock.extend(readers)
                 ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    self.submit_packets(message)
-
-                    if should_forward:
-                        forward_udp_sock.send(message)
+                for readable in ready[0]:
+                    if readable is not open_socket:
+                        readers[readable]()
+                        continue
+                    messages = read()
+                    self.packets += len(messages)
+                    for message in messages:
+                        try:
+                            submit_packets(message)
+                        except Exception:
+                            log.exception('Error receiving datagram')
+
+                        if should_forward:
+                            forward_udp_sock.send(message)
             except select_error as se:
                 # Ignore interrupted system calls from sigterm.
                 errno = se[0]
@@ -219,5 +565,27 @@ class Server(object):
             except Exception:
                 log.exception('Error receiving datagram')
 
+        self.close()
+
     def stop(self):
         self.running = False
+
+
+def kernel_drops(sock):
+    """Return the number of datagrams the kernel dropped for a UDP socket, None when unknown.
+
+    The count is read from the line of the socket in /proc/net/udp, found by the inode of the socket.
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except IOError:
+            continue
+        for line in lines[1:]:
+            fields = line.split()
+            # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+            if len(fields) >= 13 and fields[9] == inode:
+                return int(fields[12])
+    return None
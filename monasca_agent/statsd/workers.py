@@ -0,0 +1,195 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+""" Statsd worker processes which share the port of the server.
+
+Each worker binds the port with SO_REUSEPORT, so the kernel spreads the
+datagrams over the workers, and parses and aggregates them in its own
+process. On each flush the reporter collects the samples of every worker and
+adds them to its aggregator, which merges them into the series. A worker which
+exits is started again.
+"""
+import logging
+import multiprocessing
+import signal
+import threading
+
+import monasca_agent.common.aggregator as agg
+import monasca_agent.statsd.udp as udp
+
+log = logging.getLogger(__name__)
+
+# Seconds the reporter waits for the samples of a worker
+COLLECT_TIMEOUT = 10
+# Seconds a worker has to stop before it is terminated
+STOP_TIMEOUT = 5
+
+
+def _start_process(process):
+    """Start a process while this thread holds the logging locks.
+
+    A lock held by another thread when the process is forked stays locked in
+    the child, which would hang on its first log message.
+    """
+    handlers = [handler for handler in (ref() for ref in logging._handlerList) if handler is not None]
+    logging._acquireLock()
+    try:
+        for handler in handlers:
+            handler.acquire()
+        try:
+            process.start()
+        finally:
+            for handler in reversed(handlers):
+                handler.release()
+    finally:
+        logging._releaseLock()
+
+
+class Worker(multiprocessing.Process):
+    """A statsd server process, whose samples are requested over a pipe."""
+
+    def __init__(self, index, connection, aggregator, host, port, **server_kwargs):
+        super(Worker, self).__init__(name='monasca-statsd-worker-{0}'.format(index))
+        self.daemon = True
+        self.connection = connection
+        # The samples are aggregated in the worker like in the aggregator of the reporter
+        self.aggregator_args = (aggregator.hostname, aggregator.recent_point_threshold,
+                                aggregator.global_delegated_tenant)
+        # max_series bounds the samples a worker buffers between two collects as well
+        self.max_series = aggregator.max_series
+        self.server_args = (host, port)
+        # The keyword arguments of udp.Server
+        self.server_kwargs = server_kwargs
+        self.server = None
+        self.aggregator = None
+
+    def run(self):
+        # The pool stops the workers, a terminal interrupt is handled by the main process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        self.aggregator = agg.ShardedMetricsAggregator(*self.aggregator_args, max_series=self.max_series,
+                                                       shards=1)
+        self.server = udp.Server(self.aggregator, *self.server_args, reuse_port=True, **self.server_kwargs)
+        self.server.readers[self.connection] = self._handle_request
+        self.server.start()
+
+    def _handle_request(self):
+        try:
+            request = self.connection.recv()
+        except EOFError:
+            request = None
+        if request is None:
+            self.server.stop()
+            return
+        samples, count = self.aggregator.take_samples()
+        statistics = self.server.get_statistics()
+        statistics['monasca.agent.aggregator.capped_points'] = self.aggregator.get_statistics()[
+            'monasca.agent.aggregator.capped_points']
+        self.connection.send((samples, count, statistics))
+
+
+class WorkerPool(object):
+    """Statsd server of several worker processes, used like udp.Server, whose keyword arguments it takes."""
+
+    def __init__(self, workers, aggregator, host, port, **server_kwargs):
+        self.aggregator = aggregator
+        self.worker_args = (aggregator, host, port)
+        self.server_kwargs = server_kwargs
+        self.size = int(workers)
+        self.workers = []
+        self.running = False
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        # Connections of the workers whose reply to a collect request has not been read yet
+        self._awaiting = set()
+
+    def start_workers(self):
+        """Fork the workers, which is best done before the process starts any thread."""
+        with self._lock:
+            if self.workers:
+                return
+            for index in range(self.size):
+                self.workers.append(self._start_worker(index))
+        log.info('Started {0} statsd workers'.format(self.size))
+
+    def _start_worker(self, index):
+        connection, worker_connection = multiprocessing.Pipe()
+        server_kwargs = self.server_kwargs
+        if index > 0:
+            # the TCP and Unix socket connections are handled by the first worker
+            server_kwargs = dict(server_kwargs, tcp_port=None, unix_socket=None)
+        worker = Worker(index, worker_connection, *self.worker_args, **server_kwargs)
+        _start_process(worker)
+        worker_connection.close()
+        return worker, connection
+
+    def _restart_exited_workers(self):
+        with self._lock:
+            for index, (worker, connection) in enumerate(self.workers):
+                if not worker.is_alive():
+                    log.error('Statsd worker {0} exited with code {1}, starting it again'.format(worker.name,
+                                                                                                 worker.exitcode))
+                    connection.close()
+                    self._awaiting.discard(connection)
+                    self.workers[index] = self._start_worker(index)
+
+    def start(self):
+        """Start the workers, unless start_workers() did already, and run until stop() is called."""
+        self.start_workers()
+
+        self.running = True
+        while self.running:
+            self._stopped.wait(udp.UDP_SOCKET_TIMEOUT)
+            if self.running:
+                self._restart_exited_workers()
+
+        with self._lock:
+            for worker, connection in self.workers:
+                try:
+                    connection.send(None)
+                except IOError:
+                    pass
+            for worker, connection in self.workers:
+                worker.join(STOP_TIMEOUT)
+                if worker.is_alive():
+                    log.warning('Terminating statsd worker {0}'.format(worker.name))
+                    worker.terminate()
+                connection.close()
+            self.workers = []
+            self._awaiting.clear()
+
+    def stop(self):
+        self.running = False
+        self._stopped.set()
+
+    def collect(self, aggregator):
+        """Add the samples of the workers to the aggregator and return the statistics of each worker
+        with its dimensions.
+        """
+        collected = []
+        with self._lock:
+            requested = []
+            for index, (worker, connection) in enumerate(self.workers):
+                # A worker whose previous reply is still outstanding is not asked again,
+                # its reply is read now instead
+                if connection not in self._awaiting:
+                    try:
+                        connection.send('collect')
+                    except IOError as e:
+                        log.error('Statsd worker {0} is not running: {1}'.format(worker.name, e))
+                        continue
+                    self._awaiting.add(connection)
+                requested.append((index, worker, connection))
+            for index, worker, connection in requested:
+                try:
+                    if not connection.poll(COLLECT_TIMEOUT):
+                        # the samples are added by the next collect
+                        log.warning('Statsd worker {0} did not send its samples in time'.format(worker.name))
+                        continue
+                    samples, count, statistics = connection.recv()
+                except (IOError, EOFError) as e:
+                    log.error('Statsd worker {0} is not running: {1}'.format(worker.name, e))
+                    continue
+                self._awaiting.discard(connection)
+                aggregator.add_samples(samples, count)
+                collected.append(({'worker': str(index)}, statistics))
+        return collected
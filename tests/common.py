@@ -49,3 +49,10 @@ def load_check(name, config):
                         agent_config=agent_config)
         c.instances = instances
         return c
+
+
+def make_envelopes(count, tenant=None):
+    """Return count forwarder envelopes of a series each, for tenant."""
+    return [{'measurement': {'name': 'foo', 'dimensions': {'a': str(i)}, 'value': i,
+                             'timestamp': 1000, 'value_meta': None},
+             'tenant_id': tenant} for i in range(count)]
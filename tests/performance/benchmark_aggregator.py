@@ -0,0 +1,55 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Throughput of MetricsAggregator.submit_metric in calls per second for a number
+of distinct series, with and without the validation caches.
+
+Run with `python tests/performance/benchmark_aggregator.py [series ...]`
+"""
+import gc
+import sys
+import time
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.common.metrics as metrics_pkg
+
+DEFAULT_SERIES = [1000, 10000, 100000]
+ROUNDS = 3
+
+
+def make_series(count):
+    return [('vm.cpu.utilization_perc',
+             {'resource_id': 'vm-%d' % i, 'service': 'compute', 'component': 'vm',
+              'tenant_id': 'tenant-%d' % (i % 50), 'zone': 'nova'})
+            for i in xrange(count)]
+
+
+class TestAggregatorPerf(object):
+
+    def measure(self, series, cache_size):
+        aggregator.dimensions_cache = aggregator.ValidationCache(cache_size)
+        aggregator.names_cache = aggregator.ValidationCache(cache_size)
+        metrics_aggregator = aggregator.MetricsAggregator('compute-1')
+        gc.collect()
+        start = time.time()
+        for value in xrange(ROUNDS):
+            for name, dimensions in series:
+                metrics_aggregator.submit_metric(name, value, metrics_pkg.Gauge, dimensions=dimensions)
+            metrics_aggregator.flush()
+        elapsed = time.time() - start
+        hit_rate = aggregator.get_validation_cache_statistics().get(
+            'monasca.agent.validation_cache.dimensions_hit_rate', 0)
+        return ROUNDS * len(series) / elapsed, hit_rate
+
+    def test_submit_metric_perf(self, counts):
+        print('{0:>10} {1:>22} {2:>22} {3:>10}'.format('series', 'no cache (calls/sec)', 'cache (calls/sec)',
+                                                       'hit rate'))
+        for count in counts:
+            series = make_series(count)
+            before, _ = self.measure(series, 0)
+            after, hit_rate = self.measure(series, aggregator.VALIDATION_CACHE_SIZE)
+            print('{0:>10} {1:>22.0f} {2:>22.0f} {3:>9.1f}%'.format(count, before, after, hit_rate))
+
+
+if __name__ == '__main__':
+    t = TestAggregatorPerf()
+    t.test_submit_metric_perf([int(arg) for arg in sys.argv[1:]] or DEFAULT_SERIES)
@@ -0,0 +1,60 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Time to flush MetricsAggregator and encode the measurements as JSON, with
+flush() followed by json.dumps() and with flush_encoded(), for a number of
+distinct series. The series are flushed once before they are sampled again
+and timed, as in a long running statsd.
+
+Run with `python tests/performance/benchmark_flush.py [series ...]`
+"""
+import gc
+import json
+import sys
+import time
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.common.metrics as metrics_pkg
+
+DEFAULT_SERIES = [10000, 100000]
+
+
+def sample(metrics_aggregator, count):
+    for i in xrange(count):
+        metrics_aggregator.submit_metric('statsd.requests', i * 0.5, metrics_pkg.Gauge,
+                                         dimensions={'endpoint': '/v2.0/metrics/%d' % i, 'method': 'POST',
+                                                     'service': 'api'})
+
+
+def flush_dicts(metrics_aggregator):
+    measurements = metrics_aggregator.flush()
+    return [json.dumps(measurements[i:i + aggregator.ENCODED_CHUNK_SIZE])
+            for i in xrange(0, len(measurements), aggregator.ENCODED_CHUNK_SIZE)]
+
+
+def flush_encoded(metrics_aggregator):
+    return [payload for _, payload in metrics_aggregator.flush_encoded()]
+
+
+class TestFlushPerf(object):
+
+    def measure(self, flush, count):
+        metrics_aggregator = aggregator.MetricsAggregator('compute-1')
+        sample(metrics_aggregator, count)
+        flush(metrics_aggregator)
+        sample(metrics_aggregator, count)
+        gc.collect()
+        start = time.time()
+        flush(metrics_aggregator)
+        return (time.time() - start) * 1000
+
+    def test_flush_perf(self, counts):
+        print('{0:>10} {1:>24} {2:>24}'.format('series', 'flush + json.dumps (ms)', 'flush_encoded (ms)'))
+        for count in counts:
+            dicts = self.measure(flush_dicts, count)
+            encoded = self.measure(flush_encoded, count)
+            print('{0:>10} {1:>24.0f} {2:>24.0f}'.format(count, dicts, encoded))
+
+
+if __name__ == '__main__':
+    t = TestFlushPerf()
+    t.test_flush_perf([int(arg) for arg in sys.argv[1:]] or DEFAULT_SERIES)
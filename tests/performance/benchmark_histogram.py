@@ -0,0 +1,52 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Throughput of statsd timer packets in packets per second, reported as a gauge
+as before and as a histogram, for a number of distinct series.
+
+Run with `python tests/performance/benchmark_histogram.py [series ...]`
+"""
+import gc
+import random
+import sys
+import time
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.common.metrics as metrics_pkg
+import monasca_agent.statsd.udp as udp
+
+DEFAULT_SERIES = [10, 1000]
+PACKETS = 200000
+
+
+def make_packets(series):
+    return ['api.request_time:{0:.3f}|ms|#endpoint:/v2.0/metrics/{1},method:POST'.format(
+            random.lognormvariate(3, 1), i % series) for i in xrange(PACKETS)]
+
+
+class TestHistogramPerf(object):
+
+    def measure(self, packets, metric_class):
+        server = udp.Server(aggregator.MetricsAggregator('compute-1'), 'localhost', 0)
+        server.metric_class = dict(udp.metric_class, ms=metric_class)
+        gc.collect()
+        start = time.time()
+        for packet in packets:
+            server.submit_packets(packet)
+        elapsed = time.time() - start
+        flush_start = time.time()
+        server.aggregator.flush()
+        return len(packets) / elapsed, (time.time() - flush_start) * 1000
+
+    def test_timer_perf(self, counts):
+        print('{0:>10} {1:>22} {2:>22} {3:>18}'.format('series', 'gauge (packets/sec)', 'histogram (packets/sec)',
+                                                       'histogram flush ms'))
+        for count in counts:
+            packets = make_packets(count)
+            gauge, _ = self.measure(packets, metrics_pkg.Gauge)
+            histogram, flush_time = self.measure(packets, metrics_pkg.Histogram)
+            print('{0:>10} {1:>22.0f} {2:>22.0f} {3:>18.1f}'.format(count, gauge, histogram, flush_time))
+
+
+if __name__ == '__main__':
+    t = TestHistogramPerf()
+    t.test_timer_perf([int(arg) for arg in sys.argv[1:]] or DEFAULT_SERIES)
@@ -0,0 +1,107 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Measurements per second the forwarder accepts through /intake compared with
+its Unix domain socket, including the encoding done by the emitter.
+
+Run with `python tests/performance/benchmark_intake.py [payload_size ...]`
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+
+import monasca_agent.common.emitter as emitter
+import monasca_agent.common.intake as intake
+import monasca_agent.forwarder.daemon as daemon
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PAYLOAD_SIZES = [10, 100, 1000]
+MEASUREMENTS = 100000
+
+
+def make_envelopes(count):
+    return [{'measurement': {'name': 'vm.net.in_bytes_sec',
+                             'dimensions': {'hostname': 'compute-1', 'resource_id': 'vm-%d' % (i % 200),
+                                            'device': 'tap%d' % (i % 7), 'service': 'compute'},
+                             'value': float(i),
+                             'timestamp': 1490000000000,
+                             'value_meta': None},
+             'tenant_id': None} for i in xrange(count)]
+
+
+class BenchmarkForwarder(tornado.web.Application):
+    def __init__(self):
+        super(BenchmarkForwarder, self).__init__([(r"/intake/?", daemon.AgentInputHandler)],
+                                                 log_function=lambda handler: None)
+        self.received = 0
+
+    def add_measurements(self, measurements):
+        self.received += len(measurements)
+
+    def get_retry_after(self):
+        return 0
+
+
+class TestIntakePerf(object):
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'forwarder.sock')
+        self.forwarder = BenchmarkForwarder()
+        self.io_loop = tornado.ioloop.IOLoop()
+        started = threading.Event()
+
+        def run():
+            self.io_loop.make_current()
+            http_server = tornado.httpserver.HTTPServer(self.forwarder)
+            sockets = tornado.netutil.bind_sockets(0, address='127.0.0.1')
+            self.port = sockets[0].getsockname()[1]
+            http_server.add_sockets(sockets)
+            daemon.IntakeStreamServer(self.forwarder).add_socket(tornado.netutil.bind_unix_socket(self.path))
+            started.set()
+            self.io_loop.start()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+        started.wait(5)
+
+    def stop(self):
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def measure(self, emit, url, payload_size):
+        envelopes = make_envelopes(payload_size)
+        payloads = MEASUREMENTS // payload_size
+        self.forwarder.received = 0
+        start = time.time()
+        for _ in xrange(payloads):
+            emit(envelopes, log, url)
+        elapsed = time.time() - start
+        assert self.forwarder.received == payloads * payload_size
+        return self.forwarder.received / elapsed
+
+    def test_intake_perf(self, payload_sizes):
+        print('unix socket encoding: {0}'.format('msgpack' if intake.msgpack else 'json'))
+        print('{0:>12} {1:>22} {2:>22}'.format('payload size', '/intake (meas/sec)', 'unix socket (meas/sec)'))
+        for payload_size in payload_sizes:
+            http = self.measure(emitter.http_emitter, 'http://127.0.0.1:{0}'.format(self.port), payload_size)
+            unix = self.measure(emitter.emit, 'unix://' + self.path, payload_size)
+            print('{0:>12} {1:>22.0f} {2:>22.0f}'.format(payload_size, http, unix))
+
+
+if __name__ == '__main__':
+    t = TestIntakePerf()
+    try:
+        t.test_intake_perf([int(arg) for arg in sys.argv[1:]] or DEFAULT_PAYLOAD_SIZES)
+    finally:
+        t.stop()
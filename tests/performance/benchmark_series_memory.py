@@ -0,0 +1,99 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Memory used per series held by MetricsAggregator, compared with the metric
+objects which kept their own name and dimensions dicts.
+
+Every measurement runs in a forked process and is taken from the growth of its
+resident set size. Run with `python tests/performance/benchmark_series_memory.py [series ...]`
+"""
+import gc
+import os
+import resource
+import sys
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.common.metrics as metrics_pkg
+
+DEFAULT_SERIES = [10000, 100000]
+HOSTNAME = 'compute-1'
+
+
+class DictGauge(object):
+    """The previous layout of a series"""
+
+    def __init__(self, name, dimensions, tenant):
+        self.metric = {'name': name,
+                       'dimensions': dimensions.copy()}
+        self.value_meta = None
+        self.value = None
+        self.timestamp = None
+        self.tenant = tenant
+
+    def sample(self, value, sample_rate, timestamp):
+        self.value = value
+        self.timestamp = timestamp
+
+
+def make_series(count):
+    return [('statsd.requests', {'endpoint': '/v2.0/metrics/%d' % i, 'method': 'POST',
+                                 'status': str(200 + i % 5), 'service': 'api'})
+            for i in xrange(count)]
+
+
+def dict_series(series):
+    """Hold the series the way the previous submit_metric did"""
+    held = {}
+    for value, (name, dimensions) in enumerate(series):
+        dimensions_copy = dimensions.copy()
+        dimensions_copy['hostname'] = HOSTNAME
+        context = (name, tuple(dimensions_copy.items()), None, HOSTNAME, None)
+        held[context] = DictGauge(name, dimensions_copy, tenant=None)
+        held[context].sample(value, 1, 1000)
+    return held
+
+
+def slots_series(series):
+    metrics_aggregator = aggregator.MetricsAggregator(HOSTNAME)
+    for value, (name, dimensions) in enumerate(series):
+        metrics_aggregator.submit_metric(name, value, metrics_pkg.Gauge, dimensions=dimensions, timestamp=None)
+    return metrics_aggregator.metrics
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def measure(hold, count):
+    """Return the bytes per series used by hold() in a child process."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        series = make_series(count)
+        gc.collect()
+        before = rss()
+        held = hold(series)
+        gc.collect()
+        used = rss() - before
+        os.write(write_fd, str(used / float(len(held))))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return float(result)
+
+
+class TestSeriesMemory(object):
+
+    def test_series_memory(self, counts):
+        print('{0:>10} {1:>24} {2:>24}'.format('series', 'dict metrics (B/series)', 'slots metrics (B/series)'))
+        for count in counts:
+            print('{0:>10} {1:>24.0f} {2:>24.0f}'.format(count, measure(dict_series, count),
+                                                         measure(slots_series, count)))
+
+
+if __name__ == '__main__':
+    t = TestSeriesMemory()
+    t.test_series_memory([int(arg) for arg in sys.argv[1:]] or DEFAULT_SERIES)
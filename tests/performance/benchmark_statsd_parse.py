@@ -0,0 +1,114 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Statsd lines parsed per second by the previous parser, which split each line
+several times, built DogStatsd tags a character at a time and evaluated
+Monasca dimensions with ast.literal_eval, and by udp.Server, for plain lines,
+lines with DogStatsd tags and lines with Monasca dimensions. The lines cycle
+through a number of distinct dimensions, like the series of an application.
+
+Run with `python tests/performance/benchmark_statsd_parse.py [lines] [distinct dimensions]`
+"""
+import ast
+import sys
+import time
+
+import monasca_agent.statsd.udp as udp
+
+DEFAULT_LINES = 200000
+DEFAULT_DISTINCT = 100
+
+
+def previous_parse_metric_packet(packet):
+    name_and_metadata = packet.split(':', 1)
+    if len(name_and_metadata) != 2:
+        raise Exception('Unparseable metric packet: %s' % packet)
+    name = name_and_metadata[0]
+    metadata = name_and_metadata[1].split('|')
+    if len(metadata) < 2:
+        raise Exception('Unparseable metric packet: %s' % packet)
+    raw_value = metadata[0]
+    metric_type = metadata[1]
+    if metric_type == 's':
+        value = raw_value
+    else:
+        try:
+            value = int(raw_value)
+        except ValueError:
+            try:
+                value = float(raw_value)
+            except ValueError:
+                raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
+    sample_rate = 1
+    dimensions = {}
+    for m in metadata[2:]:
+        if m[0] == '@':
+            sample_rate = float(m[1:])
+            assert 0 <= sample_rate <= 1
+        elif m[0] == '#' and len(m) > 2:
+            if m[1] == '{':
+                dimensions = ast.literal_eval(m[1:])
+            else:
+                dimensions = previous_parse_dogstatsd_tags(m[1:])
+    return name, value, metric_type, dimensions, sample_rate
+
+
+def previous_parse_dogstatsd_tags(statsd_msg):
+    dimensions = {}
+    s = ''
+    key = ''
+    for c in statsd_msg[1:]:
+        if c == ':':
+            key = s.strip()
+            s = ''
+        elif c == ',':
+            s = s.strip()
+            if len(key) > 0:
+                if len(s) > 0:
+                    dimensions[key] = s
+                else:
+                    dimensions[key] = '?'
+            elif len(s) > 0:
+                dimensions[s] = "True"
+            key = ''
+            s = ''
+        else:
+            s += c
+    s = s.strip()
+    if len(s) > 0 and len(key) > 0:
+        dimensions[key] = s
+    return dimensions
+
+
+def make_lines(kind, count, distinct):
+    if kind == 'plain':
+        return ['statsd.requests.%d:%d|c' % (i % distinct, i) for i in xrange(count)]
+    if kind == 'dogstatsd':
+        return ['statsd.latency:%d.5|ms|@0.5|#endpoint:/v2.0/metrics/%d,method:POST,service:api' % (i, i % distinct)
+                for i in xrange(count)]
+    return ['statsd.latency:%d.5|ms|@0.5|#{"endpoint": "/v2.0/metrics/%d", "method": "POST", "service": "api"}' %
+            (i, i % distinct) for i in xrange(count)]
+
+
+def lines_per_second(parse, lines):
+    start = time.time()
+    for line in lines:
+        parse(line)
+    return len(lines) / (time.time() - start)
+
+
+class TestStatsdParsePerf(object):
+
+    def test_statsd_parse_perf(self, count, distinct):
+        print('{0} lines with {1} distinct names or dimensions'.format(count, distinct))
+        print('{0:>10} {1:>24} {2:>24}'.format('lines', 'previous (lines/sec)', 'udp.Server (lines/sec)'))
+        for kind in ('plain', 'dogstatsd', 'monasca'):
+            lines = make_lines(kind, count, distinct)
+            print('{0:>10} {1:>24.0f} {2:>24.0f}'.format(kind,
+                                                         lines_per_second(previous_parse_metric_packet, lines),
+                                                         lines_per_second(udp.Server._parse_metric_packet, lines)))
+
+
+if __name__ == '__main__':
+    t = TestStatsdParsePerf()
+    t.test_statsd_parse_perf(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_LINES,
+                             int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_DISTINCT)
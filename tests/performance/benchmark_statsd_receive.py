@@ -0,0 +1,92 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Packets per second the statsd server sustains and the share it loses, while
+sender processes send counter packets to it as fast as they can:
+
+  one per wakeup: a select and a recv for every packet, as statsd used to
+  recv loop:      recv until the socket has no more packets after a select
+  recvmmsg:       RECEIVE_BATCH packets read by each recvmmsg call
+
+each with the receive buffer of the kernel and with monasca_statsd_receive_buffer.
+
+Run with `python tests/performance/benchmark_statsd_receive.py [packets per sender] [senders]`
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.statsd.udp as udp
+
+DEFAULT_PACKETS = 200000
+DEFAULT_SENDERS = 2
+# A monasca_statsd_receive_buffer of 4 MiB, which net.core.rmem_max has to allow
+RECEIVE_BUFFER = 4194304
+
+
+def send(address, packets, sender):
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for i in xrange(packets):
+        client.sendto('statsd.requests:1|c|#{"endpoint": "/v2.0/metrics/%d", "sender": "%d"}' % (i % 100, sender),
+                      address)
+    client.close()
+
+
+def measure(max_per_wakeup, batch, receive_buffer, packets, senders):
+    """Return the packets per second received and the share of packets lost."""
+    server = udp.Server(aggregator.ShardedMetricsAggregator('compute-1'), '127.0.0.1', 0,
+                        receive_buffer=receive_buffer, receive_batch=batch)
+    server.bind()
+    address = server.socket.getsockname()
+    udp.MAX_DATAGRAMS_PER_WAKEUP = max_per_wakeup
+    thread = threading.Thread(target=server.start)
+    thread.start()
+
+    start = time.time()
+    pids = []
+    for sender in range(senders):
+        pid = os.fork()
+        if pid == 0:
+            send(address, packets, sender)
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    # the server is done once it stops receiving
+    received = -1
+    end = time.time()
+    while server.packets != received:
+        if received >= 0:
+            end = time.time()
+        received = server.packets
+        time.sleep(0.5)
+
+    server.stop()
+    # wake the select loop up
+    send(address, 1, 0)
+    thread.join()
+    return received / (end - start), 1 - received / float(packets * senders)
+
+
+class TestStatsdReceivePerf(object):
+
+    def test_statsd_receive_perf(self, packets, senders):
+        print('{0} senders sending {1} packets each'.format(senders, packets))
+        print('{0:>16} {1:>16} {2:>12} {3:>8}'.format('mode', 'receive buffer', 'packets/sec', 'loss'))
+        modes = [('one per wakeup', 1, 1),
+                 ('recv loop', udp.MAX_DATAGRAMS_PER_WAKEUP, 1),
+                 ('recvmmsg', udp.MAX_DATAGRAMS_PER_WAKEUP, udp.RECEIVE_BATCH)]
+        for name, max_per_wakeup, batch in modes:
+            for receive_buffer in (None, RECEIVE_BUFFER):
+                rate, loss = measure(max_per_wakeup, batch, receive_buffer, packets, senders)
+                print('{0:>16} {1:>16} {2:>12.0f} {3:>7.1f}%'.format(name, receive_buffer or 'default', rate,
+                                                                     loss * 100))
+
+
+if __name__ == '__main__':
+    t = TestStatsdReceivePerf()
+    t.test_statsd_receive_perf(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PACKETS,
+                               int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SENDERS)
@@ -0,0 +1,80 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Statsd counter lines per second through udp.Server.submit_packets, with the
+previous Counter, which divided every sample by its sample rate into a float
+and truncated the sum, and with Counter, which sums the samples of each sample
+rate and divides once at flush. Also reports the counts flushed by both, for
+lines of which half are sampled at 0.3.
+
+Run with `python tests/performance/benchmark_statsd_submit.py [lines] [series]`
+"""
+import gc
+import sys
+import time
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.common.metrics as metrics_pkg
+import monasca_agent.statsd.udp as udp
+
+DEFAULT_LINES = 1000000
+DEFAULT_SERIES = 100
+# Lines given to each submit_packets call, as in a datagram
+LINES_PER_PACKET = 10
+
+
+class PreviousCounter(metrics_pkg.Metric):
+    """The previous Counter"""
+
+    __slots__ = ()
+
+    def sample(self, value, sample_rate, timestamp):
+        inc = float(value) / sample_rate
+        if self.timestamp is None:
+            self.value = inc
+        else:
+            self.value += inc
+        self.timestamp = timestamp
+
+    def flush_values(self):
+        if self.timestamp:
+            self.value = int(self.value)
+            return super(PreviousCounter, self).flush_values()
+        return []
+
+
+def make_packets(lines, series):
+    # every other round over the series is sampled
+    packet_lines = ['api.requests:1|c%s|#endpoint:/v2.0/metrics/%d,method:POST' % (
+                    '|@0.3' if (i // series) % 2 else '', i % series) for i in xrange(lines)]
+    return ['\n'.join(packet_lines[i:i + LINES_PER_PACKET]) for i in xrange(0, lines, LINES_PER_PACKET)]
+
+
+def measure(packets, counter_class):
+    """Return the lines per second submitted and the total count flushed."""
+    server = udp.Server(aggregator.MetricsAggregator('compute-1'), 'localhost', 0)
+    server.metric_class = dict(udp.metric_class, c=counter_class)
+    gc.collect()
+    start = time.time()
+    for packet in packets:
+        server.submit_packets(packet)
+    elapsed = time.time() - start
+    total = sum(envelope['measurement']['value'] for envelope in server.aggregator.flush())
+    return len(packets) * LINES_PER_PACKET / elapsed, total
+
+
+class TestStatsdSubmitPerf(object):
+
+    def test_statsd_submit_perf(self, lines, series):
+        packets = make_packets(lines, series)
+        expected = lines // 2 + (lines - lines // 2) / 0.3
+        print('{0} counter lines over {1} series, expected count {2:.0f}'.format(lines, series, expected))
+        print('{0:>16} {1:>14} {2:>14}'.format('counter', 'lines/sec', 'count'))
+        for name, counter_class in (('previous', PreviousCounter), ('Counter', metrics_pkg.Counter)):
+            rate, total = measure(packets, counter_class)
+            print('{0:>16} {1:>14.0f} {2:>14}'.format(name, rate, total))
+
+
+if __name__ == '__main__':
+    t = TestStatsdSubmitPerf()
+    t.test_statsd_submit_perf(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_LINES,
+                              int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SERIES)
@@ -0,0 +1,71 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+"""
+Calls to json.dumps per sample and samples per second of
+MetricsAggregator.submit_metric with value_meta, including the flush, with
+and without the value_meta cache. Checks like http_check submit the same
+error message in every run.
+
+Run with `python tests/performance/benchmark_value_meta.py [distinct value_meta ...]`
+"""
+import gc
+import json
+import sys
+import time
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.common.metrics as metrics_pkg
+
+DEFAULT_DISTINCT = [1, 100, 10000]
+SERIES = 10000
+ROUNDS = 3
+
+
+class CountingDumps(object):
+    def __init__(self, dumps):
+        self.dumps = dumps
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.dumps(*args, **kwargs)
+
+
+class TestValueMetaPerf(object):
+
+    def measure(self, distinct, cache_size, encoded):
+        aggregator.value_meta_cache = aggregator.ValidationCache(cache_size)
+        metrics_aggregator = aggregator.MetricsAggregator('compute-1')
+        value_metas = [{'error': 'Connection to http://10.0.0.%d:8080/ timed out' % i} for i in xrange(distinct)]
+        series = [{'url': 'http://10.0.0.%d:8080/' % i} for i in xrange(SERIES)]
+        counting = CountingDumps(json.dumps)
+        json.dumps = counting
+        gc.collect()
+        start = time.time()
+        try:
+            for value in xrange(ROUNDS):
+                for i, dimensions in enumerate(series):
+                    metrics_aggregator.submit_metric('http_status', 1, metrics_pkg.Gauge, dimensions=dimensions,
+                                                     value_meta=dict(value_metas[i % distinct]))
+                if encoded:
+                    list(metrics_aggregator.flush_encoded())
+                else:
+                    metrics_aggregator.flush()
+        finally:
+            json.dumps = counting.dumps
+        elapsed = time.time() - start
+        return float(counting.calls) / (ROUNDS * SERIES), ROUNDS * SERIES / elapsed
+
+    def test_value_meta_perf(self, counts):
+        print('{0:>10} {1:>8} {2:>26} {3:>26}'.format('distinct', 'flush', 'no cache (dumps, samples/s)',
+                                                      'cache (dumps, samples/s)'))
+        for distinct in counts:
+            for encoded in (False, True):
+                before = self.measure(distinct, 0, encoded)
+                after = self.measure(distinct, aggregator.VALUE_META_CACHE_SIZE, encoded)
+                print('{0:>10} {1:>8} {2[0]:>10.2f} {2[1]:>15.0f} {3[0]:>10.2f} {3[1]:>15.0f}'.format(
+                      distinct, 'encoded' if encoded else 'dicts', before, after))
+
+
+if __name__ == '__main__':
+    t = TestValueMetaPerf()
+    t.test_value_meta_perf([int(arg) for arg in sys.argv[1:]] or DEFAULT_DISTINCT)
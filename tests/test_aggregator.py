@@ -1,4 +1,8 @@
 # (C) Copyright 2015-2016 Hewlett Packard Enterprise Development Company LP
+import json
+import pickle
+import threading
+import time
 import unittest
 
 import monasca_agent.common.aggregator as aggregator
@@ -291,3 +295,220 @@ class TestMetricsAggregator(unittest.TestCase):
                            dimensions=dimensions,
                            value_meta=value_meta,
                            exception=aggregator.InvalidValueMeta)
+
+    def testValidationCache(self):
+        aggregator.get_validation_cache_statistics()
+        dimensions = {'A': 'B', 'B': 'C'}
+        for value in range(3):
+            self.submit_metric("CachedName", value, dimensions=dict(dimensions))
+        statistics = aggregator.get_validation_cache_statistics()
+        self.assertAlmostEqual(statistics['monasca.agent.validation_cache.dimensions_hit_rate'], 200.0 / 3)
+        self.assertAlmostEqual(statistics['monasca.agent.validation_cache.names_hit_rate'], 200.0 / 3)
+
+        # invalid dimensions are never cached
+        for _ in range(2):
+            self.submit_metric("CachedName", 1, dimensions={'A': 'B', 'B': 'C;'},
+                               exception=aggregator.InvalidDimensionValue)
+        self.submit_metric("CachedName", 1, dimensions={'A': ['B']},
+                           exception=aggregator.InvalidDimensionValue)
+        self.assertFalse(frozenset([('B', 'C;'), ('A', 'B')]) in aggregator.dimensions_cache)
+
+    def testValueMetaCache(self):
+        aggregator.get_validation_cache_statistics()
+        for name in ("A", "B"):
+            self.submit_metric(name, 1, dimensions={}, value_meta={'error': 'timeout'})
+        value_metas = [metric.value_meta for metric in self.aggregator.metrics.values()]
+        # validated and encoded once, then shared by both series
+        self.assertIs(value_metas[0], value_metas[1])
+        self.assertEqual(value_metas[0].encoded, '{"error": "timeout"}')
+        statistics = aggregator.get_validation_cache_statistics()
+        self.assertEqual(statistics['monasca.agent.validation_cache.value_meta_hit_rate'], 50.0)
+        self.assertEqual([envelope['measurement']['value_meta'] for envelope in self.aggregator.flush()],
+                         [{'error': 'timeout'}] * 2)
+
+        for _ in range(2):
+            self.submit_metric("A", 1, dimensions={}, value_meta={'error': 'x' * 2048},
+                               exception=aggregator.InvalidValueMeta)
+        self.assertEqual(aggregator.value_meta_cache.get(aggregator._value_meta_key({'error': 'x' * 2048})), None)
+
+    def testValueMetaCacheTypes(self):
+        # equal values of different types are cached apart
+        for name, value in (("Bool", True), ("Int", 1), ("Float", 1.0), ("Tuple", (1,)), ("BoolTuple", (True,))):
+            self.submit_metric(name, 1, dimensions={}, value_meta={'k': value})
+        self.assertEqual(dict((metric.name, metric.value_meta.encoded) for metric in self.aggregator.metrics.values()),
+                         {"Bool": '{"k": true}', "Int": '{"k": 1}', "Float": '{"k": 1.0}',
+                          "Tuple": '{"k": [1]}', "BoolTuple": '{"k": [true]}'})
+
+    def testSetValues(self):
+        for value in ("user-1", "user-2", "user-1"):
+            self.aggregator.submit_metric("Users", value, metrics_pkg.Set, dimensions={})
+        self.assertEqual(self.aggregator.flush()[0]['measurement']['value'], 2)
+        self.submit_metric("Users", "user-1", dimensions={}, exception=aggregator.InvalidValue)
+
+    def testFlushEncoded(self):
+        timestamp = time.time()
+
+        def submit(metrics_aggregator):
+            metrics_aggregator.submit_metric("Gauge", 1.5, metrics_pkg.Gauge, dimensions={'A': u'\xe9'},
+                                             value_meta={'msg': 'ok'}, timestamp=timestamp)
+            metrics_aggregator.submit_metric("Counter", 3, metrics_pkg.Counter, dimensions={},
+                                             delegated_tenant='tenant', timestamp=timestamp)
+            metrics_aggregator.submit_metric("Timer", 10, metrics_pkg.Histogram, dimensions={'B': 'C'},
+                                             timestamp=timestamp)
+
+        def key(envelope):
+            return envelope['measurement']['name']
+
+        submit(self.aggregator)
+        expected = sorted(self.aggregator.flush(), key=key)
+        submit(self.aggregator)
+        chunks = list(self.aggregator.flush_encoded(chunk_size=4))
+        self.assertEqual([count for count, _ in chunks], [4, 4, 2])
+        encoded = sorted((envelope for _, payload in chunks for envelope in json.loads(payload)), key=key)
+        self.assertEqual(encoded, expected)
+        self.assertEqual(list(self.aggregator.flush_encoded()), [])
+
+    def testSeriesEviction(self):
+        self.aggregator = aggregator.MetricsAggregator("Foo", series_ttl=2)
+        self.submit_metric("Stale", 1, dimensions={'A': 'B'})
+        self.assertEqual(len(self.aggregator.flush()), 1)
+        for value in range(2):
+            self.submit_metric("Fresh", value, dimensions={})
+            self.assertEqual(len(self.aggregator.flush()), 1)
+        self.assertEqual([context[0] for context in self.aggregator.metrics], ["Fresh"])
+        statistics = self.aggregator.get_statistics()
+        self.assertEqual(statistics['monasca.agent.aggregator.series'], 1)
+        self.assertEqual(statistics['monasca.agent.aggregator.evicted_series'], 1)
+        self.assertEqual(self.aggregator.get_statistics()['monasca.agent.aggregator.evicted_series'], 0)
+
+    def testMaxSeries(self):
+        self.aggregator = aggregator.MetricsAggregator("Foo", max_series=2)
+        for name in ("A", "B", "C", "A"):
+            self.submit_metric(name, 1, dimensions={})
+        self.assertEqual(sorted(envelope['measurement']['name'] for envelope in self.aggregator.flush()),
+                         ["A", "B"])
+        self.assertEqual(self.aggregator.get_statistics()['monasca.agent.aggregator.capped_points'], 1)
+
+
+class TestValidationCache(unittest.TestCase):
+    def testEviction(self):
+        cache = aggregator.ValidationCache(4)
+        cache.add('a')
+        cache.add('b')
+        # 'a' is moved to the new generation when it is used
+        cache.add('c')
+        self.assertTrue('a' in cache)
+        cache.add('d')
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+    def testDisabled(self):
+        cache = aggregator.ValidationCache(0)
+        cache.add('a')
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.reset_statistics(), (0, 1))
+
+
+class TestShardedMetricsAggregator(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = aggregator.ShardedMetricsAggregator("Foo", shards=4)
+
+    def submit(self, name, value, metric_class, timestamp=None, **dimensions):
+        self.aggregator.submit_metric(name, value, metric_class, dimensions=dimensions, timestamp=timestamp)
+
+    def values(self):
+        return dict((envelope['measurement']['name'], envelope['measurement']['value'])
+                    for envelope in self.aggregator.flush())
+
+    def testMerge(self):
+        now = time.time()
+        self.submit("Gauge", 1, metrics_pkg.Gauge)
+        self.submit("Counter", 2, metrics_pkg.Counter)
+        self.submit("Rate", 10, metrics_pkg.Rate, timestamp=now - 10)
+        self.assertEqual(self.values(), {"Gauge": 1, "Counter": 2})
+
+        self.submit("Gauge", 3, metrics_pkg.Gauge)
+        self.submit("Counter", 2, metrics_pkg.Counter)
+        self.submit("Counter", 5, metrics_pkg.Counter)
+        # the rate is computed from the sample of the previous interval
+        self.submit("Rate", 30, metrics_pkg.Rate, timestamp=now)
+        self.submit("Set", "a", metrics_pkg.Set)
+        self.submit("Set", "b", metrics_pkg.Set)
+        self.assertEqual(self.values(), {"Gauge": 3, "Counter": 7, "Rate": 2.0, "Set": 2})
+        self.assertEqual(len(self.aggregator.metrics), 4)
+
+    def testAddSamples(self):
+        worker = aggregator.ShardedMetricsAggregator("Foo", shards=1)
+        worker.submit_metric("Counter", 2, metrics_pkg.Counter, dimensions={})
+        worker.submit_metric("Histogram", 4, metrics_pkg.Histogram, dimensions={})
+        self.submit("Counter", 3, metrics_pkg.Counter)
+
+        samples, count = worker.take_samples()
+        self.assertEqual(count, 2)
+        self.assertEqual(worker.take_samples(), ({}, 0))
+
+        self.aggregator.add_samples(pickle.loads(pickle.dumps(samples, 2)), count)
+        values = self.values()
+        self.assertEqual(values["Counter"], 5)
+        self.assertEqual(values["Histogram.max"], 4)
+        self.assertEqual(self.aggregator.total_count, 3)
+
+    def testMaxSeries(self):
+        self.aggregator = aggregator.ShardedMetricsAggregator("Foo", max_series=2, shards=4)
+        # the shard buffers hold no more series than the aggregator may before a flush
+        for name in ("A", "B", "C", "A", "D"):
+            self.submit(name, 1, metrics_pkg.Gauge)
+        self.assertEqual(sum(len(shard.samples) for shard in self.aggregator._shards), 2)
+        self.assertEqual(sorted(self.values()), ["A", "B"])
+        self.assertEqual(self.aggregator.get_statistics()['monasca.agent.aggregator.capped_points'], 2)
+
+        # the held series are still sampled, new ones are not
+        self.submit("A", 2, metrics_pkg.Gauge)
+        self.submit("C", 2, metrics_pkg.Gauge)
+        self.assertEqual(self.values(), {"A": 2})
+
+        # samples added from a worker are capped as well
+        worker = aggregator.ShardedMetricsAggregator("Foo", max_series=2, shards=1)
+        for name in ("B", "E", "F"):
+            worker.submit_metric(name, 1, metrics_pkg.Gauge, dimensions={})
+        samples, count = worker.take_samples()
+        self.assertEqual(sorted(context[0] for context in samples), ["B", "E"])
+        self.aggregator.add_samples(samples, count)
+        self.assertEqual(self.values(), {"B": 1})
+        self.assertEqual(self.aggregator.get_statistics()['monasca.agent.aggregator.capped_points'], 2)
+
+    def testConcurrentProducers(self):
+        producers = 8
+        samples = 5000
+        flushed = []
+        done = threading.Event()
+
+        def produce(producer):
+            for i in xrange(samples):
+                self.submit("Counter", 1, metrics_pkg.Counter, series=str(i % 10))
+                self.submit("Gauge", producer, metrics_pkg.Gauge, producer=str(producer))
+
+        def flush():
+            while not done.is_set():
+                flushed.extend(self.aggregator.flush())
+
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        threads = [threading.Thread(target=produce, args=(producer,)) for producer in range(producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        flusher.join()
+        flushed.extend(self.aggregator.flush())
+
+        # no sample was lost or counted twice while the buffers were swapped
+        counted = sum(envelope['measurement']['value'] for envelope in flushed
+                      if envelope['measurement']['name'] == "Counter")
+        self.assertEqual(counted, producers * samples)
+        self.assertEqual(self.aggregator.total_count, 2 * producers * samples)
+        gauges = set(envelope['measurement']['dimensions']['producer'] for envelope in flushed
+                     if envelope['measurement']['name'] == "Gauge")
+        self.assertEqual(gauges, set(str(producer) for producer in range(producers)))
@@ -0,0 +1,65 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import json
+import unittest
+
+import monasca_agent.forwarder.batcher as batcher
+from tests.common import make_envelopes
+
+
+class TestBatcher(unittest.TestCase):
+
+    def test_cut_at_max_measurements(self):
+        b = batcher.Batcher(max_measurements=3, max_bytes=1024 * 1024, max_linger=1000)
+        ready = b.add(make_envelopes(7))
+
+        self.assertEqual([count for _, _, count in ready], [3, 3])
+        self.assertEqual(len(b), 1)
+        tenant, body, count = ready[0]
+        self.assertEqual(tenant, None)
+        self.assertEqual([m['value'] for m in json.loads(body)], [0, 1, 2])
+
+    def test_cut_before_max_bytes(self):
+        # the measurements all have the same size
+        size = len(json.dumps(make_envelopes(1)[0]['measurement']))
+        b = batcher.Batcher(max_measurements=100, max_bytes=3 * size + 4, max_linger=1000)
+        ready = b.add(make_envelopes(7))
+
+        self.assertEqual([count for _, _, count in ready], [3, 3])
+        for _, body, count in ready:
+            self.assertEqual(len(body), 3 * size + 4)
+            self.assertEqual(len(json.loads(body)), count)
+
+    def test_batches_per_tenant(self):
+        b = batcher.Batcher(max_measurements=2, max_bytes=1024 * 1024, max_linger=1000)
+        listed = make_envelopes(1)
+        listed[0]['measurement']['dimensions'] = [('c', 'd')]
+        ready = b.add(make_envelopes(1, 'a') + make_envelopes(1, 'b') + make_envelopes(1, 'a') + listed)
+
+        self.assertEqual(len(ready), 1)
+        self.assertEqual(ready[0][0], 'a')
+        flushed = dict((tenant, json.loads(body)) for tenant, body, _ in b.flush())
+        self.assertEqual(sorted(flushed.keys()), [None, 'b'])
+        self.assertEqual(flushed[None][0]['dimensions'], {'c': 'd'})
+        self.assertEqual(len(b), 0)
+
+    def test_linger(self):
+        b = batcher.Batcher(max_measurements=100, max_bytes=1024 * 1024, max_linger=1000)
+        b.add(make_envelopes(1, 'a'), now=100.0)
+        b.add(make_envelopes(1, 'b'), now=100.5)
+
+        self.assertEqual(b.expired(now=100.9), [])
+        self.assertEqual([tenant for tenant, _, _ in b.expired(now=101.0)], ['a'])
+        self.assertEqual([tenant for tenant, _, _ in b.expired(now=101.5)], ['b'])
+
+    def test_statistics(self):
+        b = batcher.Batcher(max_measurements=4, max_bytes=1024 * 1024, max_linger=1000)
+        b.add(make_envelopes(9))
+        b.flush()
+
+        statistics = b.get_statistics()
+        self.assertEqual(statistics['monasca.agent.forwarder.batch_measurements.count'], 3)
+        self.assertEqual(statistics['monasca.agent.forwarder.batch_measurements.avg'], 3.0)
+        self.assertEqual(statistics['monasca.agent.forwarder.batch_measurements.max'], 4)
+        self.assertEqual(statistics['monasca.agent.forwarder.batch_measurements.median'], 4)
+        self.assertTrue('monasca.agent.forwarder.batch_bytes.95percentile' in statistics)
+        self.assertEqual(b.get_statistics(), {})
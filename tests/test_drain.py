@@ -0,0 +1,31 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import unittest
+
+import monasca_agent.forwarder.api.drain as drain
+
+
+class TestDrainController(unittest.TestCase):
+    def test_rate_unchanged_without_requests(self):
+        controller = drain.DrainController(5, 100, 1000)
+        self.assertEqual(controller.next_rate(), 5)
+
+    def test_additive_increase(self):
+        controller = drain.DrainController(5, 7, 1000)
+        for expected in [6, 7, 7]:
+            controller.record(10, False)
+            self.assertEqual(controller.next_rate(), expected)
+
+    def test_multiplicative_decrease_on_failure(self):
+        controller = drain.DrainController(40, 100, 1000)
+        controller.record(10, False)
+        controller.record(10, True)
+        self.assertEqual(controller.next_rate(), 20)
+        controller.record(10, True)
+        self.assertEqual(controller.next_rate(), 10)
+
+    def test_decrease_on_high_latency(self):
+        controller = drain.DrainController(3, 100, 1000)
+        controller.record(1500, False)
+        self.assertEqual(controller.next_rate(), 1)
+        controller.record(5000, False)
+        self.assertEqual(controller.next_rate(), 1)
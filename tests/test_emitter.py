@@ -0,0 +1,130 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import BaseHTTPServer
+import json
+import logging
+import threading
+import time
+import unittest
+
+import monasca_agent.common.emitter as emitter
+
+log = logging.getLogger(__name__)
+
+
+class StubForwarderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.retry_after:
+            self.send_response(503)
+            self.send_header('Retry-After', str(self.server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.server.drop_requests:
+            # hang up without answering, like a forwarder being restarted
+            self.server.drop_requests -= 1
+            self.close_connection = 1
+            return
+        self.server.received.append(json.loads(body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        if self.server.close_connections:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestEmitter(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubForwarderHandler)
+        self.server.received = []
+        self.server.close_connections = False
+        self.server.drop_requests = 0
+        self.server.retry_after = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.emitter = emitter.Emitter('http://127.0.0.1:{0}'.format(self.server.server_port))
+
+    def tearDown(self):
+        self.emitter.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_connection_is_reused(self):
+        for i in range(3):
+            self.emitter.send([{'value': i}], log)
+
+        self.assertEqual(self.server.received, [[{'value': 0}], [{'value': 1}], [{'value': 2}]])
+        statistics = self.emitter.get_statistics()
+        self.assertEqual(statistics['monasca.agent.emitter.connections'], 1)
+        self.assertEqual(statistics['monasca.agent.emitter.errors'], 0)
+        self.assertTrue(statistics['monasca.agent.emitter.send_time_max_ms'] >= 0)
+
+    def test_retry_on_closed_connection(self):
+        self.server.close_connections = True
+        for i in range(3):
+            self.emitter.send([{'value': i}], log)
+
+        # every request after the first one failed on the connection closed by the server
+        self.assertEqual(len(self.server.received), 3)
+        statistics = self.emitter.get_statistics()
+        self.assertEqual(statistics['monasca.agent.emitter.connections'], 3)
+        self.assertEqual(statistics['monasca.agent.emitter.errors'], 0)
+
+    def test_retry_on_dropped_request(self):
+        self.emitter.send([{'value': 1}], log)
+        self.server.drop_requests = 1
+        self.emitter.send([{'value': 2}], log)
+
+        self.assertEqual(self.server.received, [[{'value': 1}], [{'value': 2}]])
+        statistics = self.emitter.get_statistics()
+        self.assertEqual(statistics['monasca.agent.emitter.connections'], 2)
+        self.assertEqual(statistics['monasca.agent.emitter.errors'], 0)
+
+        # the request is given up after the retry failed as well
+        self.server.drop_requests = 2
+        self.emitter.send([{'value': 3}], log)
+        self.assertEqual(len(self.server.received), 2)
+        self.assertEqual(self.emitter.get_statistics()['monasca.agent.emitter.errors'], 1)
+
+    def test_send_encoded(self):
+        self.emitter.send(json.dumps([{'value': 1}]), log)
+        self.assertEqual(self.server.received, [[{'value': 1}]])
+
+    def test_forwarder_down(self):
+        down = emitter.Emitter('http://127.0.0.1:1', timeout=1)
+        down.send([{'value': 1}], log)
+        self.assertEqual(down.get_statistics()['monasca.agent.emitter.errors'], 1)
+
+    def test_hold_measurements_while_refused(self):
+        def envelope(name, value, dimensions):
+            return {'measurement': {'name': name, 'dimensions': dimensions, 'value': value,
+                                    'timestamp': 1000, 'value_meta': None},
+                    'tenant_id': None}
+
+        self.emitter.max_held_measurements = 3
+        self.server.retry_after = 30
+        self.emitter.send([envelope('a', 1, {'x': '1'}), envelope('a', 1, {'x': '2'})], log)
+        self.assertTrue(self.emitter.paused())
+        self.assertTrue(29 < self.emitter._resume_time - time.time() <= 30)
+
+        # nothing is sent while paused, every measurement is kept, as a count must not be replaced
+        self.emitter.send([envelope('a', 2, {'x': '1'}), envelope('b', 2, {})], log)
+        statistics = self.emitter.get_statistics()
+        self.assertEqual(statistics['monasca.agent.emitter.refused'], 1)
+        self.assertEqual(statistics['monasca.agent.emitter.held_measurements'], 3)
+        self.assertEqual(statistics['monasca.agent.emitter.dropped_measurements'], 1)
+
+        self.server.retry_after = 0
+        self.emitter._resume_time = 0
+        self.emitter.send([envelope('a', 3, {'x': '2'})], log)
+        self.assertEqual([(m['measurement']['dimensions'], m['measurement']['value'])
+                          for m in self.server.received[0]],
+                         [({'x': '1'}, 1), ({'x': '2'}, 1), ({'x': '1'}, 2), ({'x': '2'}, 3)])
+        self.assertEqual(self.emitter.get_statistics()['monasca.agent.emitter.held_measurements'], 0)
@@ -0,0 +1,72 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import json
+
+import mock
+import tornado.testing
+
+import monasca_agent.forwarder.daemon as daemon
+from tests.common import make_envelopes
+
+
+class TestForwarder(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        config = {'url': 'http://localhost:8070/v2.0',
+                  'max_buffer_size': -1,
+                  'max_measurement_buffer_size': -1,
+                  'backlog_send_rate': 5,
+                  'write_timeout': 10,
+                  'post_threads': 0,
+                  'max_batch_measurements': 4,
+                  'backlog_high_water_mark': 0.5}
+        self.forwarder = daemon.Forwarder(17123, config)
+        self.forwarder._endpoint.mon_client = mock.Mock()
+        self.forwarder._endpoint.mon_client.http_client.credentials_headers.return_value = {}
+        self.forwarder._add_tornado_handlers()
+        return self.forwarder
+
+    def get_status(self):
+        response = self.fetch('/status')
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body)
+
+    def test_status(self):
+        for count in (3, 3):
+            response = self.fetch('/intake', method='POST', body=json.dumps(make_envelopes(count)))
+            self.assertEqual(response.code, 200)
+
+        status = self.get_status()
+        self.assertEqual(status['totals']['intake_requests'], 2)
+        self.assertEqual(status['totals']['intake_measurements'], 6)
+        self.assertEqual(status['queue']['monasca.agent.forwarder.pending_measurements'], 2)
+        self.assertEqual(status['queue']['monasca.agent.forwarder.backlog_size'], 0)
+        self.assertEqual(status['last_report']['statistics'], {})
+
+        with mock.patch('monasca_agent.common.util.get_hostname', return_value='host'):
+            self.forwarder.publish_statistics()
+        statistics = self.get_status()['last_report']['statistics']
+        self.assertTrue(statistics['monasca.agent.forwarder.intake_measurements_sec'] > 0)
+        self.assertEqual(statistics['monasca.agent.forwarder.batch_measurements.count'], 1)
+        self.assertEqual(statistics['monasca.agent.forwarder.discarded_measurements'], 0)
+        # the forwarder's own measurements are not counted as intake
+        self.assertEqual(self.get_status()['totals']['intake_measurements'], 6)
+
+    def test_intake_refused_while_backlogged(self):
+        endpoint = self.forwarder._endpoint
+        endpoint.max_measurement_buffer_size = 10
+        endpoint.mon_client.http_client.raw_request.side_effect = Exception('down')
+        endpoint.post_metrics(make_envelopes(5))
+        self.assertTrue(endpoint.is_backlogged())
+
+        response = self.fetch('/intake', method='POST', body=json.dumps(make_envelopes(3)))
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], '10')
+        status = self.get_status()
+        self.assertEqual(status['totals']['intake_measurements'], 0)
+        self.assertEqual(status['totals']['refused_requests'], 1)
+
+        # the backlog is sent without waiting for new measurements
+        endpoint.mon_client.http_client.raw_request.side_effect = None
+        self.forwarder.flush()
+        self.assertFalse(endpoint.is_backlogged())
+        response = self.fetch('/intake', method='POST', body=json.dumps(make_envelopes(3)))
+        self.assertEqual(response.code, 200)
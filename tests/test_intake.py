@@ -0,0 +1,125 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import mock
+import tornado.ioloop
+import tornado.netutil
+
+import monasca_agent.common.emitter as emitter
+import monasca_agent.common.intake as intake
+import monasca_agent.forwarder.daemon as daemon
+
+log = logging.getLogger(__name__)
+
+ENVELOPES = [{'measurement': {'name': u'foo', 'dimensions': {u'a': u'\xe9'}, 'value': 1.5,
+                              'timestamp': 1000, 'value_meta': None},
+              'tenant_id': None},
+             {'measurement': {'name': u'bar', 'dimensions': {}, 'value': 2,
+                              'timestamp': 1000, 'value_meta': {u'msg': u'x'}},
+              'tenant_id': u'tenant'}]
+
+
+def decode_frame(frame):
+    length, encoding = intake.decode_header(frame[:intake.HEADER.size])
+    payload = frame[intake.HEADER.size:]
+    assert len(payload) == length
+    return intake.decode_payload(payload, encoding)
+
+
+class FakeForwarder(object):
+    def __init__(self):
+        self.received = []
+        self.retry_after = 0
+
+    def add_measurements(self, measurements):
+        self.received.extend(measurements)
+
+    def get_retry_after(self):
+        return self.retry_after
+
+    def refuse_measurements(self):
+        pass
+
+
+class TestIntakeFrames(unittest.TestCase):
+    def test_msgpack_round_trip(self):
+        if not intake.msgpack:
+            raise unittest.SkipTest('msgpack is not installed')
+        frame = intake.encode(ENVELOPES)
+        self.assertEqual(intake.HEADER.unpack(frame[:intake.HEADER.size])[1], intake.ENCODING_MSGPACK)
+        self.assertEqual(decode_frame(frame), ENVELOPES)
+
+    def test_json_round_trip(self):
+        with mock.patch.object(intake, 'msgpack', None):
+            frame = intake.encode(ENVELOPES)
+            self.assertEqual(intake.HEADER.unpack(frame[:intake.HEADER.size])[1], intake.ENCODING_JSON)
+            self.assertEqual(decode_frame(frame), ENVELOPES)
+
+    def test_invalid_header(self):
+        self.assertRaises(intake.FrameError, intake.decode_header, intake.HEADER.pack(10, 9))
+        self.assertRaises(intake.FrameError, intake.decode_header,
+                          intake.HEADER.pack(intake.MAX_FRAME_SIZE + 1, intake.ENCODING_JSON))
+
+    def test_socket_path(self):
+        self.assertEqual(intake.socket_path('unix:///run/forwarder.sock'), '/run/forwarder.sock')
+        self.assertEqual(intake.socket_path('http://localhost:17123'), None)
+
+
+class TestIntakeStreamServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'forwarder.sock')
+        self.forwarder = FakeForwarder()
+        self.io_loop = tornado.ioloop.IOLoop()
+        started = threading.Event()
+
+        def run():
+            self.io_loop.make_current()
+            server = daemon.IntakeStreamServer(self.forwarder)
+            server.add_socket(tornado.netutil.bind_unix_socket(self.path))
+            started.set()
+            self.io_loop.start()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+        started.wait(5)
+
+    def tearDown(self):
+        emitter.get_emitter('unix://' + self.path).close()
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.thread.join()
+        self.io_loop.close(all_fds=True)
+        shutil.rmtree(self.directory)
+
+    def test_emit_over_unix_socket(self):
+        url = 'unix://' + self.path
+        emitter.emit(ENVELOPES[:1], log, url)
+        emitter.emit(ENVELOPES[1:], log, url)
+
+        self.assertEqual(self.forwarder.received, ENVELOPES)
+        # both payloads were sent over the same connection
+        self.assertEqual(emitter.get_emitter(url).get_statistics()['monasca.agent.emitter.connections'], 1)
+
+    def test_refused_while_backlogged(self):
+        url = 'unix://' + self.path
+        self.forwarder.retry_after = 5
+        emitter.emit(ENVELOPES, log, url)
+
+        self.assertEqual(self.forwarder.received, [])
+        self.assertTrue(emitter.get_emitter(url).paused())
+        self.assertEqual(emitter.get_emitter(url).get_statistics()['monasca.agent.emitter.held_measurements'], 2)
+
+    def test_invalid_frame_is_refused(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(intake.HEADER.pack(3, 9) + 'foo')
+        self.assertEqual(intake.decode_status(emitter.recv_exactly(sock, intake.STATUS.size)),
+                         (intake.STATUS_BAD_REQUEST, 0))
+        self.assertEqual(sock.recv(1), '')
+        sock.close()
@@ -1,4 +1,5 @@
 # (C) Copyright 2016 Hewlett Packard Enterprise Development LP
+import pickle
 import unittest
 
 import monasca_agent.common.metrics as metrics
@@ -97,6 +98,28 @@ class TestMetrics(unittest.TestCase):
         results = counter.flush()
         self.assertEqual(results, [])
 
+    def test_Counter_sample_rate(self):
+        counter = metrics.Counter('bar', {}, None)
+
+        # adding 1 / 0.3 thirty times gives 99.99999999999997, the count is 100
+        for i in range(30):
+            counter.sample(1, 0.3, 1)
+        self.assertEqual(counter.flush_values(), [('bar', 100, 1)])
+
+        counter.sample(5, SAMPLE_RATE, 2)
+        counter.sample(1, 0.5, 2)
+        counter.sample(1, 0.5, 2)
+        counter.sample(1, 0.25, 2)
+        later = metrics.Counter('bar', {}, None)
+        later.sample(2, SAMPLE_RATE, 3)
+        later.sample(1, 0.25, 3)
+        counter.merge(later)
+        self.assertEqual(counter.flush_values(), [('bar', 19, 3)])
+
+        # invalid sample rates: ignore
+        counter.sample(1, 0, 4)
+        self.assertEqual(counter.flush_values(), [])
+
     def test_Rate(self):
         tenant_name = "test_rate"
         metric_name = "baz"
@@ -157,16 +180,9 @@ class TestMetrics(unittest.TestCase):
         self.assertEqual(measurement['value'], 1)
         self.assertEqual(measurement['timestamp'], 6000)
 
-	# negative rate: often result of a restart, but that should not be hidden
+	# counter reset, often the result of a restart: no rate for the interval
         rate.sample(1, SAMPLE_RATE, 7)
-
-        envelope = rate.flush()[0]
-        measurement = envelope['measurement']
-        self.assertEqual(envelope['tenant_id'], tenant_name)
-        self.assertEqual(measurement['name'], metric_name)
-        self.assertEqual(measurement['dimensions'], dimensions)
-        self.assertEqual(measurement['value'], -13)
-        self.assertEqual(measurement['timestamp'], 7000)
+        self.assertEqual(rate.flush(), [])
 
 	# recover from negative rate
 	rate.sample(2, SAMPLE_RATE, 8)
@@ -178,4 +194,95 @@ class TestMetrics(unittest.TestCase):
         self.assertEqual(measurement['dimensions'], dimensions)
         self.assertEqual(measurement['value'], 1)
         self.assertEqual(measurement['timestamp'], 8000)
+
+    def test_pickle(self):
+        histogram = metrics.histogram_class([0.9])('foo', {'a': 'b'}, 'tenant')
+        histogram.sample(3, SAMPLE_RATE, 1)
+        rate = metrics.rate_class(32)('bar', {}, None)
+        rate.sample(2 ** 32 - 5, SAMPLE_RATE, 1)
+
+        histogram, rate = pickle.loads(pickle.dumps([histogram, rate], 2))
+        self.assertIs(type(histogram), metrics.histogram_class([0.9]))
+        self.assertEqual(histogram.dimensions, (('a', 'b'),))
+        values = dict((name, value) for name, value, _ in histogram.flush_values())
+        self.assertAlmostEqual(values['foo.90percentile'], 3, delta=0.03)
+        self.assertIs(type(rate), metrics.rate_class(32))
+        rate.sample(5, SAMPLE_RATE, 2)
+        self.assertEqual(rate.flush_values(), [('bar', 10, 2)])
+
+    def test_Rate_counter_width(self):
+        rate = metrics.rate_class(32)('baz', {}, 'test_rate')
+        self.assertIs(metrics.rate_class(32), type(rate))
+        self.assertIs(metrics.rate_class(None), metrics.Rate)
+
+        # wrapped around at 2 ** 32
+        rate.sample(2 ** 32 - 10, SAMPLE_RATE, 1)
+        rate.sample(10, SAMPLE_RATE, 3)
+        self.assertEqual(rate.flush()[0]['measurement']['value'], 10)
+
+        # a drop by more than half the range is a reset
+        rate.sample(2 ** 31, SAMPLE_RATE, 4)
+        rate.sample(5, SAMPLE_RATE, 5)
+        self.assertEqual(rate.flush(), [])
+        rate.sample(15, SAMPLE_RATE, 6)
+        self.assertEqual(rate.flush()[0]['measurement']['value'], 10)
+
+        # so is a value too large for the counter
+        rate.sample(2 ** 32 + 10, SAMPLE_RATE, 7)
+        rate.flush()
+        rate.sample(0, SAMPLE_RATE, 8)
+        self.assertEqual(rate.flush(), [])
 	
+
+    def test_shared_dimensions(self):
+        dimensions = metrics.dimensions_key({'c': 'd', 'a': 'b'})
+        self.assertEqual(dimensions, (('a', 'b'), ('c', 'd')))
+
+        gauge = metrics.Gauge('foo', dimensions, None)
+        self.assertIs(gauge.dimensions, dimensions)
+        self.assertFalse(hasattr(gauge, '__dict__'))
+        self.assertEqual(gauge.metric, {'name': 'foo', 'dimensions': {'a': 'b', 'c': 'd'}})
+
+    def test_Histogram(self):
+        dimensions = {'a': 'b'}
+        histogram = metrics.Histogram('latency', dimensions, 'tenant')
+        self.assertEqual(histogram.flush(), [])
+
+        for value in range(1, 101):
+            histogram.sample(value, SAMPLE_RATE, 10)
+        histogram.sample(1000, 0.5, 11)
+
+        measurements = dict((envelope['measurement']['name'], envelope['measurement'])
+                            for envelope in histogram.flush())
+        self.assertEqual(sorted(measurements), ['latency.95percentile', 'latency.99percentile',
+                                                'latency.avg', 'latency.count', 'latency.max',
+                                                'latency.median', 'latency.min', 'latency.sum'])
+        self.assertEqual(measurements['latency.count']['value'], 102)
+        self.assertEqual(measurements['latency.sum']['value'], 7050)
+        self.assertEqual(measurements['latency.min']['value'], 1)
+        self.assertEqual(measurements['latency.max']['value'], 1000)
+        self.assertAlmostEqual(measurements['latency.median']['value'], 51, delta=0.51)
+        self.assertEqual(measurements['latency.count']['dimensions'], dimensions)
+        self.assertEqual(measurements['latency.count']['timestamp'], 11000)
+        self.assertEqual(histogram.flush(), [])
+
+        histogram = metrics.histogram_class([0.5, 0.999])('latency', dimensions)
+        histogram.sample(1, SAMPLE_RATE, 10)
+        self.assertEqual(sorted(envelope['measurement']['name'] for envelope in histogram.flush())[:2],
+                         ['latency.99.9percentile', 'latency.avg'])
+
+    def test_Set(self):
+        users = metrics.Set('users', {'a': 'b'})
+        self.assertEqual(users.flush(), [])
+        for value in ('x', 'y', 'x'):
+            users.sample(value, SAMPLE_RATE, 1)
+        self.assertEqual(users.flush()[0]['measurement']['value'], 2)
+        self.assertEqual(users.flush(), [])
+
+        # above exact_max the values are counted by a HyperLogLog
+        for value in range(metrics.SET_EXACT_MAX_DEFAULT * 2):
+            users.sample(str(value), SAMPLE_RATE, 2)
+        self.assertIsNotNone(users.hll)
+        count = users.flush()[0]['measurement']['value']
+        self.assertAlmostEqual(count, metrics.SET_EXACT_MAX_DEFAULT * 2, delta=100)
+        self.assertIsNone(users.hll)
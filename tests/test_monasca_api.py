@@ -0,0 +1,228 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import BaseHTTPServer
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import mock
+import monascaclient.client
+import monascaclient.exc
+
+import monasca_agent.forwarder.api.monasca_api as monasca_api
+from tests.common import make_envelopes
+
+
+class TestMonascaAPI(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.config = {'url': 'http://localhost:8070/v2.0',
+                       'max_buffer_size': -1,
+                       'max_measurement_buffer_size': -1,
+                       'backlog_send_rate': 5,
+                       'write_timeout': 10,
+                       'post_threads': 0}
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def get_api(self, **config):
+        self.config.update(config)
+        api = monasca_api.MonascaAPI(self.config)
+        api.mon_client = mock.Mock()
+        api.mon_client.http_client.credentials_headers.return_value = {}
+        return api
+
+    def test_failed_batches_are_queued(self):
+        api = self.get_api(max_measurement_buffer_size=5)
+        api.mon_client.http_client.raw_request.side_effect = Exception('down')
+
+        api.post_metrics(make_envelopes(3))
+        api.post_metrics(make_envelopes(2, tenant='other'))
+        self.assertEqual(len(api.message_queue), 2)
+        self.assertEqual(api._current_number_measurements, 5)
+
+        # the oldest batch is discarded once the measurement limit is exceeded
+        api.post_metrics(make_envelopes(1))
+        self.assertEqual(len(api.message_queue), 2)
+        self.assertEqual(api._current_number_measurements, 3)
+        statistics = api.get_statistics()
+        self.assertEqual(statistics['monasca.agent.forwarder.backlog_measurements'], 3)
+        self.assertEqual(statistics['monasca.agent.forwarder.discarded_batches'], 1)
+        self.assertEqual(statistics['monasca.agent.forwarder.discarded_measurements'], 3)
+        self.assertEqual(api.get_statistics()['monasca.agent.forwarder.discarded_measurements'], 0)
+        self.assertEqual(api.discarded_measurements_total, 3)
+
+    def test_spooled_backlog_survives_restart(self):
+        api = self.get_api(backlog_spool_dir=self.spool_dir)
+        api.mon_client.http_client.raw_request.side_effect = Exception('down')
+        api.post_metrics(make_envelopes(3, tenant='tenant'))
+        api.post_metrics(make_envelopes(2))
+        api.message_queue.close()
+
+        api = self.get_api(backlog_spool_dir=self.spool_dir)
+        self.assertEqual(len(api.message_queue), 2)
+        self.assertEqual(api._current_number_measurements, 5)
+
+        api.post_metrics(make_envelopes(1))
+        calls = api.mon_client.http_client.raw_request.call_args_list
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[1][0][1], '/metrics')
+        self.assertEqual(len(json.loads(calls[1][1]['data'])), 2)
+        self.assertEqual(calls[2][0][1], '/metrics?tenant_id=tenant')
+        self.assertEqual(len(json.loads(calls[2][1]['data'])), 3)
+        self.assertEqual(len(api.message_queue), 0)
+        self.assertEqual(api._current_number_measurements, 0)
+
+    def test_posts_from_threads(self):
+        api = self.get_api(post_threads=2, max_inflight_requests=1)
+        release = threading.Event()
+        api.mon_client.http_client.raw_request.side_effect = lambda *args, **kwargs: release.wait(5)
+
+        api.post_metrics(make_envelopes(3))
+        api.post_metrics(make_envelopes(2, tenant='other'))
+        # the first request for the default tenant is still running
+        api.post_metrics(make_envelopes(1))
+        self.assertEqual(len(api.message_queue), 1)
+        self.assertEqual(api.get_statistics()['monasca.agent.forwarder.send_queue_depth'], 2)
+
+        release.set()
+        api.stop()
+        statistics = api.get_statistics()
+        self.assertEqual(statistics['monasca.agent.forwarder.send_queue_depth'], 0)
+        self.assertTrue('monasca.agent.forwarder.send_time_ms' in statistics)
+        self.assertTrue(statistics['monasca.agent.forwarder.send_time_median_ms'] <=
+                        statistics['monasca.agent.forwarder.send_time_95percentile_ms'] <=
+                        statistics['monasca.agent.forwarder.send_time_max_ms'])
+        # the backlog is sent after the next successful post
+        self.assertEqual(api.mon_client.http_client.raw_request.call_count, 3)
+        self.assertEqual(len(api.message_queue), 0)
+
+    def test_slow_keystone_does_not_block_intake(self):
+        api = self.get_api(post_threads=1, max_buffer_size=10, backlog_high_water_mark=0.5)
+        api.mon_client = None
+        keystone_called = threading.Event()
+        release = threading.Event()
+
+        def get_monclient():
+            keystone_called.set()
+            release.wait(5)
+
+        with mock.patch.object(api, 'get_monclient', get_monclient):
+            api.post_metrics(make_envelopes(1))
+            self.assertTrue(keystone_called.wait(5))
+            # the IOLoop checks the backlog and queues batches while a post thread waits for Keystone
+            start = time.time()
+            self.assertFalse(api.is_backlogged())
+            api._queue_message(None, '[]', 0, 'test')
+            self.assertTrue(time.time() - start < 1)
+            release.set()
+            api.stop()
+        self.assertEqual(len(api.message_queue), 2)
+
+    def test_failure_reason_of_each_batch(self):
+        api = self.get_api()
+        api.mon_client.http_client.raw_request.side_effect = Exception('down')
+        self.assertEqual(api._send_message('[]'), 'The Monasca API is DOWN or unreachable')
+        api.mon_client.http_client.raw_request.side_effect = None
+        self.assertEqual(api._send_message('[]'), None)
+
+        api.mon_client.http_client.raw_request.side_effect = monascaclient.exc.HTTPUnauthorized()
+        self.assertEqual(api._send_message('[]'), 'Invalid token detected. Waiting to get new token from Keystone')
+        self.assertTrue(api._resume_time > time.time())
+        self.assertEqual(api._send_message('[]'), 'Waiting to get a new token from Keystone')
+
+    def test_backlog_batches_are_merged(self):
+        api = self.get_api(backlog_merge_size=600)
+        api.mon_client.http_client.raw_request.side_effect = Exception('down')
+        api.post_metrics(make_envelopes(1, tenant='other'))
+        for _ in range(3):
+            api.post_metrics(make_envelopes(2))
+        api.post_metrics(make_envelopes(1))
+        self.assertEqual(len(api.message_queue), 5)
+
+        raw_request = api.mon_client.http_client.raw_request
+        raw_request.reset_mock()
+        raw_request.side_effect = None
+        api.post_metrics(make_envelopes(1))
+
+        # the failures halved the number of requests sent from the backlog
+        self.assertEqual(api.drain.rate, 2)
+        bodies = [json.loads(call[1]['data']) for call in raw_request.call_args_list]
+        self.assertEqual([len(body) for body in bodies], [1, 5, 2])
+        self.assertEqual(len(api.message_queue), 1)
+        self.assertEqual(api._current_number_measurements, 1)
+
+
+class StubAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, self.headers.get('Content-Encoding'), body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubAPIHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def get_api(self, **config):
+        api_config = {'url': 'http://127.0.0.1:{0}/v2.0'.format(self.server.server_port),
+                      'max_buffer_size': -1,
+                      'max_measurement_buffer_size': -1,
+                      'backlog_send_rate': 5,
+                      'write_timeout': 10,
+                      'post_threads': 0}
+        api_config.update(config)
+        api = monasca_api.MonascaAPI(api_config)
+        api.mon_client = monascaclient.client.Client('2_0', api_config['url'], token='token')
+        return api
+
+    def test_compressed_body_round_trips(self):
+        envelopes = make_envelopes(100, tenant='tenant')
+        expected = [envelope['measurement'] for envelope in envelopes]
+        for encoding, wbits in (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)):
+            api = self.get_api(compression=encoding, compression_level=9)
+            api.post_metrics(envelopes)
+
+            path, content_encoding, body = self.server.requests.pop()
+            self.assertEqual(path, '/v2.0/metrics?tenant_id=tenant')
+            self.assertEqual(content_encoding, encoding)
+            self.assertEqual(json.loads(zlib.decompress(body, wbits)), expected)
+            statistics = api.get_statistics()
+            self.assertTrue(statistics['monasca.agent.forwarder.compression_ratio'] > 5)
+            self.assertTrue('monasca.agent.forwarder.compression_time_ms' in statistics)
+
+    def test_compression_time_is_cpu_time(self):
+        def compress(body, encoding, level):
+            time.sleep(0.2)
+            return monasca_api.CompressedBody(zlib.compress(body))
+
+        api = self.get_api(compression='deflate')
+        with mock.patch.object(monasca_api, 'compress', compress):
+            api.post_metrics(make_envelopes(100))
+        # the sleep is not counted
+        self.assertTrue(api.get_statistics()['monasca.agent.forwarder.compression_time_ms'] < 100)
+
+    def test_small_bodies_are_not_compressed(self):
+        api = self.get_api(compression='gzip', compression_min_size=100000)
+        api.post_metrics(make_envelopes(10))
+
+        path, content_encoding, body = self.server.requests.pop()
+        self.assertEqual(content_encoding, None)
+        self.assertEqual(len(json.loads(body)), 10)
+        self.assertFalse('monasca.agent.forwarder.compression_ratio' in api.get_statistics())
@@ -0,0 +1,63 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import time
+import unittest
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.common.metrics as metrics_pkg
+import monasca_agent.common.rules as rules
+
+
+class TestRules(unittest.TestCase):
+    def make_aggregator(self, *rule_config):
+        return aggregator.MetricsAggregator('host', rules=list(rule_config))
+
+    def flush(self, metrics_aggregator):
+        return sorted((envelope['measurement']['name'], envelope['measurement']['dimensions'],
+                       envelope['measurement']['value']) for envelope in metrics_aggregator.flush())
+
+    def test_drop_dimensions(self):
+        metrics_aggregator = self.make_aggregator({'metric': r'vm\.vnic\.', 'drop_dimensions': ['device'],
+                                                   'function': 'sum'})
+        for device, value in (('tap1', 1), ('tap2', 2)):
+            metrics_aggregator.submit_metric('vm.vnic.in_bytes', value, metrics_pkg.Gauge,
+                                             dimensions={'device': device, 'resource_id': 'vm1'})
+        metrics_aggregator.submit_metric('vm.cpu', 5, metrics_pkg.Gauge, dimensions={'device': 'cpu0'})
+
+        self.assertEqual(self.flush(metrics_aggregator),
+                         [('vm.cpu', {'device': 'cpu0', 'hostname': 'host'}, 5),
+                          ('vm.vnic.in_bytes', {'hostname': 'host', 'resource_id': 'vm1'}, 3)])
+        self.assertEqual(metrics_aggregator.get_statistics()['monasca.agent.aggregator.rule_reduced_points'], 1)
+
+    def test_every(self):
+        metrics_aggregator = self.make_aggregator({'metric': 'prometheus', 'every': 3})
+        sent = []
+        for value in range(7):
+            metrics_aggregator.submit_metric('prometheus.up', value, metrics_pkg.Gauge, dimensions={})
+            sent.extend(value for _, _, value in self.flush(metrics_aggregator))
+        self.assertEqual(sent, [0, 3, 6])
+
+    def test_window(self):
+        metrics_aggregator = self.make_aggregator({'metric': 'load', 'window': 20, 'function': 'max'})
+        now = time.time() - 100
+        sent = []
+        for offset, value in ((0, 1), (10, 5), (20, 2), (30, 3)):
+            metrics_aggregator.submit_metric('load', value, metrics_pkg.Gauge, dimensions={},
+                                             timestamp=now + offset)
+            sent.append([value for _, _, value in self.flush(metrics_aggregator)])
+        self.assertEqual(sent, [[], [], [5], []])
+        # the window in progress is sent once the metric is no longer sampled
+        self.assertEqual([value for _, _, value in self.flush(metrics_aggregator)], [3])
+        self.assertEqual(self.flush(metrics_aggregator), [])
+
+    def test_first_matching_rule(self):
+        engine = rules.RuleEngine([{'metric': 'a', 'function': 'min'}, {'metric': '.*', 'function': 'max'}])
+        self.assertEqual(engine.match('abc').function, 'min')
+        self.assertEqual(engine.match('b').function, 'max')
+        self.assertIs(engine.match('b'), engine.rules[1])
+
+    def test_invalid_rules(self):
+        self.assertRaises(rules.InvalidRule, rules.RuleEngine, [{'metric': '('}])
+        self.assertRaises(rules.InvalidRule, rules.RuleEngine, [{'metric': 'a', 'function': 'median'}])
+        self.assertRaises(rules.InvalidRule, rules.RuleEngine, [{'function': 'sum'}])
+        # an aggregator with invalid rules sends every measurement
+        self.assertEqual(self.make_aggregator({'metric': 'a', 'every': 0}).rules, None)
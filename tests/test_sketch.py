@@ -0,0 +1,77 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import random
+import unittest
+
+import monasca_agent.common.sketch as sketch
+
+
+class TestSketch(unittest.TestCase):
+    def assertRelativeError(self, estimate, exact, accuracy=sketch.RELATIVE_ACCURACY_DEFAULT):
+        self.assertTrue(abs(estimate - exact) <= accuracy * abs(exact),
+                        '{0} is not within {1} of {2}'.format(estimate, accuracy, exact))
+
+    def test_quantiles(self):
+        values = [random.lognormvariate(3, 2) for _ in range(10000)]
+        quantiles = sketch.Sketch()
+        for value in values:
+            quantiles.add(value)
+        values.sort()
+        for fraction in (0, 0.25, 0.5, 0.95, 0.99, 1):
+            self.assertRelativeError(quantiles.quantile(fraction), values[int(fraction * (len(values) - 1))])
+        self.assertEqual(quantiles.count, 10000)
+        self.assertEqual(quantiles.min, values[0])
+        self.assertEqual(quantiles.max, values[-1])
+
+    def test_negative_and_zero(self):
+        quantiles = sketch.Sketch()
+        for value in (-100, -10, 0, 0, 10):
+            quantiles.add(value)
+        self.assertRelativeError(quantiles.quantile(0), -100)
+        self.assertRelativeError(quantiles.quantile(0.25), -10)
+        self.assertEqual(quantiles.quantile(0.5), 0)
+        self.assertRelativeError(quantiles.quantile(1), 10)
+        self.assertEqual(quantiles.sum, -100)
+
+    def test_weights_and_merge(self):
+        first = sketch.Sketch()
+        first.add(1, 3)
+        second = sketch.Sketch()
+        second.add(100)
+        first.merge(second)
+        self.assertEqual(first.count, 4)
+        self.assertEqual(first.sum, 103)
+        self.assertRelativeError(first.quantile(0.5), 1)
+        self.assertEqual(first.max, 100)
+
+        first.clear()
+        self.assertEqual(first.count, 0)
+        self.assertEqual(first.quantile(0.5), None)
+
+    def test_bounded_bins(self):
+        quantiles = sketch.Sketch(max_bins=10)
+        for exponent in range(-5, 20):
+            quantiles.add(10 ** exponent)
+        self.assertEqual(len(quantiles._positive.bins), 10)
+        # the highest values keep their accuracy
+        self.assertRelativeError(quantiles.quantile(1), 10 ** 19)
+        self.assertEqual(quantiles.count, 25)
+
+
+class TestHyperLogLog(unittest.TestCase):
+    def test_count(self):
+        for distinct in (10, 1000, 100000):
+            hll = sketch.HyperLogLog()
+            for value in range(distinct):
+                hll.add('session-{0}'.format(value))
+                hll.add('session-{0}'.format(value))
+            self.assertTrue(abs(hll.count() - distinct) <= 0.05 * distinct,
+                            '{0} is not close to {1}'.format(hll.count(), distinct))
+
+    def test_merge(self):
+        first = sketch.HyperLogLog()
+        second = sketch.HyperLogLog()
+        for value in range(1000):
+            first.add(value)
+            second.add(value + 500)
+        first.merge(second)
+        self.assertTrue(abs(first.count() - 1500) <= 75)
@@ -0,0 +1,81 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import monasca_agent.forwarder.api.spool as spool
+
+
+def make_batch(tenant, count, value=0):
+    measurements = [{'name': 'foo', 'dimensions': {'a': 'b'}, 'value': value, 'timestamp': 1000}] * count
+    return tenant, json.dumps(measurements), count
+
+
+class TestSegmentSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pop_returns_newest_first(self):
+        queue = spool.SegmentSpool(self.directory)
+        first = make_batch(None, 2, value=1)
+        second = make_batch(u'tenant', 3, value=2)
+        queue.append(first)
+        queue.append(second)
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.measurements, 5)
+        self.assertEqual(queue.pop(), second)
+        self.assertEqual(queue.pop(), first)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.measurements, 0)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertRaises(IndexError, queue.pop)
+
+    def test_survives_restart(self):
+        queue = spool.SegmentSpool(self.directory, segment_size=256)
+        batches = [make_batch('tenant', 1, value=i) for i in range(10)]
+        for batch in batches:
+            queue.append(batch)
+        queue.close()
+        self.assertTrue(len(os.listdir(self.directory)) > 1)
+
+        queue = spool.SegmentSpool(self.directory, segment_size=256)
+        self.assertEqual(len(queue), 10)
+        self.assertEqual(queue.measurements, 10)
+        for batch in reversed(batches):
+            self.assertEqual(queue.pop(), batch)
+
+    def test_partial_record_discarded_on_load(self):
+        queue = spool.SegmentSpool(self.directory)
+        batch = make_batch(None, 4)
+        queue.append(batch)
+        queue.append(make_batch(None, 2))
+        queue.close()
+
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+
+        queue = spool.SegmentSpool(self.directory)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.measurements, 4)
+        self.assertEqual(queue.pop(), batch)
+
+    def test_evict_oldest_segment(self):
+        queue = spool.SegmentSpool(self.directory, max_measurements=16)
+        for i in range(6):
+            queue.append(make_batch(None, 1, value=i))
+        newest = make_batch(None, 1, value=6)
+        queue.append(newest)
+
+        # segments are closed after 16 / 8 measurements
+        self.assertEqual(queue.evict_oldest(), (2, 2))
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(queue.measurements, 5)
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+        self.assertEqual(queue.pop(), newest)
@@ -0,0 +1,338 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+import monasca_agent.common.aggregator as aggregator
+import monasca_agent.common.metrics as metrics_pkg
+import monasca_agent.statsd.udp as udp
+import monasca_agent.statsd.workers as workers
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = aggregator.ShardedMetricsAggregator('Foo')
+        self.server = udp.Server(self.aggregator, '127.0.0.1', free_port())
+
+    def tearDown(self):
+        if self.server.socket is not None:
+            self.server.socket.close()
+
+    def test_statistics(self):
+        self.server.bind()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(3):
+            client.sendto('counter:1|c', self.server.address)
+        time.sleep(0.1)
+        for i in range(3):
+            self.server.packets += 1
+            self.server.submit_packets(self.server.socket.recv(self.server.buffer_size))
+
+        self.assertEqual(self.server.collect(self.aggregator),
+                         [({}, {'monasca.agent.statsd.packets': 3, 'monasca.agent.statsd.kernel_drops': 0})])
+        self.assertEqual(self.server.get_statistics()['monasca.agent.statsd.packets'], 0)
+        self.assertEqual(udp.kernel_drops(self.server.socket), 0)
+        self.assertEqual(self.aggregator.flush()[0]['measurement']['value'], 3)
+
+    def test_receive_buffer(self):
+        self.server.receive_buffer = 65536
+        self.server.bind()
+        self.assertGreaterEqual(self.server.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536)
+
+
+class TestListeners(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = aggregator.ShardedMetricsAggregator('Foo')
+        self.directory = tempfile.mkdtemp()
+        self.unix_socket = os.path.join(self.directory, 'statsd.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_server(self, send, **kwargs):
+        server = udp.Server(self.aggregator, '127.0.0.1', free_port(), **kwargs)
+        server.bind()
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        try:
+            send(server)
+            time.sleep(0.2)
+        finally:
+            server.stop()
+            # wake the select loop up
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM).sendto('', server.address)
+            thread.join()
+        return dict(((envelope['measurement']['name'], envelope['measurement']['dimensions'].get('line')),
+                     envelope['measurement']['value'])
+                    for envelope in self.aggregator.flush())
+
+    def test_tcp(self):
+        def send(server):
+            tcp_address = (server.address[0], server.tcp_port)
+            client = socket.create_connection(tcp_address)
+            # lines split over several sends, and a bad line
+            client.sendall('counter:1|c\ncoun')
+            time.sleep(0.1)
+            client.sendall('ter:2|c\nbad\ngauge:7|g')
+            client.close()
+            client = socket.create_connection(tcp_address)
+            client.sendall('\n'.join('counter:1|c|#{"line": "%d"}' % (i % 2) for i in range(2000)))
+            client.close()
+
+        values = self.run_server(send, tcp_port=free_port())
+        self.assertEqual(values, {('counter', None): 3, ('gauge', None): 7, ('counter', '0'): 1000,
+                                  ('counter', '1'): 1000})
+
+    def test_tcp_long_line(self):
+        def send(server):
+            client = socket.create_connection((server.address[0], server.tcp_port))
+            # the rest of the line after MAX_LINE_LENGTH is discarded, up to its newline
+            client.sendall('counter:1|c\n' + 'x' * (udp.MAX_LINE_LENGTH + 10))
+            time.sleep(0.1)
+            client.sendall('x' * 100)
+            time.sleep(0.1)
+            client.sendall('gauge:3|g\ncounter:2|c\n')
+            client.close()
+            time.sleep(0.2)
+            self.assertEqual(server.packets, 2)
+
+        values = self.run_server(send, tcp_port=free_port())
+        self.assertEqual(values, {('counter', None): 3})
+
+    def test_unix_dgram(self):
+        def send(server):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # larger than a UDP datagram of statsd
+            client.sendto('\n'.join(['counter:1|c|#{"padding": "%s"}' % ('x' * 100)] * 200), self.unix_socket)
+            client.close()
+
+        values = self.run_server(send, unix_socket=self.unix_socket)
+        self.assertEqual(values, {('counter', None): 200})
+        self.assertFalse(os.path.exists(self.unix_socket))
+
+    def test_unix_stream(self):
+        def send(server):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(self.unix_socket)
+            client.sendall('counter:1|c\n' * 10 + 'counter:5|c')
+            client.close()
+
+        # a socket left by a previous run is replaced
+        socket.socket(socket.AF_UNIX, socket.SOCK_STREAM).bind(self.unix_socket)
+        values = self.run_server(send, unix_socket=self.unix_socket, unix_socket_type='stream')
+        self.assertEqual(values, {('counter', None): 15})
+
+
+class TestParser(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = aggregator.MetricsAggregator('myhost')
+        self.server = udp.Server(self.aggregator, '127.0.0.1', 8125)
+
+    def values(self):
+        return sorted((envelope['measurement']['name'], envelope['measurement']['value'],
+                       sorted(envelope['measurement']['dimensions'].items()))
+                      for envelope in self.aggregator.flush())
+
+    def test_metric_packets(self):
+        parse = udp.Server._parse_metric_packet
+        self.assertEqual(parse('int:1|c'), ('int', 1, 'c', {}, 1))
+        self.assertEqual(parse('my.second.gauge:1.5|g'), ('my.second.gauge', 1.5, 'g', {}, 1))
+        self.assertEqual(parse('test.scinot:9.512901e-05|g'), ('test.scinot', 9.512901e-05, 'g', {}, 1))
+        self.assertEqual(parse('my.set:string|s'), ('my.set', 'string', 's', {}, 1))
+        self.assertEqual(parse('sampled.hist:5|h|@0.5'), ('sampled.hist', 5, 'h', {}, 0.5))
+        self.assertEqual(parse('gauge:2|c|@1'), ('gauge', 2, 'c', {}, 1.0))
+        self.assertEqual(parse('gauge:4|c|#tag1,tag2'), ('gauge', 4, 'c', {'tag1': 'True', 'tag2': 'True'}, 1))
+        self.assertEqual(parse('gauge:4|c|@0.1|#tag1:a, tag2:b:c ,tag3:'),
+                         ('gauge', 4, 'c', {'tag1': 'a', 'tag2': 'b:c', 'tag3': '?'}, 0.1))
+        self.assertEqual(parse('gauge:4|ms|#{"service": "api", "code": "200"}'),
+                         ('gauge', 4, 'ms', {'service': 'api', 'code': '200'}, 1))
+        self.assertEqual(parse("gauge:4|ms|#{'service': 'a,b:c', 'ratio': '0.5' }"),
+                         ('gauge', 4, 'ms', {'service': 'a,b:c', 'ratio': '0.5'}, 1))
+        self.assertEqual(parse('gauge:4|ms|#{}'), ('gauge', 4, 'ms', {}, 1))
+        # the other dict literals are parsed as by ast.literal_eval
+        self.assertEqual(parse('gauge:4|ms|#{"a": "b", }'), ('gauge', 4, 'ms', {'a': 'b'}, 1))
+        self.assertEqual(parse(r'gauge:4|ms|#{"a": "x\"y", "b": "\t"}'), ('gauge', 4, 'ms', {'a': 'x"y', 'b': '\t'}, 1))
+        self.assertEqual(parse("gauge:4|ms|#{u'a': 'b'}"), ('gauge', 4, 'ms', {u'a': 'b'}, 1))
+        self.assertEqual(udp.Server._parse_service_check_packet('_sc|check|2|#a:b,c:d'),
+                         ('check', 2, {'a': 'b', 'c': 'd'}))
+
+    def test_bad_packets(self):
+        for packet in ['missing.value.and.type',
+                       'missing.type:2',
+                       'missing.value|c',
+                       '2|c',
+                       'string.value:abc|c',
+                       'string.sample.rate:0|c|@abc',
+                       'sample.rate:0|c|@2',
+                       'dimensions:0|c|#{"a": b}',
+                       'dimensions:0|c|#{"a": "b"',
+                       'dimensions:0|c|#{"a": "b"} c',
+                       'dimensions:0|c|#{"a": "b",,}',
+                       # only flat dicts of strings are dimensions
+                       'dimensions:0|c|#{"code": 200}',
+                       'dimensions:0|c|#{"a": True}',
+                       'dimensions:0|c|#{"a": ["b"]}',
+                       'dimensions:0|c|#{1: "b"}',
+                       'dimensions:0|c|#{"a", "b"}',
+                       'dimensions:0|c|#{"a": ' + '(' * 1000 + '"b"' + ')' * 1000 + '}']:
+            self.assertRaises(Exception, udp.Server._parse_metric_packet, packet)
+
+    def test_dimensions_cache(self):
+        dimensions = udp.parse_dimensions('tag1:a,tag2:b')
+        self.assertIs(udp.parse_dimensions('tag1:a,tag2:b'), dimensions)
+        for i in range(udp.TAG_CACHE_SIZE):
+            udp.parse_dimensions('tag:%d' % i)
+        self.assertLessEqual(len(udp._tag_cache), udp.TAG_CACHE_SIZE)
+        self.assertEqual(udp.parse_dimensions('tag1:a,tag2:b'), dimensions)
+
+    def test_submit_packets(self):
+        self.server.submit_packets('counter:1|c\ncounter:1|c|@0.5\ngauge:1|g\n\n'
+                                   'gauge:4|c|#tag1,tag2\ngauge:8|c|#tag2,tag1\nmy.set:10|s\nmy.set:20|s\n'
+                                   'my.set:10|s\nunknown.type:2|z\n_e{6,4}:title|text')
+        self.assertEqual(self.values(), [('counter', 3.0, [('hostname', 'myhost')]),
+                                         ('gauge', 1, [('hostname', 'myhost')]),
+                                         ('gauge', 12, [('hostname', 'myhost'), ('tag1', 'True'),
+                                                        ('tag2', 'True')]),
+                                         ('my.set', 2, [('hostname', 'myhost')])])
+
+
+class TestDatagramReader(unittest.TestCase):
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        # room for more than MAX_DATAGRAMS_PER_WAKEUP datagrams
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 ** 21)
+        self.sock.bind(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.sock.close()
+
+    def send(self, count):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(count):
+            client.sendto('counter.%d:1|c' % i, self.sock.getsockname())
+        client.close()
+        time.sleep(0.1)
+
+    def check_read(self, batch):
+        reader = udp.DatagramReader(self.sock, 16, batch)
+        self.assertEqual(reader.read(), [])
+        self.send(100)
+        # longer datagrams are truncated
+        self.assertEqual(reader.read(), ['counter.%d:1|c' % i for i in range(100)])
+        self.assertEqual(reader.read(), [])
+
+        self.send(udp.MAX_DATAGRAMS_PER_WAKEUP + 10)
+        self.assertEqual(len(reader.read()), udp.MAX_DATAGRAMS_PER_WAKEUP)
+        self.assertEqual(len(reader.read()), 10)
+
+    def test_read_batches(self):
+        self.assertIsNotNone(udp._recvmmsg)
+        self.check_read(8)
+
+    def test_read_each(self):
+        self.check_read(1)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_collect(self):
+        metrics_aggregator = aggregator.ShardedMetricsAggregator('Foo')
+        address = ('127.0.0.1', free_port())
+        pool = workers.WorkerPool(2, metrics_aggregator, address[0], address[1], histogram_percentiles=[0.5])
+        thread = threading.Thread(target=pool.start)
+        thread.start()
+        try:
+            # wait for the workers to bind the port
+            time.sleep(1)
+            # the kernel picks the worker of each client socket
+            for client_index in range(8):
+                client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                for i in range(10):
+                    client.sendto('requests:1|c|#{"client": "all"}\nlatency:%d|ms' % i, address)
+                client.close()
+
+            packets = 0
+            deadline = time.time() + 10
+            while packets < 80 and time.time() < deadline:
+                time.sleep(0.1)
+                collected = pool.collect(metrics_aggregator)
+                self.assertEqual(sorted(dimensions['worker'] for dimensions, _ in collected), ['0', '1'])
+                packets += sum(statistics['monasca.agent.statsd.packets'] for _, statistics in collected)
+            self.assertEqual(packets, 80)
+        finally:
+            pool.stop()
+            thread.join()
+
+        values = dict((envelope['measurement']['name'], envelope['measurement']['value'])
+                      for envelope in metrics_aggregator.flush())
+        self.assertEqual(values['requests'], 80)
+        self.assertEqual(values['latency.count'], 80)
+        self.assertEqual(values['latency.max'], 9)
+        self.assertIn('latency.median', values)
+        self.assertEqual(pool.workers, [])
+
+    def test_restart_exited_worker(self):
+        metrics_aggregator = aggregator.ShardedMetricsAggregator('Foo')
+        address = ('127.0.0.1', free_port())
+        pool = workers.WorkerPool(2, metrics_aggregator, address[0], address[1])
+        with mock.patch.object(udp, 'UDP_SOCKET_TIMEOUT', 0.1):
+            pool.start_workers()
+            exited = pool.workers[1][0]
+            thread = threading.Thread(target=pool.start)
+            thread.start()
+            try:
+                os.kill(exited.pid, signal.SIGKILL)
+                deadline = time.time() + 10
+                while pool.workers[1][0] is exited and time.time() < deadline:
+                    time.sleep(0.1)
+                self.assertIsNot(pool.workers[1][0], exited)
+                self.assertTrue(pool.workers[1][0].is_alive())
+                self.assertEqual(sorted(dimensions['worker'] for dimensions, _ in pool.collect(metrics_aggregator)),
+                                 ['0', '1'])
+            finally:
+                pool.stop()
+                thread.join()
+        self.assertEqual(pool.workers, [])
+
+    def test_late_reply_is_read_before_asking_again(self):
+        metrics_aggregator = aggregator.ShardedMetricsAggregator('Foo')
+        pool = workers.WorkerPool(1, metrics_aggregator, '127.0.0.1', 0)
+        connection, worker_connection = multiprocessing.Pipe()
+        pool.workers = [(mock.Mock(name='worker'), connection)]
+
+        def reply(value):
+            self.assertEqual(worker_connection.recv(), 'collect')
+            worker = aggregator.ShardedMetricsAggregator('Foo', shards=1)
+            worker.submit_metric('requests', value, metrics_pkg.Counter, dimensions={})
+            samples, count = worker.take_samples()
+            worker_connection.send((samples, count, {'monasca.agent.statsd.packets': count}))
+
+        with mock.patch.object(workers, 'COLLECT_TIMEOUT', 0.1):
+            # the worker does not answer in time
+            self.assertEqual(pool.collect(metrics_aggregator), [])
+            reply(1)
+            # its late reply is read without sending another request
+            self.assertEqual(len(pool.collect(metrics_aggregator)), 1)
+            self.assertFalse(worker_connection.poll())
+            self.assertEqual(metrics_aggregator.flush()[0]['measurement']['value'], 1)
+
+            # the next collect asks again and gets the samples of its own interval
+            threading.Timer(0.01, reply, (2,)).start()
+            self.assertEqual(len(pool.collect(metrics_aggregator)), 1)
+            self.assertEqual(metrics_aggregator.flush()[0]['measurement']['value'], 2)